@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+#
+# Micro-benchmarks for procoin.core.ProCoin using a synthetic catalog and
+# users file (see benchmarks/synthetic.py). Discord is not required.
+#
+# Run this from the repository root with:
+#   python3 -m benchmarks.bench_core --items 1000 --users 10000 \
+#       --output results.json [--compare old_results.json]
+#
+# The results are written as JSON so runs on different commits can be
+# compared with --compare.
+#
+
+from __future__ import annotations
+import argparse, asyncio, itertools, json, os, platform, random, shutil, subprocess
+import tempfile, time, timeit
+from collections.abc import Callable
+from typing import Any, Optional
+
+from procoin import db
+from procoin.core import ProCoin
+from procoin.ledger import Ledger
+from procoin.users import UserInterface
+from .synthetic import generate_items, generate_users
+
+# Times fn and returns the mean and best time per call in microseconds.
+def _time(fn: Callable[[], Any], number: int, repeat: int) \
+        -> dict[str, float]:
+    times = timeit.Timer(fn).repeat(repeat=repeat, number=number)
+    return {
+        'mean_us': sum(times) / len(times) / number * 1e6,
+        'min_us': min(times) / number * 1e6,
+        'calls': number * repeat,
+    }
+
+# Submits n operations to a new ledger at once and waits for them to be
+# applied.
+async def _ledger_batch(fn: Callable[[], Any], n: int) -> None:
+    ledger = Ledger()
+    await asyncio.gather(*[ledger.submit(fn) for _ in range(n)])
+    ledger.close()
+
+# Returns a list of (name, function, number) tuples.
+def _benchmarks(pc: ProCoin, directory: str) \
+        -> list[tuple[str, Callable[[], Any], int]]:
+    rng = random.Random(0)
+    items = list(pc.items.items.values())
+    stockable = [item for item in items if item.stockable and not item.cursed]
+    normal = [item for item in items if not item.cursed]
+    cursed = [item for item in items if item.cursed]
+
+    # Give the store (practically) unlimited stock.
+    for item in stockable:
+        pc.store.sell(item, 10 ** 12)
+
+    # Create some users with (practically) unlimited items and money.
+    rich = pc.users.get_or_create('rich')
+    rich2 = pc.users.get_or_create('rich2')
+    for user in (rich, rich2):
+        user.balance = 10 ** 30
+        for item in normal:
+            user.add_item(item, 10 ** 12)
+
+    cursed_user = pc.users.get_or_create('cursed')
+    cursed_user.add_item(pc.items.get_item('remove_curse'), 10 ** 12)
+    cursed_user.add_item(rng.choice(normal), 10 ** 12)
+    for item in cursed:
+        cursed_user.add_item(item, 10 ** 12)
+
+    names = itertools.cycle([item.name.upper() for item in items])
+    buy_items = itertools.cycle([item.name for item in stockable])
+    sell_items = itertools.cycle([item.name for item in normal])
+    recipes = itertools.cycle([[item.name
+                                for item in pc.merges.get_recipe(key)]
+                               for key in pc.merges.merges])
+    payers = itertools.cycle((('rich', 'rich2'), ('rich2', 'rich')))
+
+    def get_inventory_cold() -> None:
+        rich.add_item(normal[0], 1)
+        rich.get_inventory()
+
+    loop = asyncio.new_event_loop()
+    def ledger_pay() -> None:
+        loop.run_until_complete(_ledger_batch(
+            lambda : pc.pay(*next(payers), 1), 100))
+
+    raw_users = pc.users.to_dict()
+    users_file = os.path.join(directory, 'bench_users.json')
+    db.save_blocking(users_file, raw_users)
+    binary_file = os.path.join(directory, 'bench_users.bin')
+    db.save_blocking(binary_file, raw_users, codec='binary')
+    big = max(1, len(raw_users) // 10_000)
+
+    # Loads the binary users file and decodes every user.
+    def load_binary_all() -> None:
+        for _ in db.load_users(binary_file).values():
+            pass
+
+    return [
+        ('ItemInterface.lookup', lambda : pc.items.lookup(next(names)),
+         10_000),
+        ('ProCoin.buy', lambda : pc.buy('rich', next(buy_items), 1), 1000),
+        ('ProCoin.sell', lambda : pc.sell('rich', next(sell_items), 1), 1000),
+        ('ProCoin.pay', lambda : pc.pay(*next(payers), 1), 1000),
+        ('Ledger (100x ProCoin.pay)', ledger_pay, 10),
+        ('ProCoin.give_item',
+         lambda : pc.give_item(*next(payers), next(sell_items), 1), 1000),
+        ('ProCoin.merge', lambda : pc.merge('rich', next(recipes), 1), 1000),
+        ('ProCoin.remove_curse', lambda : pc.remove_curse('cursed'), 1000),
+        ('User.get_inventory (cached)', rich.get_inventory, 1000),
+        ('User.get_inventory (changed)', get_inventory_cold, 100),
+        ('MergeInterface.update_merges', pc.merges.update_merges, 10),
+        ('ProCoin.reload_items (unchanged)', pc.reload_items, 10),
+        ('ProCoin.possible_merges', lambda : pc.possible_merges('rich'),
+         100),
+        ('UserInterface.to_dict', pc.users.to_dict, big),
+        ('UserInterface.from_dict',
+         lambda : UserInterface.from_dict(pc.store, raw_users), big),
+        ('db.save_blocking', lambda : db.save_blocking(users_file, raw_users),
+         big),
+        ('db.load', lambda : db.load(users_file), big),
+        ('db.save_blocking (binary)',
+         lambda : db.save_blocking(binary_file, raw_users, codec='binary'),
+         big),
+        ('db.load_users (binary)', lambda : db.load_users(binary_file), big),
+        ('db.load_users (binary, decode all)', load_binary_all, big),
+    ]
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              check=True).stdout.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(item_count: int, user_count: int, items_per_user: int,
+        repeat: int, only: Optional[str] = None) -> dict[str, Any]:
+    directory = tempfile.mkdtemp()
+    try:
+        items = generate_items(item_count)
+        users = generate_users(user_count, items,
+                               items_per_user=items_per_user)
+        db.save_blocking(os.path.join(directory, 'items.json'), items)
+        db.save_blocking(os.path.join(directory, 'users.json'), users)
+        del users
+
+        start = time.perf_counter()
+        pc = ProCoin(os.path.join(directory, 'items.json'),
+                     os.path.join(directory, 'users.json'))
+        load_time = time.perf_counter() - start
+
+        results: dict[str, dict[str, float]] = {
+            'ProCoin.__init__': {'mean_us': load_time * 1e6,
+                                 'min_us': load_time * 1e6, 'calls': 1},
+        }
+        for name, fn, number in _benchmarks(pc, directory):
+            if only and only not in name:
+                continue
+            results[name] = _time(fn, number, repeat)
+            print(f'{name:>32}: {results[name]["min_us"]:14,.2f} µs')
+
+        pc.save_user_file_blocking()
+        pc.close()
+    finally:
+        db.flush()
+        shutil.rmtree(directory)
+
+    return {
+        'meta': {
+            'commit': _git_commit(),
+            'python': platform.python_version(),
+            'time': time.time(),
+            'items': item_count,
+            'users': user_count,
+            'items_per_user': items_per_user,
+        },
+        'results': results,
+    }
+
+# Prints the ratio between the best times of two runs.
+def compare(old: dict[str, Any], new: dict[str, Any]) -> None:
+    print(f'Comparing with {old["meta"].get("commit")}:')
+    for name, result in new['results'].items():
+        old_result = old['results'].get(name)
+        if old_result is None:
+            continue
+        ratio = result['min_us'] / old_result['min_us']
+        print(f'{name:>32}: {ratio:6.2f}x')
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--items-per-user', type=int, default=30)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', help='Only run benchmarks containing this '
+                        'string.')
+    parser.add_argument('--output', help='Write the results to this file.')
+    parser.add_argument('--compare', help='Compare the results with a '
+                        'previous output file.')
+    args = parser.parse_args()
+
+    res = run(args.items, args.users, args.items_per_user, args.repeat,
+              args.only)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(res, f, indent=4)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(json.load(f), res)
+
+if __name__ == '__main__':
+    main()
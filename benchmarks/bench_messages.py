@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+#
+# Drives synthetic message streams through the on_message dispatch stage
+# (procoin.events) with the real boost and sweepstakes handlers, and reports
+# how many messages per second can be processed. Discord is not contacted.
+#
+# Run this from the repository root with:
+#   python3 -m benchmarks.bench_messages
+#
+
+from __future__ import annotations
+import argparse, asyncio, os, random, shutil, tempfile, time
+from collections.abc import Iterator
+from typing import Any, Optional
+
+from procoin import db
+
+# procoin_cog and sweepstakes_cog require discord.py.
+from procoin_cog import BotInterface
+from sweepstakes_cog import Sweepstakes
+
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class _FakeUser:
+    __slots__ = ('id', 'bot', 'mention', 'name')
+    def __init__(self, id: int, bot: bool = False) -> None:
+        self.id = id
+        self.bot = bot
+        self.mention = f'<@{id}>'
+        self.name = f'user{id}'
+
+    def mentioned_in(self, message: _FakeMessage) -> bool:
+        return self in message.mentions
+
+class _FakeGuild:
+    __slots__ = ('id',)
+    def __init__(self, id: int) -> None:
+        self.id = id
+
+class _FakeChannel:
+    __slots__ = ('sent',)
+    def __init__(self) -> None:
+        self.sent = 0
+
+    async def send(self, content: str) -> None:
+        self.sent += 1
+
+class _FakeMessage:
+    __slots__ = ('author', 'guild', 'channel', 'mentions')
+    def __init__(self, author: _FakeUser, guild: Optional[_FakeGuild],
+            channel: _FakeChannel, mentions: list[_FakeUser]) -> None:
+        self.author = author
+        self.guild = guild
+        self.channel = channel
+        self.mentions = mentions
+
+class _FakeBot:
+    __slots__ = ('user', 'cogs')
+    def __init__(self) -> None:
+        self.user = _FakeUser(1, bot=True)
+        self.cogs: dict[str, Any] = {}
+
+    def get_cog(self, name: str) -> Any:
+        return self.cogs.get(name)
+
+    def get_user(self, id: int) -> None:
+        return None
+
+# Generates a stream of messages. bot_ratio, dm_ratio and unknown_ratio are
+# the fractions of messages sent by bots, sent in DMs and sent by users without
+# a balance. spam makes every guild have a single author.
+def _messages(count: int, users: list[_FakeUser], bot: _FakeBot, *,
+        guilds: int, bot_ratio: float = 0, dm_ratio: float = 0,
+        unknown_ratio: float = 0, mention_ratio: float = 0,
+        spam: bool = False) -> Iterator[_FakeMessage]:
+    rng = random.Random(count)
+    guild_objs = [_FakeGuild(100 + i) for i in range(guilds)]
+    channel = _FakeChannel()
+    other_bot = _FakeUser(2, bot=True)
+    for i in range(count):
+        guild: Optional[_FakeGuild] = guild_objs[i % guilds]
+        if spam:
+            author = users[i % guilds]
+        else:
+            r = rng.random()
+            if r < bot_ratio:
+                author = other_bot
+            elif r < bot_ratio + unknown_ratio:
+                author = _FakeUser(10 ** 12 + i)
+            else:
+                author = rng.choice(users)
+            if rng.random() < dm_ratio:
+                guild = None
+        mentions = [bot.user] if rng.random() < mention_ratio else []
+        yield _FakeMessage(author, guild, channel, mentions)
+
+_scenarios = {
+    'active users': {},
+    'mixed': {'bot_ratio': 0.1, 'dm_ratio': 0.05, 'unknown_ratio': 0.2,
+              'mention_ratio': 0.01},
+    'spam': {'spam': True},
+}
+
+async def _run(messages: int, user_count: int, guilds: int) \
+        -> dict[str, float]:
+    tmpdir = tempfile.mkdtemp()
+    try:
+        shutil.copy(os.path.join(_root, 'items.json'), tmpdir)
+        bot = _FakeBot()
+        cog = bot.cogs['General commands'] = BotInterface(bot, tmpdir)
+        bot.cogs['Sweepstakes'] = Sweepstakes(bot)
+
+        users = [_FakeUser(1000 + i) for i in range(user_count)]
+        assert cog.pc is not None
+        for user in users:
+            cog.pc.users.get_or_create(user.id)
+
+        results: dict[str, float] = {}
+        for name, kwargs in _scenarios.items():
+            stream = list(_messages(messages, users, bot, guilds=guilds,
+                                    **kwargs))
+            dispatch = cog.messages.dispatch
+            start = time.perf_counter()
+            for message in stream:
+                await dispatch(message)
+            results[name] = messages / (time.perf_counter() - start)
+
+        cog.cog_unload()
+        return results
+    finally:
+        db.flush()
+        shutil.rmtree(tmpdir)
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=200_000)
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--guilds', type=int, default=50)
+    args = parser.parse_args()
+
+    results = asyncio.run(_run(args.messages, args.users, args.guilds))
+    for name, rate in results.items():
+        print(f'{name:>16}: {rate:12,.0f} messages/s')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+#
+# Load-tests the ledger process (see procoin.rpc) without Discord. A ledger
+# server is started in one process with a synthetic users file, and several
+# stand-in bot processes each keep a number of requests in flight, reporting
+# how many operations per second the ledger process handles.
+#
+# Run this from the repository root with:
+#   python3 -m benchmarks.bench_rpc --clients 4 --pipeline 64
+#
+
+from __future__ import annotations
+import argparse, asyncio, multiprocessing, os, random, shutil, tempfile, time
+from typing import Any
+
+from procoin import db
+from procoin.core import ProCoin
+from procoin.items import ItemInterface
+from procoin.ledger import Ledger
+from procoin.rpc import LedgerServer, RemoteEconomy
+from procoin.store import Error
+from .synthetic import generate_items, generate_users
+
+def _serve(directory: str, path: str, ready: Any) -> None:
+    pc = ProCoin(os.path.join(directory, 'items.json'),
+                 os.path.join(directory, 'users.json'))
+    pc.store.regenerate_store()
+    server = LedgerServer(pc, Ledger())
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(server.start(path))
+    ready.set()
+    loop.run_forever()
+
+# A stand-in bot process that sends a mix of operations similar to what
+# commands and messages would send.
+async def _client(directory: str, path: str, user_ids: list[str],
+        operations: int, pipeline: int, seed: int) -> None:
+    items = ItemInterface.from_dict(db.load(os.path.join(directory,
+                                                         'items.json')))
+    economy = RemoteEconomy(path, items)
+    rng = random.Random(seed)
+    item_names = [item.name for item in items.items.values()]
+
+    async def worker(count: int) -> None:
+        for _ in range(count):
+            user_id = rng.choice(user_ids)
+            r = rng.random()
+            try:
+                if r < 0.7:
+                    economy.add_boost(user_id, time.time())
+                    await economy.balance(user_id)
+                elif r < 0.85:
+                    await economy.pay(user_id, rng.choice(user_ids), 1)
+                elif r < 0.95:
+                    await economy.sell(user_id, rng.choice(item_names), 1)
+                else:
+                    await economy.inventory(user_id)
+            except Error:
+                pass
+
+    await asyncio.gather(*[worker(operations // pipeline)
+                           for _ in range(pipeline)])
+    economy.close()
+
+def _run_client(*args: Any) -> None:
+    asyncio.run(_client(*args))
+
+def run(clients: int, operations: int, pipeline: int, user_count: int,
+        item_count: int) -> float:
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'ledger.sock')
+    server = None
+    try:
+        items = generate_items(item_count)
+        users = generate_users(user_count, items)
+        db.save_blocking(os.path.join(directory, 'items.json'), items)
+        db.save_blocking(os.path.join(directory, 'users.json'), users)
+        user_ids = list(users)
+        del users
+
+        ready = multiprocessing.Event()
+        server = multiprocessing.Process(target=_serve,
+                                         args=(directory, path, ready))
+        server.start()
+        ready.wait()
+
+        procs = [multiprocessing.Process(target=_run_client,
+                     args=(directory, path, user_ids, operations, pipeline, i))
+                 for i in range(clients)]
+        start = time.perf_counter()
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+        elapsed = time.perf_counter() - start
+        return clients * (operations // pipeline) * pipeline / elapsed
+    finally:
+        if server is not None:
+            server.terminate()
+            server.join()
+        shutil.rmtree(directory)
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--operations', type=int, default=20_000,
+                        help='The number of operations per client.')
+    parser.add_argument('--pipeline', type=int, default=64,
+                        help='The number of requests each client keeps in '
+                        'flight.')
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--items', type=int, default=1000)
+    args = parser.parse_args()
+
+    rate = run(args.clients, args.operations, args.pipeline, args.users,
+               args.items)
+    print(f'{rate:,.0f} operations/s')
+
+if __name__ == '__main__':
+    main()
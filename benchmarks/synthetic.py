@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+#
+# Generates synthetic items.json and users.json files for benchmarks.
+#
+# Usage: python3 -m benchmarks.synthetic <directory> [--items N] [--users N]
+#
+
+from __future__ import annotations
+import argparse, json, math, os, random
+from typing import Any
+
+# Generates an items.json catalog with item_count items (plus a scroll of
+# remove curse). merge_ratio of the items can be created with merges, and
+# cursed_ratio of them are cursed.
+def generate_items(item_count: int, *, merge_ratio: float = 0.1,
+        cursed_ratio: float = 0.02, seed: int = 0) -> dict[str, Any]:
+    rng = random.Random(seed)
+    items: dict[str, Any] = {}
+    for i in range(item_count):
+        cost = int(10 ** rng.uniform(2, math.log10(2 ** 33)))
+        items[f'item{i}'] = {
+            'name': f'Item {i}',
+            'cost': cost,
+            'boost': cost // rng.randint(150, 400),
+            'default_qty': rng.choice((0, 1, 1, 3, 5, 10)),
+        }
+
+    # Add cursed items
+    item_ids = list(items)
+    for item_id in rng.sample(item_ids, max(int(item_count * cursed_ratio),
+                                            1)):
+        item = items[item_id]
+        item['cursed'] = True
+        item['boost'] = -abs(item['boost'])
+
+    # Add merges, which only use items that aren't cursed.
+    ingredients = [i for i in item_ids if not items[i].get('cursed')]
+    for item_id in rng.sample(ingredients, int(item_count * merge_ratio)):
+        items[item_id]['merges'] = [
+            rng.sample(ingredients, rng.randint(2, 3))
+            for _ in range(rng.randint(1, 2))
+        ]
+
+    items['remove_curse'] = {
+        'name': 'Scroll of Remove Curse',
+        'cost': 300_000,
+        'boost': 2020,
+        'default_qty': 0,
+        'merges': [rng.sample(ingredients, 2)],
+    }
+    return items
+
+# Generates a users.json file with user_count users, who each have (on
+# average) items_per_user types of items.
+def generate_users(user_count: int, items: dict[str, Any], *,
+        items_per_user: int = 30, seed: int = 0) -> dict[str, Any]:
+    rng = random.Random(seed)
+    item_ids = list(items)
+    users: dict[str, Any] = {}
+    for i in range(user_count):
+        k = min(int(rng.expovariate(1 / items_per_user)), len(item_ids))
+        users[str(10 ** 17 + i)] = {
+            'balance': int(10 ** rng.uniform(3, 10)),
+            'inventory': {item_id: rng.randint(1, 20)
+                          for item_id in rng.sample(item_ids, k)},
+        }
+    return users
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directory')
+    parser.add_argument('--items', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--items-per-user', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    items = generate_items(args.items, seed=args.seed)
+    users = generate_users(args.users, items,
+                           items_per_user=args.items_per_user,
+                           seed=args.seed)
+    os.makedirs(args.directory, exist_ok=True)
+    with open(os.path.join(args.directory, 'items.json'), 'w') as f:
+        json.dump(items, f, indent=4)
+    with open(os.path.join(args.directory, 'users.json'), 'w') as f:
+        json.dump(users, f)
+
+if __name__ == '__main__':
+    main()
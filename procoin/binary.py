@@ -0,0 +1,249 @@
+# A binary format for users files
+#
+# Loading users.json means parsing every user up front, which takes most of
+# the startup time and memory. Binary users files are memory-mapped instead,
+# and each user is only decoded when it is accessed (which, with
+# UserInterface's lazy loading, means when the user is first used).
+#
+# The format (all integers are little-endian):
+#
+#   header: magic (8 bytes), version (u32), user count (u32),
+#           item table offset (u64), index offset (u64)
+#   records: one per user, see _encode_record()
+#   item table: item count (u32), then the item IDs joined by "\0" prefixed
+#               with their total length (u32)
+#   index: the user IDs joined by "\0" prefixed with their total length
+#          (u64), then the offset of each user's record (u64 each)
+#
+# Item IDs are interned in the item table, so records only store the position
+# of each item in the table.
+#
+# Usage: python3 -m procoin.binary {to-binary,to-json} <input> <output>
+
+from __future__ import annotations
+import argparse, json, mmap, struct, sys
+from array import array
+from collections.abc import Iterator, Mapping, MutableMapping
+from typing import Any, Union
+
+magic = b'PCUSERS\0'
+version = 1
+
+_header = struct.Struct('<8sIIQQ')
+_u32 = struct.Struct('<I')
+_u64 = struct.Struct('<Q')
+
+# A user in the users.json format.
+# This Union[] is a hack to keep Python 3.7 and 3.8 support.
+_RawUser = Union['dict[str, Any]']
+
+class FormatError(ValueError):
+    pass
+
+# Integers are stored as a length byte followed by that many bytes (in
+# two's complement), as balances can be larger than 64 bits.
+def _encode_int(n: int) -> bytes:
+    raw = n.to_bytes((n + (n < 0)).bit_length() // 8 + 1, 'little',
+                     signed=True)
+    return bytes((len(raw),)) + raw
+
+def _decode_int(buf: Any, pos: int) -> tuple[int, int]:
+    size = buf[pos]
+    end = pos + 1 + size
+    return int.from_bytes(buf[pos + 1:end], 'little', signed=True), end
+
+# A record is the balance, the number of items (u32) and then the position
+# of each item in the item table (u32) followed by its quantity.
+def _encode_record(data: _RawUser, item_table: dict[str, int]) -> bytes:
+    inventory = data['inventory']
+    parts = [_encode_int(data['balance']), _u32.pack(len(inventory))]
+    for item_id, qty in inventory.items():
+        item_pos = item_table.get(item_id)
+        if item_pos is None:
+            item_pos = item_table[item_id] = len(item_table)
+        parts.append(_u32.pack(item_pos))
+        parts.append(_encode_int(qty))
+    return b''.join(parts)
+
+# Converts users (in the users.json format) to the binary format.
+def dumps(users: Mapping[str, _RawUser]) -> bytes:
+    item_table: dict[str, int] = {}
+    records: list[bytes] = []
+    offsets = array('Q')
+    pos = _header.size
+    for data in users.values():
+        record = _encode_record(data, item_table)
+        records.append(record)
+        offsets.append(pos)
+        pos += len(record)
+
+    if any('\0' in user_id for user_id in users):
+        raise ValueError('User IDs cannot contain null bytes')
+    user_ids = '\0'.join(users).encode('utf-8')
+    item_ids = '\0'.join(item_table).encode('utf-8')
+    if sys.byteorder != 'little':
+        offsets.byteswap()
+
+    item_table_offset = pos
+    index_offset = item_table_offset + _u32.size * 2 + len(item_ids)
+    header = _header.pack(magic, version, len(users), item_table_offset,
+                          index_offset)
+    return b''.join((header, *records,
+                     _u32.pack(len(item_table)), _u32.pack(len(item_ids)),
+                     item_ids, _u64.pack(len(user_ids)), user_ids,
+                     offsets.tobytes()))
+
+# A read-only view of a binary users file, which decodes users when they are
+# accessed. buf can be a bytes object or an mmap.
+class _UsersFile:
+    __slots__ = ('buf', 'item_ids', 'user_count', 'index_offset')
+
+    def __init__(self, buf: Any) -> None:
+        if len(buf) < _header.size:
+            raise FormatError('File too short')
+        file_magic, file_version, user_count, item_table_offset, \
+            index_offset = _header.unpack_from(buf, 0)
+        if file_magic != magic:
+            raise FormatError('Not a binary users file')
+        if file_version != version:
+            raise FormatError(f'Unsupported version: {file_version}')
+        self.buf = buf
+        self.user_count: int = user_count
+        self.index_offset: int = index_offset
+
+        item_count, size = struct.unpack_from('<II', buf, item_table_offset)
+        start = item_table_offset + 8
+        self.item_ids: list[str] = \
+            bytes(buf[start:start + size]).decode('utf-8').split('\0') \
+            if item_count else []
+
+    # Returns a {user_id: offset} dict.
+    def read_index(self) -> dict[str, int]:
+        buf = self.buf
+        size, = _u64.unpack_from(buf, self.index_offset)
+        start = self.index_offset + _u64.size
+        user_ids = bytes(buf[start:start + size]).decode('utf-8').split('\0') \
+            if self.user_count else []
+        offsets = array('Q')
+        start += size
+        offsets.frombytes(buf[start:start + self.user_count * _u64.size])
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        return dict(zip(user_ids, offsets))
+
+    def decode(self, pos: int) -> _RawUser:
+        buf = self.buf
+        balance, pos = _decode_int(buf, pos)
+        count, = _u32.unpack_from(buf, pos)
+        pos += _u32.size
+        item_ids = self.item_ids
+        inventory: dict[str, int] = {}
+        for _ in range(count):
+            item_pos, = _u32.unpack_from(buf, pos)
+            qty, pos = _decode_int(buf, pos + _u32.size)
+            inventory[item_ids[item_pos]] = qty
+        return {'balance': balance, 'inventory': inventory}
+
+# The users in one or more binary users files. Users are decoded every time
+# they are accessed, and users that are set (or deleted) are stored in a
+# normal dict, so this can be used anywhere a users dict loaded from JSON is.
+class LazyUsers(MutableMapping):
+    __slots__ = ('_files', '_index', '_overlay')
+
+    # Each value in _index is the position of the record in the file shifted
+    # left by 8 bits, plus the position of the file in _files.
+    def __init__(self) -> None:
+        self._files: list[_UsersFile] = []
+        self._index: dict[str, int] = {}
+        self._overlay: dict[str, _RawUser] = {}
+
+    @classmethod
+    def from_buffer(cls, buf: Any) -> LazyUsers:
+        self = cls()
+        self._add_file(buf)
+        return self
+
+    def _add_file(self, buf: Any) -> None:
+        file_no = len(self._files)
+        if file_no >= 256:
+            raise ValueError('Too many files')
+        users_file = _UsersFile(buf)
+        index = users_file.read_index()
+        self._files.append(users_file)
+        self._index.update((user_id, offset << 8 | file_no)
+                           for user_id, offset in index.items())
+
+    # Adds the users from another LazyUsers object (or any other mapping).
+    # Users that exist in both are replaced.
+    def merge(self, other: Mapping[str, _RawUser]) -> None:
+        if not isinstance(other, LazyUsers):
+            self.update(other)
+            return
+
+        shift = len(self._files)
+        if shift + len(other._files) > 256:
+            raise ValueError('Too many files')
+        self._files.extend(other._files)
+        for user_id in other._index:
+            self._overlay.pop(user_id, None)
+        self._index.update((user_id, value + shift)
+                           for user_id, value in other._index.items())
+        for user_id, data in other._overlay.items():
+            self[user_id] = data
+
+    def __getitem__(self, user_id: str) -> _RawUser:
+        data = self._overlay.get(user_id)
+        if data is not None:
+            return data
+        value = self._index[user_id]
+        return self._files[value & 0xff].decode(value >> 8)
+
+    def __setitem__(self, user_id: str, data: _RawUser) -> None:
+        self._index.pop(user_id, None)
+        self._overlay[user_id] = data
+
+    def __delitem__(self, user_id: str) -> None:
+        if self._index.pop(user_id, None) is None:
+            del self._overlay[user_id]
+
+    def __contains__(self, user_id: object) -> bool:
+        return user_id in self._index or user_id in self._overlay
+
+    def __iter__(self) -> Iterator[str]:
+        yield from self._index
+        yield from self._overlay
+
+    def __len__(self) -> int:
+        return len(self._index) + len(self._overlay)
+
+# Returns True if the data starts with the binary format's magic number.
+def is_binary(header: bytes) -> bool:
+    return header.startswith(magic)
+
+def load(filename: str, use_mmap: bool = True) -> LazyUsers:
+    with open(filename, 'rb') as f:
+        if use_mmap:
+            buf: Any = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            buf = f.read()
+    return LazyUsers.from_buffer(buf)
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('direction', choices=('to-binary', 'to-json'))
+    parser.add_argument('input')
+    parser.add_argument('output')
+    args = parser.parse_args()
+
+    if args.direction == 'to-binary':
+        with open(args.input, 'r') as f:
+            raw = dumps(json.load(f))
+        with open(args.output, 'wb') as f:
+            f.write(raw)
+    else:
+        users = load(args.input)
+        with open(args.output, 'w') as f:
+            json.dump(dict(users.items()), f)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+# Columnar snapshots of users for offline analysis and bulk jobs
+#
+# A snapshot stores every user's balance as one vector and the inventories as
+# a CSR (compressed sparse row) users × items matrix of quantities, where the
+# columns are item indexes (see ItemInterface.by_index). Snapshots are saved
+# as a directory of .npy files that can be loaded memory-mapped, so looking at
+# millions of users doesn't require creating User objects (or even reading
+# the whole snapshot into memory).
+#
+# This requires NumPy, which the bot itself doesn't need.
+#
+# Usage: python3 -m procoin.columnar <items.json> <users.json> <directory>
+
+from __future__ import annotations
+import argparse, os
+from collections.abc import Sequence
+from typing import Any, Optional
+import numpy as np # type: ignore
+from . import db
+from .items import ItemInterface
+from .storage import JSONStorage
+from .store import Store
+from .users import UserInterface
+
+# The arrays in a snapshot. Every one of these is saved as "<name>.npy".
+_arrays = ('user_ids', 'balances', 'indptr', 'indices', 'quantities',
+           'item_ids', 'item_boosts', 'item_costs')
+
+_int64_max = 2 ** 63 - 1
+
+class Snapshot:
+    __slots__ = _arrays
+
+    # Row i of the matrix (user_ids[i]'s inventory) is stored in
+    # indices[indptr[i]:indptr[i + 1]] (item indexes, in ascending order) and
+    # quantities[indptr[i]:indptr[i + 1]]. The item catalog is saved with the
+    # snapshot so it can be used without items.json.
+    def __init__(self, user_ids: Any, balances: Any, indptr: Any,
+            indices: Any, quantities: Any, item_ids: Any, item_boosts: Any,
+            item_costs: Any) -> None:
+        self.user_ids = user_ids
+        self.balances = balances
+        self.indptr = indptr
+        self.indices = indices
+        self.quantities = quantities
+        self.item_ids = item_ids
+        self.item_boosts = item_boosts
+        self.item_costs = item_costs
+
+    def __len__(self) -> int:
+        return len(self.balances)
+
+    # Creates a snapshot of every user. Balances, quantities and the item
+    # boosts and costs are stored as 64-bit integers, unless one of them
+    # doesn't fit (see _int_array).
+    @classmethod
+    def from_users(cls, users: UserInterface) -> Snapshot:
+        user_ids: list[str] = []
+        balances: list[int] = []
+        indptr: list[int] = [0]
+        indices: list[Sequence[int]] = []
+        quantities: list[Sequence[int]] = []
+        for user_id, balance, idx, qty in users.index_records():
+            user_ids.append(user_id)
+            balances.append(balance)
+            indptr.append(indptr[-1] + len(idx))
+            indices.append(idx)
+            quantities.append(qty)
+
+        ii: ItemInterface = users.store.items
+        return cls(
+            np.array(user_ids, dtype=str),
+            _int_array(balances),
+            np.array(indptr, dtype=np.int64),
+            _concatenate(indices, np.int32),
+            _concatenate(quantities, np.int64),
+            np.array([item.id for item in ii.by_index], dtype=str),
+            _int_array([item.boost for item in ii.by_index]),
+            _int_array([item.cost for item in ii.by_index]),
+        )
+
+    def save(self, dirname: str) -> None:
+        os.makedirs(dirname, exist_ok=True)
+        for name in _arrays:
+            np.save(os.path.join(dirname, name + '.npy'), getattr(self, name))
+
+    # Loads a snapshot saved with save(). If mmap is True, the arrays are
+    # memory-mapped (read-only) instead of being read into memory.
+    @classmethod
+    def load(cls, dirname: str, mmap: bool = True) -> Snapshot:
+        return cls(*(_load(os.path.join(dirname, name + '.npy'), mmap)
+                     for name in _arrays))
+
+    # Multiplies the quantity matrix by a vector with a value for every item,
+    # giving a vector with the total for every user. This uses integers so
+    # that the results are exact, Python integers are used if the totals
+    # might not fit in 64 bits.
+    def matvec(self, values: Any) -> Any:
+        quantities = self.quantities
+        values = _int_array(values)
+        dtype: Any = np.int64
+        if _max_abs(quantities) * _max_abs(values) * len(quantities) > \
+                _int64_max:
+            dtype = object
+            quantities = quantities.astype(object)
+            values = values.astype(object)
+        products = quantities * values[self.indices]
+        totals = np.concatenate((np.zeros(1, dtype=dtype),
+                                 np.cumsum(products, dtype=dtype)))
+        return totals[self.indptr[1:]] - totals[self.indptr[:-1]]
+
+    # Every user's boost (see User.recalc_boost), using the item boosts from
+    # the snapshot unless item_boosts is specified.
+    def boosts(self, item_boosts: Optional[Any] = None) -> Any:
+        if item_boosts is None:
+            item_boosts = self.item_boosts
+        return self.matvec(item_boosts) + 1
+
+    # Every user's net worth (see User.net_worth).
+    def net_worths(self, item_costs: Optional[Any] = None) -> Any:
+        if item_costs is None:
+            item_costs = self.item_costs
+        balances = self.balances
+        totals = self.matvec(item_costs)
+        if _max_abs(balances) + _max_abs(totals) > _int64_max:
+            return balances.astype(object) + totals.astype(object)
+        return balances + totals
+
+    # The total amount of each item users have (indexed by item index).
+    def item_counts(self) -> Any:
+        quantities = self.quantities
+        dtype: Any = np.int64
+        if _max_abs(quantities) * len(quantities) > _int64_max:
+            dtype = object
+            quantities = quantities.astype(object)
+        counts = np.zeros(len(self.item_ids), dtype=dtype)
+        np.add.at(counts, self.indices, quantities)
+        return counts
+
+# Balances and quantities can be too big for 64-bit integers (see
+# procoin.users._make_quantities), in which case the array holds Python
+# integers instead. These are a lot slower and can't be memory-mapped.
+def _int_array(values: Any) -> Any:
+    try:
+        return np.asarray(values, dtype=np.int64)
+    except OverflowError:
+        return np.array(values, dtype=object)
+
+def _concatenate(arrays: list[Sequence[int]], dtype: Any) -> Any:
+    if not arrays:
+        return np.zeros(0, dtype=dtype)
+    try:
+        return np.concatenate([np.asarray(a, dtype=dtype) for a in arrays])
+    except OverflowError:
+        return np.concatenate([np.array(a, dtype=object) for a in arrays])
+
+# The largest absolute value in an array (as a Python integer).
+def _max_abs(array: Any) -> int:
+    if not len(array):
+        return 0
+    return max(abs(int(array.max())), abs(int(array.min())))
+
+def _load(filename: str, mmap: bool) -> Any:
+    try:
+        return np.load(filename, mmap_mode='r' if mmap else None)
+    except ValueError:
+        # Arrays of Python integers (see _int_array) are pickled.
+        return np.load(filename, allow_pickle=True)
+
+# The Gini coefficient of some values (0 means everyone has the same amount
+# and 1 means one user has everything). Negative values are treated as 0.
+def gini(values: Any) -> float:
+    v = np.sort(np.maximum(np.asarray(values, dtype=np.float64), 0))
+    n = len(v)
+    if n == 0 or not v[-1]:
+        return 0.0
+    ranks = np.arange(1, n + 1)
+    return float((2 * ranks - n - 1).dot(v) / (n * v.sum()))
+
+def percentiles(values: Any, q: Sequence[float] = (10, 25, 50, 75, 90, 99)) \
+        -> dict[float, float]:
+    if len(values) == 0:
+        return {}
+    values = np.asarray(values, dtype=np.float64)
+    return dict(zip(q, np.percentile(values, q).tolist()))
+
+# Returns (counts, bin edges) for a histogram of values. If log is True, the
+# bins are spaced logarithmically (which suits balances) and values below 1
+# are counted in the first bin.
+def histogram(values: Any, bins: int = 20, log: bool = False) \
+        -> tuple[Any, Any]:
+    values = np.asarray(values, dtype=np.float64)
+    if log and len(values):
+        high = max(float(values.max()), 1.0)
+        edges = np.logspace(0, np.log10(high) if high > 1 else 1, bins + 1)
+        edges[0] = min(float(values.min()), 0.0)
+        return np.histogram(values, bins=edges)
+    return np.histogram(values, bins=bins)
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('items', help='The items.json file.')
+    parser.add_argument('users', help='The users.json file (the shard '
+                        'directory and journal are used if they exist).')
+    parser.add_argument('directory', help='Where to save the snapshot.')
+    args = parser.parse_args()
+
+    # Load the users without opening the journal, so this can be run while
+    # the bot is running.
+    ii = ItemInterface.from_dict(db.load(args.items))
+    data, _ = JSONStorage(args.users).load_raw()
+    users = UserInterface.from_dict(Store(ii), data, lazy=True)
+    Snapshot.from_users(users).save(args.directory)
+
+    snapshot = Snapshot.load(args.directory)
+    net_worths = snapshot.net_worths()
+    print(f'Users: {len(snapshot):,}')
+    print(f'Total boost: {int(snapshot.boosts().sum()):,}')
+    print(f'Balance Gini coefficient: {gini(snapshot.balances):.3f}')
+    print(f'Net worth Gini coefficient: {gini(net_worths):.3f}')
+    for q, value in percentiles(net_worths).items():
+        print(f'Net worth p{q:g}: {value:,.0f}')
+
+if __name__ == '__main__':
+    main()
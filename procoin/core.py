@@ -1,7 +1,10 @@
 from __future__ import annotations
-from . import db, items, merges, store, users
+from . import db, items, merges, storage, store, users
 from .items import Item as _Item
+from .snapshots import SnapshotManager as _SnapshotManager
+from .storage import Storage as _Storage, open_storage as _open_storage
 from .store import CannotAffordError, Error, ItemNotFoundError
+from concurrent.futures import Future
 from typing import Optional, Union
 import random
 
@@ -10,10 +13,18 @@ class ProCoin:
     store: store.Store
     users: users.UserInterface
     merges: merges.MergeInterface
+    storage: storage.Storage
 
-    def __init__(self, item_filename: str, user_filename: str) -> None:
+    # If storage isn't specified, a storage backend is picked based on the
+    # extension of user_filename. Snapshots are only taken if snapshots is
+    # specified.
+    def __init__(self, item_filename: str, user_filename: str,
+            storage: Optional[_Storage] = None,
+            snapshots: Optional[_SnapshotManager] = None) -> None:
         self.item_filename = item_filename
         self.user_filename = user_filename
+        self.storage = storage or _open_storage(user_filename)
+        self.snapshots = snapshots
         self.load_all()
 
     def load_all(self) -> None:
@@ -27,20 +38,49 @@ class ProCoin:
     def _load_item_file(self) -> None:
         self.items = items.ItemInterface.from_dict(db.load(self.item_filename))
 
-    # Loads the users file from the disk. This should probably modify
+    # Reloads the item file and updates the catalog in place, so the users
+    # don't have to be reloaded. Only users with changed or removed items are
+    # updated. Returns the changes that were made.
+    def reload_items(self) -> items.CatalogChanges:
+        new_items = items.ItemInterface.from_dict(db.load(self.item_filename))
+
+        # Make sure the merges are valid before modifying anything.
+        merges.MergeInterface(new_items)
+
+        changes = self.items.update_from(new_items)
+        if changes:
+            self.users.apply_catalog_changes(changes)
+            self.store.update_items()
+            self.merges.update_merges()
+        return changes
+
+    # Loads the users from the storage backend. This should probably modify
     # ProCoin.users directly.
     def _load_user_file(self) -> None:
-        data = db.load(self.user_filename)
-        self.users = users.UserInterface.from_dict(self.store, data)
+        self.users = self.storage.load_users(self.store)
 
-    # Saves the users file to the disk. The actual save operation is now done
-    # in another thread.
-    def save_user_file(self) -> None:
-        db.save(self.user_filename, self.users.to_dict())
+    # Saves any modified users to the disk. With the JSON backend, the actual
+    # save operation is done in another thread. Returns a Future that is
+    # resolved once the users have been saved.
+    def save_user_file(self) -> Future[None]:
+        return self.storage.save(self.users)
 
     # Saves the users file in the current thread.
     def save_user_file_blocking(self) -> None:
-        db.save_blocking(self.user_filename, self.users.to_dict())
+        self.storage.save_blocking(self.users)
+
+    # Takes a snapshot of the users (see procoin.snapshots) if snapshots are
+    # enabled. The snapshot is written in another thread, and the returned
+    # Future is resolved once it has been written.
+    def take_snapshot(self) -> Future[None]:
+        if self.snapshots is None:
+            return db.completed_future()
+        return self.snapshots.take(self.users, self.items)
+
+    # Closes the storage backend, save_user_file_blocking() should be called
+    # first.
+    def close(self) -> None:
+        self.storage.close()
 
     # Buys an item from the store. Returns the total cost.
     def buy(self, user_id: Union[str, int], item_string: str, qty: int) -> int:
@@ -49,7 +89,8 @@ class ProCoin:
             raise ItemNotFoundError(item_string)
 
         user = self.users.get_or_create(user_id)
-        user.buy_item(item, qty)
+        with self.users.transaction(user):
+            user.buy_item(item, qty)
         return item.cost * qty
 
     # Sells an item to the store. Returns the total cost.
@@ -60,7 +101,8 @@ class ProCoin:
             raise ItemNotFoundError(item_string)
 
         user = self.users.get_or_create(user_id)
-        sale_price: int = user.sell_item(item, qty)
+        with self.users.transaction(user):
+            sale_price: int = user.sell_item(item, qty)
         return sale_price
 
     def give_item(self, user_id: Union[str, int], target_uid: Union[str, int],
@@ -81,19 +123,32 @@ class ProCoin:
 
         # User.take_item() will raise an error if the user doesn't have enough
         # items.
-        user.take_item(item, qty)
-        target_user.add_item(item, qty)
+        with self.users.transaction(user, target_user):
+            user.take_item(item, qty)
+            target_user.add_item(item, qty)
 
-    # Adds money to a user.
+    # Gives a user an item (for example as a prize).
+    def add_item(self, user_id: Union[str, int], item: _Item, qty: int) \
+            -> None:
+        user = self.users.get_or_create(user_id)
+        with self.users.transaction(user):
+            user.add_item(item, qty)
+
+    # Adds money to a user. Unlike pay(), these functions don't use a
+    # transaction.
     def add_cash(self, user_id: Union[str, int], amount: int) -> None:
         assert amount >= 0
-        user = self.users.users[str(user_id)]
+        user = self.users.find_by_id(user_id)
+        if not user:
+            raise KeyError(user_id)
         user.balance += amount
 
     # Removes money from a user.
     def remove_cash(self, user_id: Union[str, int], amount: int) -> None:
         assert amount >= 0
-        user = self.users.users[str(user_id)]
+        user = self.users.find_by_id(user_id)
+        if not user:
+            raise KeyError(user_id)
         if amount > user.balance:
             raise CannotAffordError
         user.balance -= amount
@@ -112,11 +167,14 @@ class ProCoin:
             raise Error("I mean, you could pay yourself, but it'd do "
                         "absolutely nothing.")
 
-        try:
+        source_user = self.users.find_by_id(source_uid)
+        target_user = self.users.find_by_id(target_uid)
+        if not source_user or not target_user:
+            raise Error('Unknown user!')
+
+        with self.users.transaction(source_user, target_user):
             self.remove_cash(source_uid, amount)
             self.add_cash(target_uid, amount)
-        except KeyError as exc:
-            raise Error('Unknown user!') from exc
 
     # Merges items and returns the item names and resulting item.
     def merge(self, user_id: Union[str, int], item_strings: list[str],
@@ -129,7 +187,33 @@ class ProCoin:
             item_list.append(item)
 
         user = self.users.get_or_create(user_id)
-        return self.merges.merge_item(user, item_list, amount)
+        with self.users.transaction(user):
+            return self.merges.merge_item(user, item_list, amount)
+
+    # Returns every merge a user can currently do (see
+    # MergeInterface.get_possible_merges).
+    def possible_merges(self, user_id: Union[str, int]) \
+            -> list[tuple[tuple[_Item, ...], _Item, int]]:
+        user = self.users.find_by_id(user_id)
+        if not user:
+            return []
+        return self.merges.get_possible_merges(user)
+
+    # Returns the target item and a list of merges that will make amount of
+    # it, or None as the list if the user can't make it.
+    def plan_merges(self, user_id: Union[str, int], item_string: str,
+            amount: int = 1) \
+            -> tuple[_Item, Optional[list[merges.MergeStep]]]:
+        if amount < 1:
+            raise Error('You... uhh... merge nothing to make '
+                        '`absolutely nothing`!')
+        target = self.items.lookup(item_string)
+        if not target:
+            raise ItemNotFoundError(item_string)
+        user = self.users.find_by_id(user_id)
+        if not user:
+            return target, None
+        return target, self.merges.plan_merges(user, target, amount)
 
     # Uses a scroll of remove curse a user has to remove a cursed item. Will
     # return the item removed and (optionally) the random removed item.
@@ -141,8 +225,7 @@ class ProCoin:
 
         cursed_items = []
         not_cursed = []
-        for item_id in user.inventory:
-            item: _Item = self.items.get_item(item_id)
+        for item, _ in user.iter_items():
             if item.cursed:
                 cursed_items.append(item)
             else:
@@ -153,23 +236,62 @@ class ProCoin:
                 'do not have a cursed item!')
         cursed_item = random.choice(cursed_items)
 
-        # Take a random item sometimes
-        removed_item: Optional[_Item] = None
-        if (user.balance > 1_500_000_000 or random.randrange(3) == 0) and \
-                not_cursed:
-            removed_item = random.choice(not_cursed)
-            user.take_item(removed_item, 1)
+        with self.users.transaction(user):
+            # Take a random item sometimes
+            removed_item: Optional[_Item] = None
+            if (user.balance > 1_500_000_000 or random.randrange(3) == 0) \
+                    and not_cursed:
+                removed_item = random.choice(not_cursed)
+                user.take_item(removed_item, 1)
 
-        # Actually remove the curse
-        user.take_item(scroll, 1)
-        try:
+            # Actually remove the curse
+            user.take_item(scroll, 1)
             user.take_item(cursed_item, 1, ignore_cursed=True)
-        except:
-            user.add_item(scroll, 1)
-            raise
 
         return cursed_item, removed_item
 
+    # Returns the top n users on a leaderboard (see
+    # users.leaderboard_scores) as a list of (user_id, score) tuples.
+    def leaderboard(self, kind: str, n: int) -> list[tuple[str, int]]:
+        return self.users.get_leaderboard(kind).top(n)
+
+    # Returns a user's rank, their score and the total amount of users on a
+    # leaderboard, or None if the user doesn't exist.
+    def rank(self, kind: str, user_id: Union[str, int]) \
+            -> Optional[tuple[int, int, int]]:
+        leaderboard = self.users.get_leaderboard(kind)
+        user_id = str(user_id)
+        rank = leaderboard.rank(user_id)
+        score = leaderboard.get_score(user_id)
+        if rank is None or score is None:
+            return None
+        return rank, score, len(leaderboard)
+
+    # Returns the economy stats (see procoin.stats) and store turnover as a
+    # dict. The first call has to scan every user, after that this is O(1).
+    def economy_stats(self) -> dict[str, int]:
+        stats = self.users.get_stats()
+        return {
+            'users': stats.users,
+            'money_supply': stats.money_supply,
+            'total_boost': stats.total_boost,
+            'item_value': stats.item_value,
+            'items_in_circulation': stats.items_in_circulation,
+            'distinct_items': len(stats.item_counts),
+            'boost_payouts': stats.boost_payouts,
+            'boost_paid': stats.boost_paid,
+            'store_bought': self.store.bought,
+            'store_bought_value': self.store.bought_value,
+            'store_sold': self.store.sold,
+            'store_sold_value': self.store.sold_value,
+        }
+
+    # Returns the n items that users have the most of, as (item, count)
+    # tuples.
+    def top_items(self, n: int) -> list[tuple[_Item, int]]:
+        return [(self.items.get_item(item_id), count) for item_id, count
+                in self.users.get_stats().top_items(n)]
+
     # Shows the store(?)
     # I think this does what it is meant to.
     def show_store(self) -> str:
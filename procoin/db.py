@@ -1,37 +1,446 @@
 # ProCoin database methods
 
 from __future__ import annotations
-import json, os, tempfile, threading
-from typing import Any
+import abc, atexit, glob, json, os, tempfile, threading, time, traceback
+from collections.abc import Callable, Iterable, Mapping, MutableMapping
+from concurrent.futures import Future
+from typing import Any, Optional, Union
+from . import binary, metrics
 
 _lock = threading.Lock()
 
+# Codecs convert users files (or shard files) to and from bytes. The codec
+# used to load a file is detected from the start of the file, so files saved
+# with any registered codec can be loaded.
+class Codec(abc.ABC):
+    __slots__ = ()
+    name: str = ''
+    extension: str = ''
+
+    # Returns True if a file starting with header was saved with this codec.
+    def detect(self, header: bytes) -> bool:
+        return False
+
+    @abc.abstractmethod
+    def loads(self, raw: bytes) -> MutableMapping[str, Any]:
+        pass
+
+    # data may be any mapping (such as a users.UsersCopy).
+    @abc.abstractmethod
+    def dumps(self, data: Mapping[str, Any]) -> bytes:
+        pass
+
+    def load(self, filename: str) -> MutableMapping[str, Any]:
+        with open(filename, 'rb') as f:
+            return self.loads(f.read())
+
+class JSONCodec(Codec):
+    __slots__ = ()
+    name = 'json'
+    extension = '.json'
+
+    def loads(self, raw: bytes) -> MutableMapping[str, Any]:
+        return json.loads(raw)
+
+    def dumps(self, data: Mapping[str, Any]) -> bytes:
+        if not isinstance(data, dict):
+            data = dict(data)
+        return json.dumps(data).encode('utf-8')
+
+# Users are memory-mapped and only decoded when they are accessed, see
+# procoin.binary.
+class BinaryCodec(Codec):
+    __slots__ = ()
+    name = 'binary'
+    extension = '.bin'
+
+    def detect(self, header: bytes) -> bool:
+        return binary.is_binary(header)
+
+    def loads(self, raw: bytes) -> MutableMapping[str, Any]:
+        return binary.LazyUsers.from_buffer(raw)
+
+    def load(self, filename: str) -> MutableMapping[str, Any]:
+        return binary.load(filename)
+
+    def dumps(self, data: Mapping[str, Any]) -> bytes:
+        return binary.dumps(data)
+
+codecs: dict[str, Codec] = {}
+
+def register_codec(codec: Codec) -> None:
+    codecs[codec.name] = codec
+
+register_codec(JSONCodec())
+register_codec(BinaryCodec())
+
+def _get_codec(codec: Union[str, Codec]) -> Codec:
+    return codecs[codec] if isinstance(codec, str) else codec
+
+# Files that no codec detects are assumed to be JSON.
+def detect_codec(filename: str) -> Codec:
+    with open(filename, 'rb') as f:
+        header = f.read(16)
+    for codec in codecs.values():
+        if codec.detect(header):
+            return codec
+    return codecs['json']
+
 # Load JSON data from a file.
-# WARNING: This acquires the database lock! This can and will block the main
-# thread, however shouldn't be an issue as load() is only called once per file.
+# WARNING: This acquires the database lock and waits for any pending saves to
+# the file! This can and will block the main thread, however shouldn't be an
+# issue as load() is only called once per file.
 def load(filename: str) -> dict[Any, Any]:
+    flush(filename)
     try:
         with _lock, open(filename, 'r') as f:
             return json.load(f)
     except FileNotFoundError:
         return {}
 
-# Save JSON data to a file in another thread. This stops the file operation
-# from blocking.
-def _raw_save(filename: str, raw: str) -> None:
+# Loads a users file saved with any codec. Binary files return a
+# binary.LazyUsers object instead of a dict.
+def load_users(filename: str) -> MutableMapping[str, Any]:
+    flush(filename)
+    try:
+        with _lock:
+            return detect_codec(filename).load(filename)
+    except FileNotFoundError:
+        return {}
+
+# Loads every shard file in a directory and merges them into one dict (or,
+# if any shards are binary, a binary.LazyUsers object).
+def load_shards(dirname: str) -> MutableMapping[str, Any]:
+    flush(dirname)
+    shards: list[MutableMapping[str, Any]] = []
     with _lock:
-        # Atomic save
-        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(filename),
-                delete=False) as f:
-            f.write(raw)
-            tmpfn = f.name
-        os.replace(tmpfn, filename)
+        for fn in sorted(_shard_files(dirname)):
+            shards.append(detect_codec(fn).load(fn))
+
+    if all(isinstance(shard, dict) for shard in shards):
+        res: dict[str, Any] = {}
+        for shard in shards:
+            res.update(shard)
+        return res
+
+    lazy_res = binary.LazyUsers()
+    for shard in shards:
+        lazy_res.merge(shard)
+    return lazy_res
+
+def _shard_files(dirname: str) -> Iterable[str]:
+    extensions = {codec.extension for codec in codecs.values()}
+    for fn in glob.glob(os.path.join(glob.escape(dirname), '*')):
+        if os.path.splitext(fn)[1] in extensions:
+            yield fn
+
+def _shard_filename(dirname: str, shard: int, codec: Codec) -> str:
+    return os.path.join(dirname, f'{shard}{codec.extension}')
+
+# Atomically replaces a file. _lock should be held when calling this.
+def _replace_file(filename: str, raw: bytes) -> None:
+    dirname = os.path.dirname(filename)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with tempfile.NamedTemporaryFile('wb', dir=dirname, delete=False) as f:
+        f.write(raw)
+        tmpfn = f.name
+    os.replace(tmpfn, filename)
+
+# A pending save. files is in the format {filename: (codec, data)}, where a
+# codec of None means that the file should be deleted. If the save fails,
+# errbacks are called with the exception instead of callbacks.
+class _Job:
+    __slots__ = ('files', 'callbacks', 'errbacks', 'future')
+    def __init__(self, files: dict[str, Any]) -> None:
+        self.files = files
+        self.callbacks: list[Callable[[], None]] = []
+        self.errbacks: list[Callable[[BaseException], None]] = []
+        self.future: Future[None] = Future()
+
+    def add_callbacks(self, callback: Optional[Callable[[], None]],
+            errback: Optional[Callable[[BaseException], None]]) -> None:
+        if callback is not None:
+            self.callbacks.append(callback)
+        if errback is not None:
+            self.errbacks.append(errback)
+
+# A single long-lived thread that serialises and writes data. If a save is
+# submitted while an older save to the same file (or directory) hasn't been
+# started yet, the two are merged and only the newer data is written, so there
+# is at most one pending save per file.
+class _Writer:
+    __slots__ = ('_cond', '_pending', '_current', '_thread')
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._pending: dict[str, _Job] = {}
+
+        # The key of the save that is being written.
+        self._current: Optional[str] = None
+        self._thread: Optional[threading.Thread] = None
+
+    # Queues data to be saved and returns a Future that is resolved once the
+    # data has been written. The data must not be modified afterwards.
+    def submit(self, key: str, files: dict[str, Any],
+            callback: Optional[Callable[[], None]] = None,
+            errback: Optional[Callable[[BaseException], None]] = None) \
+            -> Future[None]:
+        with self._cond:
+            job = self._pending.get(key)
+            if job is None:
+                job = self._pending[key] = _Job(files)
+            else:
+                job.files.update(files)
+            job.add_callbacks(callback, errback)
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                    name='procoin.db writer', daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+            return job.future
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                key = next(iter(self._pending))
+                job = self._pending.pop(key)
+                self._current = key
+
+            start = time.perf_counter()
+            try:
+                raw = {fn: None if codec is None else codec.dumps(data)
+                       for fn, (codec, data) in job.files.items()}
+                with _lock:
+                    for fn, data in raw.items():
+                        if data is not None:
+                            _replace_file(fn, data)
+                        elif os.path.exists(fn):
+                            os.remove(fn)
+                    for callback in job.callbacks:
+                        callback()
+            except BaseException as exc:
+                traceback.print_exc()
+                metrics.registry.save_failed()
+                for errback in job.errbacks:
+                    try:
+                        errback(exc)
+                    except BaseException:
+                        traceback.print_exc()
+                job.future.set_exception(exc)
+            else:
+                metrics.registry.observe_save(
+                    time.perf_counter() - start,
+                    sum(len(data) for data in raw.values() if data))
+                job.future.set_result(None)
+
+            with self._cond:
+                self._current = None
+                self._cond.notify_all()
+
+    # Blocks until every pending save has been written. If key is specified,
+    # only saves to that file (or shard directory) are waited for.
+    def flush(self, key: Optional[str] = None) -> None:
+        with self._cond:
+            if key is None:
+                while self._pending or self._current is not None:
+                    self._cond.wait()
+            else:
+                while key in self._pending or self._current == key:
+                    self._cond.wait()
+
+_writer = _Writer()
+
+# Blocks until every pending save has been written. If key is specified, only
+# saves to that file (or shard directory) are waited for.
+def flush(key: Optional[str] = None) -> None:
+    _writer.flush(key)
+
+# Wait for any pending saves when exiting, as the writer is a daemon thread.
+atexit.register(_writer.flush)
+
+# Saves data to a file in the writer thread. This stops the file operation
+# from blocking. If callback is specified, it is called (in the writer
+# thread) once the file has been replaced, if the save fails errback is
+# called (also in the writer thread) with the exception instead. The returned
+# Future can be passed to asyncio.wrap_future() to wait for the save to
+# complete. Only users files can be saved with codecs other than JSON. codec
+# can also be a Codec object that isn't registered.
+def save(filename: str, data: Mapping[str, Any],
+        callback: Optional[Callable[[], None]] = None, *,
+        codec: Union[str, Codec] = 'json',
+        errback: Optional[Callable[[BaseException], None]] = None) \
+        -> Future[None]:
+    return _writer.submit(filename, {filename: (_get_codec(codec), data)},
+                          callback, errback)
 
 # A blocking save() function
-def save_blocking(filename: str, data: dict[str, Any]) -> None:
-    _raw_save(filename, json.dumps(data))
+def save_blocking(filename: str, data: Mapping[str, Any],
+        callback: Optional[Callable[[], None]] = None, *,
+        codec: Union[str, Codec] = 'json',
+        errback: Optional[Callable[[BaseException], None]] = None) -> None:
+    save(filename, data, callback, codec=codec, errback=errback).result()
+
+# Saves shards (in the format {shard: data}) to a directory. Each shard file
+# is replaced atomically, and shards that aren't specified are left alone.
+# Copies of the shards saved with other codecs are deleted.
+def save_shards(dirname: str, shards: Mapping[int, Mapping[str, Any]],
+        callback: Optional[Callable[[], None]] = None, *,
+        codec: str = 'json',
+        errback: Optional[Callable[[BaseException], None]] = None) \
+        -> Future[None]:
+    shard_codec = codecs[codec]
+    files: dict[str, tuple[Optional[Codec], Any]] = {}
+    for shard, data in shards.items():
+        for other in codecs.values():
+            if other.extension != shard_codec.extension:
+                files[_shard_filename(dirname, shard, other)] = (None, None)
+        files[_shard_filename(dirname, shard, shard_codec)] = \
+            (shard_codec, data)
+    return _writer.submit(dirname, files, callback, errback)
+
+def save_shards_blocking(dirname: str,
+        shards: Mapping[int, Mapping[str, Any]],
+        callback: Optional[Callable[[], None]] = None, *,
+        codec: str = 'json',
+        errback: Optional[Callable[[BaseException], None]] = None) -> None:
+    save_shards(dirname, shards, callback, codec=codec,
+                errback=errback).result()
+
+# Returns a Future that has already completed, for storage backends that
+# save synchronously.
+def completed_future() -> Future[None]:
+    future: Future[None] = Future()
+    future.set_result(None)
+    return future
+
+
+# An append-only journal of user changes, so that changes made since the last
+# save aren't lost if the bot crashes. Each line is a JSON list in the format
+# [user_id, balance, {item_id: qty, ...}], where a quantity of 0 means that
+# the user no longer has that item. Records store the new values (rather than
+# deltas) so replaying a record more than once is harmless.
+#
+# When a snapshot of the users file is about to be written, rotate() moves the
+# current journal to "<filename>.<generation>". Once the snapshot is on the
+# disk, discard() deletes every generation it contains. If a save fails,
+# retain() stops the generations that may contain the unsaved changes from
+# being discarded until release() is called.
+class Journal:
+    __slots__ = ('filename', 'generation', '_file', '_lock', '_retain_from')
+
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self._lock = threading.Lock()
+        self.generation: int = max(_journal_generations(filename),
+                                   default=0) + 1
+        self._file = open(filename, 'a')
+        self._retain_from: Optional[int] = None
+
+    # Appends a record to the journal. The write is flushed so it survives
+    # the bot crashing, however it isn't fsync()ed as that would be far too
+    # slow to do for every trade. The lock stops records from being written
+    # to a file that rotate() has just closed.
+    def append(self, user_id: str, balance: int,
+            inventory: dict[str, int]) -> None:
+        record = json.dumps([user_id, balance, inventory],
+                            separators=(',', ':')) + '\n'
+        with self._lock:
+            self._file.write(record)
+            self._file.flush()
+
+    # Starts a new journal file and returns the last generation that should be
+    # discarded once a snapshot made now has been saved.
+    def rotate(self) -> int:
+        with self._lock:
+            self._file.close()
+            generation = self.generation
+            if os.path.getsize(self.filename):
+                os.replace(self.filename, f'{self.filename}.{generation}')
+                self.generation += 1
+            else:
+                generation -= 1
+            self._file = open(self.filename, 'a')
+        return generation
+
+    # Deletes rotated journal files up to and including generation, unless
+    # they are being retained. Newer generations are always kept, as
+    # replaying an older generation on its own could revert users to older
+    # values. This may be called from another thread.
+    def discard(self, generation: int) -> None:
+        with self._lock:
+            if self._retain_from is not None:
+                generation = min(generation, self._retain_from - 1)
+            for gen in _journal_generations(self.filename):
+                if gen <= generation:
+                    os.remove(f'{self.filename}.{gen}')
+
+    # Keeps every generation that hasn't been discarded yet (including the
+    # current one) until release() is called. This may be called from
+    # another thread.
+    def retain(self) -> None:
+        with self._lock:
+            if self._retain_from is None:
+                self._retain_from = min(_journal_generations(self.filename),
+                                        default=self.generation)
+
+    def release(self) -> None:
+        with self._lock:
+            self._retain_from = None
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+# Returns the generations of any rotated journal files.
+def _journal_generations(filename: str) -> Iterable[int]:
+    for fn in glob.glob(glob.escape(filename) + '.*'):
+        suffix = fn.rsplit('.', 1)[-1]
+        if suffix.isdigit():
+            yield int(suffix)
+
+# Replays a journal (including any rotated files that haven't been discarded)
+# on top of users loaded with load_users() or load_shards(). Returns the IDs
+# of any modified users.
+def replay_journal(filename: str, users: MutableMapping[str, Any]) \
+        -> set[str]:
+    modified: set[str] = set()
+    filenames = [f'{filename}.{gen}'
+                 for gen in sorted(_journal_generations(filename))]
+    filenames.append(filename)
+    for fn in filenames:
+        try:
+            f = open(fn, 'r')
+        except FileNotFoundError:
+            continue
+
+        with f:
+            for line in f:
+                try:
+                    user_id, balance, inventory = json.loads(line)
+                except ValueError:
+                    # The last line may be incomplete if the bot crashed
+                    # while writing it.
+                    print(f'WARNING: Ignoring invalid journal record in '
+                          f'{fn!r}: {line!r}')
+                    continue
+
+                modified.add(user_id)
+                user = users.get(user_id)
+                if user is None:
+                    user = {'inventory': {}}
+                user['balance'] = balance
+                user_inv = user['inventory']
+                for item_id, qty in inventory.items():
+                    if qty > 0:
+                        user_inv[item_id] = qty
+                    else:
+                        user_inv.pop(item_id, None)
 
-# A user-facing function to call the thread.
-def save(filename: str, data: dict[str, Any]) -> None:
-    threading.Thread(target=_raw_save, args=(filename, json.dumps(data)),
-                     kwargs={}).start()
+                # Binary users are decoded into a new dict every time they
+                # are accessed, so the user always has to be stored.
+                users[user_id] = user
+    return modified
@@ -0,0 +1,79 @@
+# A single dispatch stage for guild messages, so that the work done for every
+# message (filtering out bots and DMs, looking up the author and reading the
+# clock) is only done once no matter how many cogs are interested.
+
+from __future__ import annotations
+import sys, time, traceback
+from collections.abc import Awaitable, Callable
+from typing import Any, Optional, Union
+from . import metrics
+
+class MessageEvent:
+    __slots__ = ('message', 'author_id', 'guild_id', 'time')
+    def __init__(self, message: Any, author_id: int, guild_id: int,
+            t: float) -> None:
+        self.message = message
+        self.author_id = author_id
+        self.guild_id = guild_id
+        self.time = t
+
+# Message handlers are called synchronously, and can return an awaitable if
+# they have to do something asynchronous (such as sending a message). Most
+# messages don't need any asynchronous work, so this avoids creating a
+# coroutine per handler per message.
+# This Union[] is a hack to keep Python 3.7 and 3.8 support.
+MessageHandler = Union['Callable[[MessageEvent], Optional[Awaitable[None]]]']
+
+class MessageDispatcher:
+    __slots__ = ('handlers',)
+
+    def __init__(self) -> None:
+        self.handlers: list[MessageHandler] = []
+
+    def add_handler(self, handler: MessageHandler) -> None:
+        if handler not in self.handlers:
+            self.handlers.append(handler)
+
+    def remove_handler(self, handler: MessageHandler) -> None:
+        if handler in self.handlers:
+            self.handlers.remove(handler)
+
+    # Dispatches a discord.py message to every handler. Messages from bots and
+    # messages outside of guilds are ignored.
+    async def dispatch(self, message: Any) -> None:
+        author = message.author
+        guild = message.guild
+        if author.bot or guild is None:
+            return
+
+        # The time taken by each handler is recorded (see procoin.metrics),
+        # including anything it has to await. Exceptions are printed rather
+        # than raised so that one handler failing doesn't stop the others
+        # from running.
+        event = MessageEvent(message, author.id, guild.id, time.time())
+        for handler in self.handlers:
+            name = _handler_name(handler)
+            token = metrics.enter_handler('message handler', name)
+            start = time.perf_counter()
+            error: Optional[str] = None
+            try:
+                res = handler(event)
+                if res is not None:
+                    await res
+            except Exception as exc:
+                error = metrics.error_name(exc)
+                print(f'Ignoring exception in message handler {name}:',
+                      file=sys.stderr)
+                traceback.print_exc()
+            except BaseException as exc:
+                metrics.registry.observe('message handler', name,
+                                         time.perf_counter() - start,
+                                         metrics.error_name(exc))
+                raise
+            finally:
+                metrics.exit_handler(token)
+            metrics.registry.observe('message handler', name,
+                                     time.perf_counter() - start, error)
+
+def _handler_name(handler: MessageHandler) -> str:
+    return getattr(handler, '__qualname__', type(handler).__qualname__)
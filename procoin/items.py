@@ -13,7 +13,7 @@ prefixes: tuple[tuple[int, str], ...] = (
 )
 class Item:
     __slots__ = ('id', 'name', 'cost', 'boost', 'default_qty', 'raw_merges',
-        'cursed')
+        'cursed', 'prefixed_name', 'item_string', 'index')
     def __init__(self, id: str, name: str, cost: int, boost: int,
             default_qty: int, raw_merges: list[list[str]], cursed: bool) \
             -> None:
@@ -24,6 +24,27 @@ class Item:
         self.default_qty = default_qty
         self.raw_merges = raw_merges
         self.cursed = cursed
+        self.update_strings()
+
+        # A dense integer index, assigned by ItemInterface.
+        self.index: int = -1
+
+    # Copies every attribute (other than the ID and index) from another item.
+    # Returns False if nothing was changed.
+    def update_from(self, other: Item) -> bool:
+        if (self.name, self.cost, self.boost, self.default_qty,
+                self.raw_merges, self.cursed) == (other.name, other.cost,
+                other.boost, other.default_qty, other.raw_merges,
+                other.cursed):
+            return False
+        self.name = other.name
+        self.cost = other.cost
+        self.boost = other.boost
+        self.default_qty = other.default_qty
+        self.raw_merges = other.raw_merges
+        self.cursed = other.cursed
+        self.update_strings()
+        return True
 
     def __str__(self) -> str:
         return self.name
@@ -38,9 +59,14 @@ class Item:
     def stockable(self) -> bool:
         return self.default_qty > 0
 
+    # Precomputes prefixed_name and item_string, this must be called if any
+    # other attributes are changed.
+    def update_strings(self) -> None:
+        self.prefixed_name: str = self._get_prefixed_name()
+        self.item_string: str = self._get_item_string()
+
     # TODO: Better name for this.
-    @property
-    def prefixed_name(self) -> str:
+    def _get_prefixed_name(self) -> str:
         res: str = ''
         if self.cursed:
             res = '**💀** '
@@ -61,8 +87,7 @@ class Item:
             res = '**V** '
         return res + self.name
 
-    @property
-    def item_string(self) -> str:
+    def _get_item_string(self) -> str:
         res = f'{self.prefixed_name} ({format_currency(self.cost)}'
         if self.boost:
             res += f', provides a boost of {format_currency(self.boost)}'
@@ -96,22 +121,103 @@ class Item:
             bool(data.get('cursed', False)))
 
 
+# The differences found by ItemInterface.update_from().
+class CatalogChanges:
+    __slots__ = ('added', 'removed', 'changed', 'index_map')
+    def __init__(self) -> None:
+        self.added: list[Item] = []
+
+        # Removed items keep their old index.
+        self.removed: list[Item] = []
+
+        # (item, old boost, old cost) for every modified item.
+        self.changed: list[tuple[Item, int, int]] = []
+
+        # If any items were removed, index_map[old_index] is the new index of
+        # the item (or -1 if it was removed).
+        self.index_map: Optional[list[int]] = None
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.removed or self.changed)
+
 # An ItemInterface will allow the program to work with all
 # the items that exist.
 class ItemInterface:
-    __slots__ = ('items',)
+    __slots__ = ('items', 'by_index', '_names', 'version')
     # Items: {"item_id": <Item object at ...>}
     def __init__(self, items: dict[str, Item]) -> None:
         self.items = items
+        self.by_index: list[Item] = []
+        self._names: dict[str, Item] = {}
+
+        # Incremented whenever update_from() changes anything, so that
+        # anything rendered from the items can be invalidated.
+        self.version: int = 0
+        self.update_index()
+
+    # Assigns every item an index (so that self.by_index[item.index] is item)
+    # and rebuilds the normalised name -> Item index used by lookup(). This
+    # must be called if self.items is modified.
+    def update_index(self) -> None:
+        self.by_index[:] = self.items.values()
+        self._names.clear()
+        for index, item in enumerate(self.by_index):
+            item.index = index
+            # If two items have the same name, the first one wins (this is
+            # what the old linear search did).
+            self._names.setdefault(self._item(item.name), item)
 
     # Items: {"item_id": {"name": "<name>", ...}}
     @classmethod
     def from_dict(cls, items: dict[str, dict[Any, Any]]):
         return cls({k: Item.from_dict(k, v) for k, v in items.items()})
 
+    # Replaces the catalog with the items in other. Existing Item objects are
+    # updated in place and keep their relative order, and new items are added
+    # to the end, so item indexes only change if items are removed.
+    def update_from(self, other: ItemInterface) -> CatalogChanges:
+        changes = CatalogChanges()
+        for item_id, new_item in other.items.items():
+            item = self.items.get(item_id)
+            if item is None:
+                changes.added.append(new_item)
+                continue
+            old_boost, old_cost = item.boost, item.cost
+            if item.update_from(new_item):
+                changes.changed.append((item, old_boost, old_cost))
+
+        changes.removed = [item for item_id, item in self.items.items()
+                           if item_id not in other.items]
+        if not changes:
+            return changes
+
+        for item in changes.removed:
+            del self.items[item.id]
+        for item in changes.added:
+            self.items[item.id] = item
+
+        old_count = len(self.by_index)
+        self.update_index()
+        self.version += 1
+        if changes.removed:
+            # The remaining old items are at the start of by_index in their
+            # old order, and removed items still have their old index.
+            removed = {item.index for item in changes.removed}
+            index_map = [-1] * old_count
+            new_index = 0
+            for old_index in range(old_count):
+                if old_index not in removed:
+                    index_map[old_index] = new_index
+                    new_index += 1
+            changes.index_map = index_map
+        return changes
+
     def get_item(self, item_id: str) -> Item:
         return self.items[item_id]
 
+    def get_by_index(self, index: int) -> Item:
+        return self.by_index[index]
+
     @staticmethod
     def _item(item: str) -> str:
         return item.casefold().strip().replace("'", '').replace('’', '')
@@ -123,11 +229,7 @@ class ItemInterface:
         if item_string.startswith('#'):
             return self.items.get(item_string[1:])
 
-        item_string = self._item(item_string)
-        for item in self.items.values():
-            if item_string == self._item(item.name):
-                return item
-        return None
+        return self._names.get(self._item(item_string))
 
     # Get an item's name from its ID.
     def get_name(self, item_id: str) -> str:
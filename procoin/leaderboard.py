@@ -0,0 +1,145 @@
+from __future__ import annotations
+import math, random
+from typing import Any, Optional
+
+# The maximum height of the skip list, this is enough for ~4 billion users.
+_max_levels = 32
+
+class _Node:
+    __slots__ = ('key', 'next', 'width')
+    def __init__(self, key: Any, levels: int) -> None:
+        self.key = key
+        self.next: list[_Node] = [_nil] * levels if levels else []
+        self.width: list[int] = [1] * levels
+
+# The node at the end of every level. Its key compares greater than every
+# (-score, user_id) tuple.
+_nil = _Node((math.inf,), 0)
+
+def _random_level() -> int:
+    level = 1
+    while level < _max_levels and random.getrandbits(1):
+        level += 1
+    return level
+
+# A leaderboard of user IDs ordered by score (highest first). This is an
+# indexable skip list, so updates, rank() and top() are all O(log n) (plus the
+# number of users returned by top()). Users with the same score are ordered by
+# ID so the order is stable.
+class Leaderboard:
+    __slots__ = ('_head', '_scores')
+
+    def __init__(self, scores: Optional[dict[str, int]] = None) -> None:
+        self._head = _Node(None, _max_levels)
+        self._scores: dict[str, int] = {}
+        if scores:
+            self._build(scores)
+
+    # Builds the skip list from scratch in O(n log n) (for the sort), which is
+    # a lot faster than inserting every user.
+    def _build(self, scores: dict[str, int]) -> None:
+        self._scores.update(scores)
+        last = [self._head] * _max_levels
+        last_pos = [0] * _max_levels
+        keys = sorted((-score, user_id) for user_id, score in scores.items())
+        for pos, key in enumerate(keys, 1):
+            node = _Node(key, _random_level())
+            for level in range(len(node.next)):
+                prev = last[level]
+                prev.next[level] = node
+                prev.width[level] = pos - last_pos[level]
+                last[level] = node
+                last_pos[level] = pos
+
+        end = len(keys) + 1
+        for level in range(_max_levels):
+            last[level].next[level] = _nil
+            last[level].width[level] = end - last_pos[level]
+
+    def __len__(self) -> int:
+        return len(self._scores)
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._scores
+
+    def get_score(self, user_id: str) -> Optional[int]:
+        return self._scores.get(user_id)
+
+    def _insert(self, key: tuple[int, str]) -> None:
+        chain: list[_Node] = [self._head] * _max_levels
+        steps_at_level = [0] * _max_levels
+        node = self._head
+        for level in reversed(range(_max_levels)):
+            while node.next[level].key <= key:
+                steps_at_level[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+
+        new_node = _Node(key, _random_level())
+        steps = 0
+        for level in range(len(new_node.next)):
+            prev = chain[level]
+            new_node.next[level] = prev.next[level]
+            prev.next[level] = new_node
+            new_node.width[level] = prev.width[level] - steps
+            prev.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in range(len(new_node.next), _max_levels):
+            chain[level].width[level] += 1
+
+    def _remove(self, key: tuple[int, str]) -> None:
+        chain: list[_Node] = [self._head] * _max_levels
+        node = self._head
+        for level in reversed(range(_max_levels)):
+            while node.next[level].key < key:
+                node = node.next[level]
+            chain[level] = node
+
+        node = chain[0].next[0]
+        assert node.key == key
+        for level in range(len(node.next)):
+            prev = chain[level]
+            prev.width[level] += node.width[level] - 1
+            prev.next[level] = node.next[level]
+        for level in range(len(node.next), _max_levels):
+            chain[level].width[level] -= 1
+
+    # Sets the score of a user, adding them to the leaderboard if required.
+    def update(self, user_id: str, score: int) -> None:
+        old_score = self._scores.get(user_id)
+        if old_score == score:
+            return
+        if old_score is not None:
+            self._remove((-old_score, user_id))
+        self._insert((-score, user_id))
+        self._scores[user_id] = score
+
+    def remove(self, user_id: str) -> None:
+        score = self._scores.pop(user_id)
+        self._remove((-score, user_id))
+
+    # Returns the (1-based) rank of a user, or None if they aren't on the
+    # leaderboard.
+    def rank(self, user_id: str) -> Optional[int]:
+        score = self._scores.get(user_id)
+        if score is None:
+            return None
+
+        key = (-score, user_id)
+        rank = 0
+        node = self._head
+        for level in reversed(range(_max_levels)):
+            while node.next[level].key < key:
+                rank += node.width[level]
+                node = node.next[level]
+        return rank + 1
+
+    # Returns the top n users as a list of (user_id, score) tuples.
+    def top(self, n: int) -> list[tuple[str, int]]:
+        res: list[tuple[str, int]] = []
+        node = self._head.next[0]
+        while node is not _nil and len(res) < n:
+            score, user_id = node.key
+            res.append((user_id, -score))
+            node = node.next[0]
+        return res
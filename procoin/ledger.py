@@ -0,0 +1,121 @@
+# ProCoin ledger
+#
+# Every change to the users goes through a Ledger, which applies operations
+# one at a time in the order they were submitted. Operations submitted during
+# the same event loop iteration are applied together as a batch once the
+# ledger task gets to run, so there is never more than one writer and
+# operations can't interleave with each other.
+#
+# Saving is also done as a ledger operation, so the data handed to the writer
+# thread (see procoin.db) is a point-in-time snapshot taken between
+# operations rather than something that changes while it is being written.
+# Reads that have to see every previously submitted change can be submitted
+# in the same way.
+
+from __future__ import annotations
+import asyncio, time, traceback
+from collections.abc import Callable
+from typing import Any, Optional, TypeVar
+
+_T = TypeVar('_T')
+
+class _Operation:
+    __slots__ = ('func', 'args', 'future')
+    def __init__(self, func: Callable[..., Any], args: tuple[Any, ...],
+            future: Optional[asyncio.Future[Any]]) -> None:
+        self.func = func
+        self.args = args
+        self.future = future
+
+class Ledger:
+    __slots__ = ('_queue', '_task', 'operations', 'batches', 'largest_batch',
+                 'busy_time')
+
+    def __init__(self) -> None:
+        # The queue and task are only created once the first operation is
+        # submitted, as there may not be an event loop before then.
+        self._queue: Optional[asyncio.Queue[_Operation]] = None
+        self._task: Optional[asyncio.Future[None]] = None
+
+        # Statistics, these are never reset.
+        self.operations: int = 0
+        self.batches: int = 0
+        self.largest_batch: int = 0
+        self.busy_time: float = 0
+
+    def _get_queue(self) -> asyncio.Queue[_Operation]:
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.ensure_future(self._run())
+        return self._queue
+
+    # Queues func(*args) and returns a Future with its result. If func raises
+    # an exception, the Future is resolved with that exception instead.
+    def submit(self, func: Callable[..., _T], *args: Any) \
+            -> asyncio.Future[_T]:
+        queue = self._get_queue()
+        future: asyncio.Future[_T] = asyncio.get_event_loop().create_future()
+        queue.put_nowait(_Operation(func, args, future))
+        return future
+
+    # Like submit(), but for operations whose result isn't needed. This is
+    # cheaper as no Future is created, and any exceptions are printed.
+    def post(self, func: Callable[..., Any], *args: Any) -> None:
+        self._get_queue().put_nowait(_Operation(func, args, None))
+
+    # Calls func(*args) once every previously submitted operation has been
+    # applied and returns the result.
+    async def call(self, func: Callable[..., _T], *args: Any) -> _T:
+        return await self.submit(func, *args)
+
+    # Waits for every operation submitted so far to be applied.
+    async def flush(self) -> None:
+        if self._queue is not None:
+            await self.submit(lambda : None)
+
+    async def _run(self) -> None:
+        queue = self._queue
+        assert queue is not None
+        while True:
+            batch = [await queue.get()]
+            while True:
+                try:
+                    batch.append(queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            self._apply(batch)
+
+    def _apply(self, batch: list[_Operation]) -> None:
+        start = time.perf_counter()
+        for op in batch:
+            future = op.future
+            try:
+                res = op.func(*op.args)
+            except Exception as exc:
+                if future is None:
+                    traceback.print_exc()
+                elif not future.cancelled():
+                    future.set_exception(exc)
+            else:
+                if future is not None and not future.cancelled():
+                    future.set_result(res)
+
+        self.operations += len(batch)
+        self.batches += 1
+        self.largest_batch = max(self.largest_batch, len(batch))
+        self.busy_time += time.perf_counter() - start
+
+    # Stops the ledger task and applies any pending operations immediately.
+    # This doesn't need a running event loop.
+    def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+        queue = self._queue
+        self._queue = None
+        if queue is not None and not queue.empty():
+            batch: list[_Operation] = []
+            while not queue.empty():
+                batch.append(queue.get_nowait())
+            self._apply(batch)
@@ -1,30 +1,57 @@
 from __future__ import annotations
-from collections.abc import Collection
-from typing import Optional
+from collections.abc import Collection, Iterable
+from typing import Optional, Union
 from .items import Item, ItemInterface
 from .store import Error
 from .users import User, UserInterface
 
+# Returns the key used for a list of items in MergeInterface.merges. This is
+# a sorted tuple of item indexes (see ItemInterface.by_index), so the order
+# of the items doesn't matter and duplicate items are preserved.
+def recipe_key(items: Iterable[Item]) -> tuple[int, ...]:
+    return tuple(sorted([item.index for item in items]))
+
+# A step in a crafting plan: (recipe items, result, amount).
+# This Union[] is a hack to keep Python 3.7 and 3.8 support.
+MergeStep = Union['tuple[tuple[Item, ...], Item, int]']
+
 class MergeInterface:
-    __slots__ = ('merges', 'items')
+    __slots__ = ('merges', 'items', 'used_in', 'made_by', '_ingredients',
+                 '_merge_lines', '_merge_pages')
 
     def __init__(self, items: ItemInterface) -> None:
         self.items = items
-        self.merges: dict[tuple[Item, ...], Item] = {}
+        self.merges: dict[tuple[int, ...], Item] = {}
+
+        # Reverse indexes: item index -> recipe keys that use the item, and
+        # item index -> recipe keys that make the item.
+        self.used_in: dict[int, list[tuple[int, ...]]] = {}
+        self.made_by: dict[int, list[tuple[int, ...]]] = {}
+
+        # Recipe key -> ((item index, count), ...) for recipes that don't use
+        # cursed items (which can't be merged), used by the planner.
+        self._ingredients: dict[tuple[int, ...],
+                                tuple[tuple[int, int], ...]] = {}
+
+        # Rendered merge lines and pages, see get_merge_pages().
+        self._merge_lines: Optional[dict[tuple[int, ...], str]] = None
+        self._merge_pages: dict[tuple[int, int], list[str]] = {}
+
         self.update_merges()
 
     # Updates the merges
     def update_merges(self) -> None:
         self.merges.clear()
-        merge: list[Item]
-        for item in self.items.items.values():
+        self._merge_lines = None
+        self._merge_pages.clear()
+        known_items = self.items.items
+        for item in known_items.values():
             if not item.raw_merges:
                 continue
             for merges in item.raw_merges:
                 assert merges
                 try:
-                    merge = sorted((self.items.items[i] for i in merges),
-                                   key=lambda n : n.id)
+                    key = recipe_key([known_items[i] for i in merges])
                 except KeyError:
                     for i in merges:
                         assert i in self.items.items, f'Error in items.json:' \
@@ -33,24 +60,142 @@ class MergeInterface:
                     # This should never happen
                     raise
                 else:
-                    self.merges[tuple(merge)] = item
+                    self.merges[key] = item
+
+        self._update_indexes()
+
+    # Rebuilds the reverse indexes from self.merges.
+    def _update_indexes(self) -> None:
+        self.used_in.clear()
+        self.made_by.clear()
+        self._ingredients.clear()
+        by_index = self.items.by_index
+        for key, result in self.merges.items():
+            self.made_by.setdefault(result.index, []).append(key)
+            counts: dict[int, int] = {}
+            for index in key:
+                counts[index] = counts.get(index, 0) + 1
+            for index in counts:
+                self.used_in.setdefault(index, []).append(key)
+            if not any(by_index[index].cursed for index in counts):
+                self._ingredients[key] = tuple(counts.items())
 
     # Gets a possible merge created from a tuple/list of items
-    def get_merge(self, items: Collection[Item]) -> Optional[Item]:
-        sorted_items: list[Item] = sorted(items, key=lambda item : item.id)
-        return self.merges.get(tuple(sorted_items))
+    def get_merge(self, items: Iterable[Item]) -> Optional[Item]:
+        return self.merges.get(recipe_key(items))
+
+    # Returns the items used in a recipe key.
+    def get_recipe(self, key: tuple[int, ...]) -> tuple[Item, ...]:
+        by_index = self.items.by_index
+        return tuple(by_index[index] for index in key)
+
+    # Renders every recipe for the "merges" command. This is cached until
+    # update_merges() is called.
+    def _get_merge_lines(self) -> dict[tuple[int, ...], str]:
+        if self._merge_lines is not None:
+            return self._merge_lines
+
+        by_index = self.items.by_index
+        lines: dict[tuple[int, ...], str] = {}
+        for key, result in self.merges.items():
+            items = sorted(by_index[index].name for index in key)
+            lines[key] = f"`{'` + `'.join(items)}` → {result}"
+        self._merge_lines = lines
+        return lines
 
     # Gets a list of merges for the "merges" command.
     def get_merges(self) -> str:
-        res: list[str] = []
-        for merge, result in self.merges.items():
-            items = sorted(item.name for item in merge)
-            res.append(f"`{'` + `'.join(items)}` → {result}")
-        res.sort()
-        return '\n'.join(res)
+        return '\n'.join(sorted(self._get_merge_lines().values()))
+
+    # Gets the merges for the "merges" command split into pages that fit in
+    # an embed. If using and/or makes are specified, only recipes that use or
+    # make those items are included. The pages are cached until
+    # update_merges() is called.
+    def get_merge_pages(self, using: Optional[Item] = None,
+            makes: Optional[Item] = None) -> list[str]:
+        cache_key = (-1 if using is None else using.index,
+                     -1 if makes is None else makes.index)
+        pages = self._merge_pages.get(cache_key)
+        if pages is not None:
+            return pages
+
+        all_lines = self._get_merge_lines()
+        keys: Iterable[tuple[int, ...]]
+        if using is not None:
+            keys = self.used_in.get(using.index, ())
+            if makes is not None:
+                keys = [key for key in keys if self.merges[key] is makes]
+        elif makes is not None:
+            keys = self.made_by.get(makes.index, ())
+        else:
+            keys = all_lines
+        lines = sorted(all_lines[key] for key in keys)
+
+        # Split the lines into pages that fit in 2048 characters.
+        pages = []
+        page: list[str] = []
+        page_l = 0
+        for line in lines:
+            if page_l + len(line) > 2048 and page:
+                pages.append('\n'.join(page))
+                page = []
+                page_l = 0
+            page.append(line)
+            page_l += len(line) + 1
+        if page or not pages:
+            pages.append('\n'.join(page))
+
+        # Don't let the cache grow forever if lots of different filters are
+        # used.
+        if len(self._merge_pages) >= 256:
+            self._merge_pages.clear()
+        self._merge_pages[cache_key] = pages
+        return pages
+
+    # Returns every merge a user can do with their current inventory as a list
+    # of (recipe items, result, maximum amount) tuples. Only recipes that use
+    # items in the inventory are checked.
+    def get_possible_merges(self, user: User) \
+            -> list[tuple[tuple[Item, ...], Item, int]]:
+        inventory = dict(zip(user._inv_idx, user._inv_qty))
+        res: list[tuple[tuple[Item, ...], Item, int]] = []
+        for index in inventory:
+            for key in self.used_in.get(index, ()):
+                # Only check each recipe once (from its first item)
+                if key[0] != index:
+                    continue
+                ingredients = self._ingredients.get(key)
+                if ingredients is None:
+                    continue
+                amount = min(inventory.get(i, 0) // count
+                             for i, count in ingredients)
+                if amount > 0:
+                    res.append((self.get_recipe(key), self.merges[key],
+                                amount))
+        return res
+
+    # Finds a sequence of merges that will make amount of target from the
+    # user's inventory, or returns None if that isn't possible. Items that the
+    # user doesn't have enough of are made with other merges where possible.
+    # The steps are returned in the order that they should be done in.
+    def plan_merges(self, user: User, target: Item, amount: int) \
+            -> Optional[list[MergeStep]]:
+        assert amount > 0
+        planner = _Planner(self, user)
+
+        # Don't use up any of the target item the user already has.
+        planner.inventory.pop(target.index, None)
+
+        if not planner.craft(target.index, amount):
+            return None
+        by_index = self.items.by_index
+        return [(self.get_recipe(key), by_index[index], qty)
+                for key, index, qty in planner.steps]
 
     # Performs a merge and returns a formatted names list of items and the
-    # resulting item.
+    # resulting item. This should be called inside a
+    # UserInterface.transaction() so that any taken items are returned if
+    # something goes wrong.
     def merge_item(self, user: User, items: Collection[Item],
             amount: int) -> tuple[str, Item]:
         items = sorted(items, key=lambda item : item.name)
@@ -79,15 +224,85 @@ class MergeInterface:
         for item, qty in required_items.items():
             user.assert_has_item(item, qty)
 
-        idx: int = 0
-        try:
-            for idx, item in enumerate(items):
-                user.take_item(item, amount)
-            user.add_item(result, amount)
-        except:
-            # If this explodes, return all items.
-            for item in items[:idx]:
-                user.add_item(item, amount)
-            raise
+        for item in items:
+            user.take_item(item, amount)
+        user.add_item(result, amount)
 
         return names, result
+
+# A depth-first search over the recipe graph. This works on a copy of the
+# user's inventory and keeps an undo log so that failed recipes can be rolled
+# back.
+class _Planner:
+    __slots__ = ('merges', 'inventory', 'steps', '_log', '_failed',
+                 '_visiting', '_cycles')
+
+    def __init__(self, merges: MergeInterface, user: User) -> None:
+        self.merges = merges
+        self.inventory = dict(zip(user._inv_idx, user._inv_qty))
+        self.steps: list[tuple[tuple[int, ...], int, int]] = []
+        self._log: list[tuple[int, int]] = []
+
+        # Item index -> the smallest amount of the item that couldn't be made.
+        # The inventory only shrinks until something is rolled back, so
+        # trying to make the same amount (or more) would fail again.
+        self._failed: dict[int, int] = {}
+
+        # Items that are currently being made, to avoid recipe loops.
+        self._visiting: set[int] = set()
+        self._cycles = 0
+
+    def _set(self, index: int, qty: int) -> None:
+        self._log.append((index, self.inventory.get(index, 0)))
+        self.inventory[index] = qty
+
+    def _rollback(self, mark: int, step_mark: int) -> None:
+        if len(self._log) > mark:
+            # Items have been returned, so earlier failures may not fail any
+            # more.
+            self._failed.clear()
+            for index, qty in reversed(self._log[mark:]):
+                self.inventory[index] = qty
+            del self._log[mark:]
+        del self.steps[step_mark:]
+
+    # Takes qty of an item from the inventory, making any missing items.
+    def _take(self, index: int, qty: int) -> bool:
+        have = self.inventory.get(index, 0)
+        if have < qty:
+            if not self.craft(index, qty - have):
+                return False
+            have = qty
+        self._set(index, have - qty)
+        return True
+
+    # Adds the steps required to make qty of an item.
+    def craft(self, index: int, qty: int) -> bool:
+        failed = self._failed.get(index)
+        if failed is not None and qty >= failed:
+            return False
+        if index in self._visiting:
+            self._cycles += 1
+            return False
+
+        cycles = self._cycles
+        self._visiting.add(index)
+        try:
+            for key in self.merges.made_by.get(index, ()):
+                ingredients = self.merges._ingredients.get(key)
+                if ingredients is None:
+                    continue
+                mark, step_mark = len(self._log), len(self.steps)
+                if all(self._take(i, count * qty) for i, count in ingredients):
+                    self.steps.append((key, index, qty))
+                    self._set(index, self.inventory.get(index, 0) + qty)
+                    return True
+                self._rollback(mark, step_mark)
+        finally:
+            self._visiting.remove(index)
+
+        # Failures caused by recipe loops depend on which items are being
+        # made and can't be remembered.
+        if self._cycles == cycles:
+            self._failed[index] = qty
+        return False
@@ -0,0 +1,370 @@
+# Latency and error metrics for commands, listeners and saves
+#
+# Everything is recorded in a single registry (which survives the cogs being
+# reloaded) and can be exported in the Prometheus text format, either with
+# Metrics.exposition() or over HTTP with start_http_server().
+
+from __future__ import annotations
+import asyncio, bisect, functools, threading, time
+from collections.abc import Awaitable, Callable
+from typing import Any, Optional, TypeVar, TYPE_CHECKING
+if TYPE_CHECKING:
+    from .ledger import Ledger
+
+# The upper bounds (in seconds) of the latency histogram buckets.
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets: tuple[float, ...] = default_buckets) -> None:
+        self.buckets = buckets
+
+        # counts[i] is the number of values in (buckets[i - 1], buckets[i]],
+        # the last count is for values larger than every bucket.
+        self.counts: list[int] = [0] * (len(buckets) + 1)
+        self.sum: float = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    # Estimates a quantile, returning the upper bound of the bucket that
+    # contains it (or infinity if it is larger than every bucket).
+    def quantile(self, q: float) -> float:
+        target = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= target:
+                return bound
+        return float('inf')
+
+    def copy(self) -> Histogram:
+        res = Histogram(self.buckets)
+        res.counts[:] = self.counts
+        res.sum = self.sum
+        return res
+
+# A summary of a command or listener for the stats command.
+class HandlerSummary:
+    __slots__ = ('kind', 'name', 'calls', 'errors', 'total', 'p50', 'p99')
+
+    def __init__(self, kind: str, name: str, histogram: Histogram,
+            errors: int) -> None:
+        self.kind = kind
+        self.name = name
+        self.calls = histogram.count
+        self.errors = errors
+        self.total = histogram.sum
+        self.p50 = histogram.quantile(0.5)
+        self.p99 = histogram.quantile(0.99)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.calls if self.calls else 0.0
+
+# Metrics may be updated from any thread (saves are done in the db writer
+# thread).
+class Metrics:
+    __slots__ = ('_lock', 'handlers', 'errors', 'saves', 'save_errors',
+                 'save_bytes', 'last_save_bytes', 'histograms', 'gauges')
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+
+        # Latencies and error counts of commands and listeners, keyed by
+        # (kind, name) and (kind, name, error type) respectively.
+        self.handlers: dict[tuple[str, str], Histogram] = {}
+        self.errors: dict[tuple[str, str, str], int] = {}
+
+        # Saves made by the db writer thread.
+        self.saves = Histogram()
+        self.save_errors: int = 0
+        self.save_bytes: int = 0
+        self.last_save_bytes: int = 0
+
+        # Other histograms, in the format {name: (help, histogram)}.
+        self.histograms: dict[str, tuple[str, Histogram]] = {}
+
+        # Other values that are read when the metrics are exported, in the
+        # format {name: (type, help, function)}.
+        self.gauges: dict[str, tuple[str, str, Callable[[], float]]] = {}
+
+    # Records a call to a command or listener. If the call failed, error
+    # should be the name of the exception type.
+    def observe(self, kind: str, name: str, seconds: float,
+            error: Optional[str] = None) -> None:
+        with self._lock:
+            histogram = self.handlers.get((kind, name))
+            if histogram is None:
+                histogram = self.handlers[kind, name] = Histogram()
+            histogram.observe(seconds)
+            if error is not None:
+                self._count_error(kind, name, error)
+
+    # Records an error without a latency (for example a command that failed
+    # a check before it started running).
+    def count_error(self, kind: str, name: str, error: str) -> None:
+        with self._lock:
+            self._count_error(kind, name, error)
+
+    def _count_error(self, kind: str, name: str, error: str) -> None:
+        key = (kind, name, error)
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+    def observe_save(self, seconds: float, size: int) -> None:
+        with self._lock:
+            self.saves.observe(seconds)
+            self.save_bytes += size
+            self.last_save_bytes = size
+
+    def save_failed(self) -> None:
+        with self._lock:
+            self.save_errors += 1
+
+    # Adds a histogram that can be updated with observe_value(). Existing
+    # histograms are kept.
+    def add_histogram(self, name: str, help: str,
+            buckets: tuple[float, ...] = default_buckets) -> None:
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = (help, Histogram(buckets))
+
+    def observe_value(self, name: str, value: float) -> None:
+        with self._lock:
+            self.histograms[name][1].observe(value)
+
+    # Adds (or replaces) a value that is read with func when the metrics are
+    # exported. metric_type should be "gauge" or "counter".
+    def add_gauge(self, name: str, help: str, func: Callable[[], float], *,
+            metric_type: str = 'gauge') -> None:
+        self.gauges[name] = (metric_type, help, func)
+
+    def remove_gauge(self, name: str) -> None:
+        self.gauges.pop(name, None)
+
+    # Returns a summary of every command and listener, sorted by the total
+    # time spent in them.
+    def summary(self) -> list[HandlerSummary]:
+        with self._lock:
+            errors: dict[tuple[str, str], int] = {}
+            for (kind, name, _), count in self.errors.items():
+                errors[kind, name] = errors.get((kind, name), 0) + count
+            res = [HandlerSummary(kind, name, histogram,
+                                  errors.get((kind, name), 0))
+                   for (kind, name), histogram in self.handlers.items()]
+        res.sort(key=lambda s : s.total, reverse=True)
+        return res
+
+    # Returns the metrics in the Prometheus text format.
+    def exposition(self) -> str:
+        with self._lock:
+            handlers = {k: v.copy() for k, v in self.handlers.items()}
+            errors = dict(self.errors)
+            saves = self.saves.copy()
+            save_errors = self.save_errors
+            save_bytes = self.save_bytes
+            last_save_bytes = self.last_save_bytes
+            histograms = {name: (help, histogram.copy())
+                          for name, (help, histogram)
+                          in self.histograms.items()}
+
+        lines: list[str] = []
+        _header(lines, 'procoin_handler_seconds', 'histogram',
+                'Time taken to run commands and listeners.')
+        for (kind, name), histogram in sorted(handlers.items()):
+            _histogram(lines, 'procoin_handler_seconds', histogram,
+                       f'kind="{_escape(kind)}",name="{_escape(name)}",')
+
+        _header(lines, 'procoin_handler_errors_total', 'counter',
+                'Commands and listeners that raised an exception.')
+        for (kind, name, error), count in sorted(errors.items()):
+            lines.append(f'procoin_handler_errors_total{{kind='
+                         f'"{_escape(kind)}",name="{_escape(name)}",'
+                         f'error="{_escape(error)}"}} {count}')
+
+        _header(lines, 'procoin_save_seconds', 'histogram',
+                'Time taken to serialise and write files.')
+        _histogram(lines, 'procoin_save_seconds', saves, '')
+        _header(lines, 'procoin_save_errors_total', 'counter',
+                'Saves that failed.')
+        lines.append(f'procoin_save_errors_total {save_errors}')
+        _header(lines, 'procoin_save_bytes_total', 'counter',
+                'Bytes written by saves.')
+        lines.append(f'procoin_save_bytes_total {save_bytes}')
+        _header(lines, 'procoin_last_save_bytes', 'gauge',
+                'Bytes written by the most recent save.')
+        lines.append(f'procoin_last_save_bytes {last_save_bytes}')
+
+        for name, (help, histogram) in sorted(histograms.items()):
+            _header(lines, name, 'histogram', help)
+            _histogram(lines, name, histogram, '')
+
+        for name, (metric_type, help, func) in sorted(self.gauges.items()):
+            _header(lines, name, metric_type, help)
+            lines.append(f'{name} {_format_value(func())}')
+
+        lines.append('')
+        return '\n'.join(lines)
+
+def _escape(value: str) -> str:
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+def _header(lines: list[str], name: str, metric_type: str, help: str) -> None:
+    lines.append(f'# HELP {name} {help}')
+    lines.append(f'# TYPE {name} {metric_type}')
+
+# labels should be empty or end with a comma.
+def _histogram(lines: list[str], name: str, histogram: Histogram,
+        labels: str) -> None:
+    total = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        total += count
+        lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {total}')
+    total += histogram.counts[-1]
+    lines.append(f'{name}_bucket{{{labels}le="+Inf"}} {total}')
+    labels = labels.rstrip(',')
+    labels = f'{{{labels}}}' if labels else ''
+    lines.append(f'{name}_sum{labels} {_format_value(histogram.sum)}')
+    lines.append(f'{name}_count{labels} {total}')
+
+registry = Metrics()
+
+# The name to record an exception as. discord.py wraps exceptions raised by
+# commands in CommandInvokeError, so the original exception is used instead.
+def error_name(error: BaseException) -> str:
+    if type(error).__name__ == 'CommandInvokeError' and \
+            error.__cause__ is not None:
+        error = error.__cause__
+    return type(error).__name__
+
+# The command or listener that each asyncio task is running, so that the
+# watchdog can tell which one blocked the event loop (see procoin.watchdog).
+# This is read from the watchdog's thread.
+running: dict[Any, str] = {}
+
+# Marks the current task as running a handler. The returned token must be
+# passed to exit_handler() afterwards.
+def enter_handler(kind: str, name: str) -> tuple[Any, Optional[str]]:
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    previous = running.get(task)
+    running[task] = f'{kind} {name!r}'
+    return task, previous
+
+def exit_handler(token: tuple[Any, Optional[str]]) -> None:
+    task, previous = token
+    if previous is None:
+        running.pop(task, None)
+    else:
+        running[task] = previous
+
+# Returns a description of what the event loop is running, for the watchdog.
+# This can be called from any thread.
+def current_handler(loop: asyncio.AbstractEventLoop) -> str:
+    try:
+        task = asyncio.current_task(loop)
+    except RuntimeError:
+        task = None
+    if task is None:
+        return 'a callback'
+    handler = running.get(task)
+    if handler is not None:
+        return handler
+    get_name = getattr(task, 'get_name', None)
+    return f'task {get_name()!r}' if get_name else repr(task)
+
+_T = TypeVar('_T')
+
+# A decorator that records the latency (and any errors) of a coroutine
+# function, such as a listener.
+def timed(kind: str, name: Optional[str] = None) \
+        -> Callable[[Callable[..., Awaitable[_T]]],
+                    Callable[..., Awaitable[_T]]]:
+    def decorator(func: Callable[..., Awaitable[_T]]) \
+            -> Callable[..., Awaitable[_T]]:
+        func_name = name or func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(*args: Any, **kwargs: Any) -> _T:
+            token = enter_handler(kind, func_name)
+            start = time.perf_counter()
+            try:
+                res = await func(*args, **kwargs)
+            except BaseException as exc:
+                registry.observe(kind, func_name, time.perf_counter() - start,
+                                 error_name(exc))
+                raise
+            finally:
+                exit_handler(token)
+            registry.observe(kind, func_name, time.perf_counter() - start)
+            return res
+        return wrapper
+    return decorator
+
+# Exports a ledger's statistics (see procoin.ledger).
+def add_ledger_gauges(ledger: Ledger) -> None:
+    registry.add_gauge('procoin_ledger_operations_total',
+                       'Operations applied by the ledger.',
+                       lambda : ledger.operations, metric_type='counter')
+    registry.add_gauge('procoin_ledger_batches_total',
+                       'Batches of operations applied by the ledger.',
+                       lambda : ledger.batches, metric_type='counter')
+    registry.add_gauge('procoin_ledger_largest_batch',
+                       'The largest batch applied by the ledger.',
+                       lambda : ledger.largest_batch)
+    registry.add_gauge('procoin_ledger_busy_seconds_total',
+                       'Time spent applying operations.',
+                       lambda : ledger.busy_time, metric_type='counter')
+
+_max_request_size = 8192
+
+async def _handle_http(reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter) -> None:
+    try:
+        request = await asyncio.wait_for(reader.readline(), 5)
+        size = len(request)
+        while size < _max_request_size:
+            line = await asyncio.wait_for(reader.readline(), 5)
+            size += len(line)
+            if line in (b'\r\n', b'\n', b''):
+                break
+
+        parts = request.split()
+        path = parts[1].split(b'?', 1)[0] if len(parts) > 1 else b''
+        if parts[:1] == [b'GET'] and path in (b'/', b'/metrics'):
+            status = '200 OK'
+            body = registry.exposition().encode('utf-8')
+        else:
+            status = '404 Not Found'
+            body = b'Not found\n'
+        writer.write(f'HTTP/1.0 {status}\r\n'
+                     f'Content-Type: text/plain; version=0.0.4; '
+                     f'charset=utf-8\r\n'
+                     f'Content-Length: {len(body)}\r\n\r\n'.encode('ascii'))
+        writer.write(body)
+        await writer.drain()
+    except (OSError, asyncio.TimeoutError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+# Serves the metrics at /metrics. This only listens on localhost by default,
+# as the metrics include command names and error types.
+async def start_http_server(port: int, host: str = '127.0.0.1') \
+        -> asyncio.AbstractServer:
+    return await asyncio.start_server(_handle_http, host, port)
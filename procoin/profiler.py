@@ -0,0 +1,182 @@
+# On-demand profiling of the running bot
+#
+# StackSampler periodically records the stack of another thread (normally the
+# event loop's thread) from a background thread, so the loop keeps running
+# normally while it is being profiled and the overhead is small enough to use
+# on the live bot. trace_memory() runs tracemalloc for a while and returns a
+# snapshot of the allocations made in that time that are still alive.
+
+from __future__ import annotations
+import asyncio, os, sys, threading, time, tracemalloc
+from collections.abc import Callable
+from typing import Optional, TypeVar, Union
+from .store import Error
+
+# A function in a stack: (filename, first line number, name).
+# This Union[] is a hack to keep Python 3.7 and 3.8 support.
+_Function = Union['tuple[str, int, str]']
+
+_T = TypeVar('_T')
+
+class ProfilerBusyError(Error):
+    def __str__(self) -> str:
+        return 'A profile is already running!'
+
+# Only one profile of each kind can run at once, as tracemalloc is global and
+# two samplers would slow the bot down twice as much.
+_running: set[str] = set()
+
+def _acquire(kind: str) -> None:
+    if kind in _running:
+        raise ProfilerBusyError
+    _running.add(kind)
+
+class StackSampler:
+    __slots__ = ('thread_id', 'interval', 'samples', 'stacks', '_stop',
+                 '_thread')
+
+    # If thread_id isn't specified, the current thread is sampled.
+    def __init__(self, thread_id: Optional[int] = None,
+            interval: float = 0.005) -> None:
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.samples: int = 0
+
+        # The number of times each stack (outermost function first) was seen.
+        self.stacks: dict[tuple[_Function, ...], int] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run,
+                                        name='procoin.profiler sampler',
+                                        daemon=True)
+        self._thread.start()
+
+    # Tells the sampler thread to stop. It may be in the middle of taking a
+    # sample, so the samples shouldn't be used until join() returns.
+    def stop(self) -> None:
+        self._stop.set()
+
+    def join(self) -> None:
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self) -> None:
+        current_frames = sys._current_frames
+        while not self._stop.wait(self.interval):
+            frame = current_frames().get(self.thread_id)
+            stack: list[_Function] = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_filename, code.co_firstlineno,
+                              code.co_name))
+                frame = frame.f_back
+            if not stack:
+                continue
+            stack.reverse()
+            key = tuple(stack)
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    # Returns [(function, cumulative samples, own samples)] sorted by the
+    # cumulative samples (the number of samples in which the function was on
+    # the stack). Functions that are in every sample (such as the event loop
+    # itself) are left out.
+    def top_functions(self, n: Optional[int] = None) \
+            -> list[tuple[_Function, int, int]]:
+        stacks = list(self.stacks)
+        skip = 0
+        if stacks:
+            skip = min(len(os.path.commonprefix(stacks)),
+                       min(map(len, stacks)) - 1)
+
+        cumulative: dict[_Function, int] = {}
+        own: dict[_Function, int] = {}
+        for stack, count in self.stacks.items():
+            for func in set(stack[skip:]):
+                cumulative[func] = cumulative.get(func, 0) + count
+            own[stack[-1]] = own.get(stack[-1], 0) + count
+        res = sorted(((func, count, own.get(func, 0))
+                      for func, count in cumulative.items()),
+                     key=lambda i : (-i[1], -i[2]))
+        return res if n is None else res[:n]
+
+    # Writes the stacks in the "collapsed" format used by flamegraph.pl and
+    # speedscope.
+    def save(self, filename: str) -> None:
+        with open(filename, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(';'.join(map(format_function, stack)))
+                f.write(f' {count}\n')
+
+def format_function(func: _Function) -> str:
+    filename, lineno, name = func
+    return f'{name} ({os.path.basename(filename)}:{lineno})'
+
+# Samples the current thread (which should be running the event loop) for
+# the specified number of seconds without blocking it.
+async def sample(seconds: float, interval: float = 0.005) -> StackSampler:
+    _acquire('cpu')
+    try:
+        sampler = StackSampler(interval=interval)
+        sampler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            sampler.stop()
+            await asyncio.get_event_loop().run_in_executor(None,
+                sampler.join)
+        return sampler
+    finally:
+        _running.discard('cpu')
+
+# Traces memory allocations for the specified number of seconds. If
+# tracemalloc was already tracing it is left running. The snapshot is taken
+# in an executor (as that copies every trace), and if process is specified it
+# is called with the snapshot there too (for example to save it). Returns the
+# snapshot and the result of process.
+async def trace_memory(seconds: float, nframe: int = 10,
+        process: Optional[Callable[[tracemalloc.Snapshot], _T]] = None) \
+        -> tuple[tracemalloc.Snapshot, Optional[_T]]:
+    _acquire('memory')
+    try:
+        stop = not tracemalloc.is_tracing()
+        if stop:
+            tracemalloc.start(nframe)
+        try:
+            await asyncio.sleep(seconds)
+        except BaseException:
+            if stop:
+                tracemalloc.stop()
+            raise
+        return await asyncio.get_event_loop().run_in_executor(None,
+            _take_snapshot, stop, process)
+    finally:
+        _running.discard('memory')
+
+def _take_snapshot(stop: bool,
+        process: Optional[Callable[[tracemalloc.Snapshot], _T]]) \
+        -> tuple[tracemalloc.Snapshot, Optional[_T]]:
+    try:
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        if stop:
+            tracemalloc.stop()
+    snapshot = snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
+    return snapshot, None if process is None else process(snapshot)
+
+# Returns the n lines that allocated the most memory (that is still in use).
+def top_allocations(snapshot: tracemalloc.Snapshot, n: int = 10) \
+        -> list[tracemalloc.Statistic]:
+    return snapshot.statistics('lineno')[:n]
+
+# Returns a filename like "<directory>/<prefix>-20240101-120000.<ext>",
+# creating the directory if needed.
+def profile_filename(directory: str, prefix: str, ext: str) -> str:
+    os.makedirs(directory, exist_ok=True)
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    return os.path.join(directory, f'{prefix}-{stamp}.{ext}')
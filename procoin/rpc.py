@@ -0,0 +1,526 @@
+# ProCoin economy RPC
+#
+# This lets several bot processes (each handling some of the gateway shards)
+# share one economy. A single ledger process owns the ProCoin object and
+# applies every operation through its Ledger, and bot processes send it
+# operations over a Unix domain socket.
+#
+# Every message is a 4-byte big-endian length followed by a compact JSON
+# array. Requests are [request_id, operation, args] and responses are
+# [request_id, error, result], where error is null or [kind, message]. A
+# request ID of 0 means that no response should be sent. Clients don't have
+# to wait for a response before sending the next request, and the ledger
+# process applies requests in the order they were received.
+#
+# Cogs use an Economy object, which either applies operations in the current
+# process (LocalEconomy) or sends them to a ledger process (RemoteEconomy).
+# Either way the operations are the functions in the operations dict below,
+# so both modes behave the same way.
+
+from __future__ import annotations
+import abc, asyncio, json, os, struct, sys, time, traceback
+from collections.abc import Callable
+from concurrent.futures import Future as _ConcurrentFuture
+from typing import Any, Optional, Union
+from .core import ProCoin
+from .items import Item, ItemInterface
+from .ledger import Ledger
+from .merges import MergeStep
+from .store import Error
+
+_header = struct.Struct('>I')
+
+# The largest message that will be accepted, to stop a broken client from
+# making the ledger process allocate lots of memory.
+max_message_size = 16 * 1024 * 1024
+
+# Raised on the client when an operation fails with something other than an
+# Error in the ledger process. The traceback is printed by the ledger process.
+class RemoteError(Exception):
+    pass
+
+def _encode(message: list[Any]) -> bytes:
+    raw = json.dumps(message, separators=(',', ':')).encode('utf-8')
+    return _header.pack(len(raw)) + raw
+
+async def _read_message(reader: asyncio.StreamReader) -> Any:
+    size, = _header.unpack(await reader.readexactly(_header.size))
+    if size > max_message_size:
+        raise ConnectionError(f'Message too large ({size} bytes)')
+    return json.loads(await reader.readexactly(size))
+
+# Waits for the result of an operation. Operations that finish in another
+# thread (such as saving) may return a concurrent.futures.Future.
+async def _resolve(result: Any) -> Any:
+    if isinstance(result, _ConcurrentFuture):
+        return await asyncio.wrap_future(result)
+    return result
+
+
+# The operations that can be sent to the ledger. These are called with the
+# ProCoin object followed by the arguments, and have to take and return
+# values that can be converted to JSON (items are passed as IDs).
+operations: dict[str, Callable[..., Any]] = {}
+
+def _operation(name: str) \
+        -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    def decorator(func: Callable[..., Any]) -> Callable[..., Any]:
+        operations[name] = func
+        return func
+    return decorator
+
+@_operation('balance')
+def _balance(pc: ProCoin, user_id: str, create: bool) -> Optional[int]:
+    user = pc.users.get_or_create(user_id) if create else \
+        pc.users.find_by_id(user_id)
+    return None if user is None else user.balance
+
+@_operation('boost')
+def _boost(pc: ProCoin, user_id: str, create: bool) -> Optional[int]:
+    user = pc.users.get_or_create(user_id) if create else \
+        pc.users.find_by_id(user_id)
+    return None if user is None else user.boost
+
+@_operation('inventory')
+def _inventory(pc: ProCoin, user_id: str, create: bool) \
+        -> Optional[list[str]]:
+    user = pc.users.get_or_create(user_id) if create else \
+        pc.users.find_by_id(user_id)
+    return None if user is None else user.get_inventory()
+
+@_operation('add_boost')
+def _add_boost(pc: ProCoin, user_id: str, t: float) -> None:
+    user = pc.users.find_by_id(user_id)
+    if user:
+        user.add_boost(t)
+
+@_operation('buy')
+def _buy(pc: ProCoin, user_id: str, item_string: str, qty: int) -> int:
+    return pc.buy(user_id, item_string, qty)
+
+@_operation('sell')
+def _sell(pc: ProCoin, user_id: str, item_string: str, qty: int) -> int:
+    return pc.sell(user_id, item_string, qty)
+
+@_operation('pay')
+def _pay(pc: ProCoin, user_id: str, target_uid: str, amount: int) -> None:
+    pc.pay(user_id, target_uid, amount)
+
+@_operation('give_item')
+def _give_item(pc: ProCoin, user_id: str, target_uid: str, item_string: str,
+        qty: int) -> None:
+    pc.give_item(user_id, target_uid, item_string, qty)
+
+@_operation('add_item')
+def _add_item(pc: ProCoin, user_id: str, item_id: str, qty: int) -> None:
+    pc.add_item(user_id, pc.items.get_item(item_id), qty)
+
+@_operation('merge')
+def _merge(pc: ProCoin, user_id: str, item_strings: list[str],
+        amount: int) -> tuple[str, str]:
+    names, result = pc.merge(user_id, item_strings, amount)
+    return names, result.id
+
+@_operation('possible_merges')
+def _possible_merges(pc: ProCoin, user_id: str) \
+        -> list[tuple[list[str], str, int]]:
+    return [([item.id for item in recipe], result.id, amount)
+            for recipe, result, amount in pc.possible_merges(user_id)]
+
+@_operation('plan_merges')
+def _plan_merges(pc: ProCoin, user_id: str, item_string: str, amount: int) \
+        -> tuple[str, Optional[list[tuple[list[str], str, int]]]]:
+    target, steps = pc.plan_merges(user_id, item_string, amount)
+    if steps is None:
+        return target.id, None
+    return target.id, [([item.id for item in recipe], result.id, n)
+                       for recipe, result, n in steps]
+
+@_operation('remove_curse')
+def _remove_curse(pc: ProCoin, user_id: str) -> tuple[str, Optional[str]]:
+    item, removed_item = pc.remove_curse(user_id)
+    return item.id, removed_item and removed_item.id
+
+@_operation('leaderboard')
+def _leaderboard(pc: ProCoin, kind: str, n: int) -> list[tuple[str, int]]:
+    return pc.leaderboard(kind, n)
+
+@_operation('rank')
+def _rank(pc: ProCoin, kind: str, user_id: str) \
+        -> Optional[tuple[int, int, int]]:
+    return pc.rank(kind, user_id)
+
+@_operation('store')
+def _store(pc: ProCoin) -> tuple[str, float]:
+    return pc.store.store_string, pc.store.last_update
+
+# Returns the economy stats and the IDs and counts of the n most common items.
+@_operation('economy_stats')
+def _economy_stats(pc: ProCoin, n: int) \
+        -> tuple[dict[str, int], list[tuple[str, int]]]:
+    return pc.economy_stats(), [(item.id, count)
+                                for item, count in pc.top_items(n)]
+
+# Saves the users, takes a snapshot (both in another thread) and regenerates
+# the store.
+@_operation('restock')
+def _restock(pc: ProCoin) -> None:
+    pc.save_user_file()
+    pc.take_snapshot()
+    pc.store.regenerate_store()
+
+# Returns the number of added, removed and changed items.
+@_operation('reload_items')
+def _reload_items(pc: ProCoin) -> tuple[int, int, int]:
+    changes = pc.reload_items()
+    return len(changes.added), len(changes.removed), len(changes.changed)
+
+@_operation('save')
+def _save(pc: ProCoin) -> _ConcurrentFuture[None]:
+    return pc.save_user_file()
+
+
+# The interface cogs use to access the economy. Items are converted to and
+# from IDs using the local item catalog.
+class Economy(abc.ABC):
+    __slots__ = ('items',)
+
+    def __init__(self, items: ItemInterface) -> None:
+        self.items = items
+
+    # Applies an operation and returns its result.
+    @abc.abstractmethod
+    async def _call(self, name: str, *args: Any) -> Any:
+        pass
+
+    # Applies an operation without waiting for it to complete.
+    @abc.abstractmethod
+    def _post(self, name: str, *args: Any) -> None:
+        pass
+
+    def _get_items(self, item_ids: list[str]) -> tuple[Item, ...]:
+        return tuple(self.items.get_item(item_id) for item_id in item_ids)
+
+    # Returns None if the user doesn't exist and create is False.
+    async def balance(self, user_id: Union[str, int],
+            create: bool = False) -> Optional[int]:
+        return await self._call('balance', str(user_id), create)
+
+    async def boost(self, user_id: Union[str, int],
+            create: bool = False) -> Optional[int]:
+        return await self._call('boost', str(user_id), create)
+
+    # Returns the user's inventory pages (see User.get_inventory).
+    async def inventory(self, user_id: Union[str, int],
+            create: bool = False) -> Optional[list[str]]:
+        return await self._call('inventory', str(user_id), create)
+
+    # Adds the boost to a user (if it's been long enough, see
+    # User.add_boost). This doesn't wait for the boost to be added.
+    def add_boost(self, user_id: Union[str, int], t: float) -> None:
+        self._post('add_boost', str(user_id), t)
+
+    async def buy(self, user_id: Union[str, int], item_string: str,
+            qty: int) -> int:
+        return await self._call('buy', str(user_id), item_string, qty)
+
+    async def sell(self, user_id: Union[str, int], item_string: str,
+            qty: int) -> int:
+        return await self._call('sell', str(user_id), item_string, qty)
+
+    async def pay(self, user_id: Union[str, int], target_uid: Union[str, int],
+            amount: int) -> None:
+        await self._call('pay', str(user_id), str(target_uid), amount)
+
+    async def give_item(self, user_id: Union[str, int],
+            target_uid: Union[str, int], item_string: str, qty: int) -> None:
+        await self._call('give_item', str(user_id), str(target_uid),
+                         item_string, qty)
+
+    async def add_item(self, user_id: Union[str, int], item: Item,
+            qty: int) -> None:
+        await self._call('add_item', str(user_id), item.id, qty)
+
+    async def merge(self, user_id: Union[str, int], item_strings: list[str],
+            amount: int) -> tuple[str, Item]:
+        names, result_id = await self._call('merge', str(user_id),
+                                            item_strings, amount)
+        return names, self.items.get_item(result_id)
+
+    async def possible_merges(self, user_id: Union[str, int]) \
+            -> list[MergeStep]:
+        return [(self._get_items(recipe), self.items.get_item(result), amount)
+                for recipe, result, amount
+                in await self._call('possible_merges', str(user_id))]
+
+    async def plan_merges(self, user_id: Union[str, int], item_string: str,
+            amount: int = 1) -> tuple[Item, Optional[list[MergeStep]]]:
+        target_id, steps = await self._call('plan_merges', str(user_id),
+                                            item_string, amount)
+        target = self.items.get_item(target_id)
+        if steps is None:
+            return target, None
+        return target, [(self._get_items(recipe),
+                         self.items.get_item(result), n)
+                        for recipe, result, n in steps]
+
+    async def remove_curse(self, user_id: Union[str, int]) \
+            -> tuple[Item, Optional[Item]]:
+        item_id, removed_id = await self._call('remove_curse', str(user_id))
+        return (self.items.get_item(item_id),
+                self.items.get_item(removed_id) if removed_id else None)
+
+    async def leaderboard(self, kind: str, n: int) -> list[tuple[str, int]]:
+        return [(user_id, score) for user_id, score
+                in await self._call('leaderboard', kind, n)]
+
+    async def rank(self, kind: str, user_id: Union[str, int]) \
+            -> Optional[tuple[int, int, int]]:
+        res = await self._call('rank', kind, str(user_id))
+        return None if res is None else tuple(res)
+
+    # Returns the store string and the time the store was last regenerated.
+    async def store(self) -> tuple[str, float]:
+        store_string, last_update = await self._call('store')
+        return store_string, last_update
+
+    # Returns the economy stats (see ProCoin.economy_stats) and the n items
+    # users have the most of.
+    async def economy_stats(self, n: int = 5) \
+            -> tuple[dict[str, int], list[tuple[Item, int]]]:
+        stats, top_items = await self._call('economy_stats', n)
+        return stats, [(self.items.get_item(item_id), count)
+                       for item_id, count in top_items]
+
+    async def restock(self) -> None:
+        await self._call('restock')
+
+    # Reloads the item catalog in the ledger (see ProCoin.reload_items).
+    # Returns the number of added, removed and changed items.
+    async def reload_items(self) -> tuple[int, int, int]:
+        added, removed, changed = await self._call('reload_items')
+        return added, removed, changed
+
+    # Waits for the users to be saved.
+    async def save(self) -> None:
+        await self._call('save')
+
+    def close(self) -> None:
+        pass
+
+# Applies operations to a ProCoin object in the current process.
+class LocalEconomy(Economy):
+    __slots__ = ('pc', 'ledger')
+
+    def __init__(self, pc: ProCoin, ledger: Ledger) -> None:
+        super().__init__(pc.items)
+        self.pc = pc
+        self.ledger = ledger
+
+    async def _call(self, name: str, *args: Any) -> Any:
+        return await _resolve(await self.ledger.call(operations[name],
+                                                     self.pc, *args))
+
+    def _post(self, name: str, *args: Any) -> None:
+        self.ledger.post(operations[name], self.pc, *args)
+
+    # Applies any pending operations, see Ledger.close().
+    def close(self) -> None:
+        self.ledger.close()
+
+# Sends operations to a ledger process. The connection is made when the
+# first operation is sent, and is remade if it is lost.
+class RemoteEconomy(Economy):
+    __slots__ = ('client',)
+
+    def __init__(self, path: str, items: ItemInterface) -> None:
+        super().__init__(items)
+        self.client = LedgerClient(path)
+
+    async def _call(self, name: str, *args: Any) -> Any:
+        return await self.client.call(name, *args)
+
+    def _post(self, name: str, *args: Any) -> None:
+        self.client.post(name, *args)
+
+    def close(self) -> None:
+        self.client.close()
+
+
+# A connection to a ledger process. Requests are pipelined, so call() can be
+# used from lots of tasks at once without waiting for each other.
+class LedgerClient:
+    __slots__ = ('path', '_writer', '_connecting', '_buffer', '_pending',
+                 '_next_id', '_task')
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._connecting: bool = False
+
+        # Messages sent while connecting.
+        self._buffer: list[bytes] = []
+
+        # Futures for requests that haven't been responded to yet.
+        self._pending: dict[int, asyncio.Future[Any]] = {}
+        self._next_id: int = 1
+        self._task: Optional[asyncio.Future[None]] = None
+
+    def _send(self, message: bytes) -> None:
+        if self._writer is not None:
+            self._writer.write(message)
+            return
+
+        self._buffer.append(message)
+        if not self._connecting:
+            self._connecting = True
+            self._task = asyncio.ensure_future(self._run())
+
+    # Sends an operation and returns the result. Errors raised by the
+    # operation are raised here.
+    async def call(self, name: str, *args: Any) -> Any:
+        request_id = self._next_id
+        self._next_id += 1
+        future = self._pending[request_id] = \
+            asyncio.get_event_loop().create_future()
+        self._send(_encode([request_id, name, args]))
+        return await future
+
+    # Sends an operation without waiting for (or getting) a response.
+    def post(self, name: str, *args: Any) -> None:
+        self._send(_encode([0, name, args]))
+
+    # Any exception (including an invalid response) drops the connection, so
+    # pending requests never wait forever.
+    async def _run(self) -> None:
+        try:
+            reader, writer = await asyncio.open_unix_connection(self.path)
+        except OSError as exc:
+            self._disconnected(exc)
+            return
+
+        self._writer = writer
+        self._connecting = False
+        try:
+            writer.write(b''.join(self._buffer))
+            self._buffer.clear()
+            while True:
+                request_id, error, result = await _read_message(reader)
+                future = self._pending.pop(request_id, None)
+                if future is None or future.cancelled():
+                    continue
+                if error is None:
+                    future.set_result(result)
+                elif error[0] == 'Error':
+                    future.set_exception(Error(error[1]))
+                else:
+                    future.set_exception(RemoteError(f'{error[0]}: '
+                                                     f'{error[1]}'))
+        except (asyncio.IncompleteReadError, ConnectionError) as exc:
+            self._disconnected(exc)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            traceback.print_exc()
+            self._disconnected(exc)
+        finally:
+            writer.close()
+
+    # Fails every pending request, the next request will reconnect.
+    def _disconnected(self, exc: BaseException) -> None:
+        self._writer = None
+        self._connecting = False
+        self._buffer.clear()
+        pending = self._pending
+        self._pending = {}
+        for future in pending.values():
+            if not future.cancelled():
+                future.set_exception(ConnectionError(
+                    f'Lost connection to the ledger: {exc}'))
+
+    def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._writer is not None:
+            self._writer.close()
+        self._disconnected(ConnectionError('The client was closed'))
+
+
+# The ledger process side. Every request is applied through the Ledger, so
+# requests from all connected bot processes are applied one at a time.
+class LedgerServer:
+    __slots__ = ('pc', 'ledger', 'requests')
+
+    def __init__(self, pc: ProCoin, ledger: Ledger) -> None:
+        self.pc = pc
+        self.ledger = ledger
+        self.requests: int = 0
+
+    # Starts listening on a Unix domain socket, replacing any stale socket
+    # file.
+    async def start(self, path: str) -> asyncio.AbstractServer:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return await asyncio.start_unix_server(self._handle_client, path)
+
+    # Responses are written from callbacks, so after each request this waits
+    # for the responses to be sent if the client isn't reading them fast
+    # enough. This stops a slow client from making the write buffer grow
+    # forever.
+    async def _handle_client(self, reader: asyncio.StreamReader,
+            writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                await writer.drain()
+                request_id, name, args = await _read_message(reader)
+                self.requests += 1
+                func = operations.get(name)
+                if func is None:
+                    if request_id:
+                        writer.write(_encode([request_id, ['Error',
+                            f'Unknown operation: {name!r}'], None]))
+                elif request_id:
+                    future = self.ledger.submit(func, self.pc, *args)
+                    future.add_done_callback(
+                        lambda future, request_id=request_id :
+                            self._respond(writer, request_id, future))
+                else:
+                    self.ledger.post(func, self.pc, *args)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except (ValueError, TypeError) as exc:
+            print(f'WARNING: Closing connection after an invalid request: '
+                  f'{exc}', file=sys.stderr)
+        finally:
+            writer.close()
+
+    # Sends the result of an operation. If the operation returned a
+    # concurrent.futures.Future, the response is sent once that completes.
+    def _respond(self, writer: asyncio.StreamWriter, request_id: int,
+            future: asyncio.Future[Any]) -> None:
+        error: Optional[list[str]] = None
+        result: Any = None
+        try:
+            result = future.result()
+            if isinstance(result, _ConcurrentFuture):
+                asyncio.wrap_future(result).add_done_callback(
+                    lambda future : self._respond(writer, request_id, future))
+                return
+        except Error as exc:
+            error = ['Error', str(exc)]
+        except Exception as exc:
+            traceback.print_exception(type(exc), exc, exc.__traceback__)
+            error = [type(exc).__name__, str(exc)]
+
+        if not writer.is_closing():
+            writer.write(_encode([request_id, error, result]))
+
+    # Saves the users and regenerates the store every hour.
+    async def run_store_loop(self) -> None:
+        while True:
+            await self.ledger.call(_restock, self.pc)
+            await asyncio.sleep(max(self.pc.store.last_update + 3600 -
+                                    time.time(), 0))
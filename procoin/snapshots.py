@@ -0,0 +1,366 @@
+# Compressed, checksummed snapshots of the users
+#
+# The storage backends only keep the latest copy of the users, so a corrupt
+# save can't be undone. SnapshotManager keeps a rotating set of snapshots
+# (a number of hourly and daily ones), and a snapshot can be verified and
+# restored without reading the whole thing into memory.
+#
+# A snapshot file contains:
+#
+#   magic (8 bytes), metadata size (u32), metadata (JSON)
+#   the users file (saved with one of db.codecs), compressed with zlib or lzma
+#   the SHA-256 hash (32 bytes) and size (u64) of the uncompressed users file
+#
+# The metadata includes a hash of the item catalog the snapshot was taken
+# with, as restoring users with a different catalog would lose any items that
+# no longer exist.
+#
+# Restoring a snapshot replaces the users file and moves the shard directory
+# and journal aside, so it must only be done while the bot is stopped.
+#
+# Usage:
+#   python3 -m procoin.snapshots list <directory>
+#   python3 -m procoin.snapshots verify <snapshot>...
+#   python3 -m procoin.snapshots restore <snapshot or directory> <users file>
+
+from __future__ import annotations
+import argparse, calendar, glob, hashlib, io, json, lzma, os, struct
+import tempfile, time, zlib
+from collections.abc import Callable, Iterator, Mapping, MutableMapping
+from concurrent.futures import Future
+from typing import Any, BinaryIO, Optional
+from . import db
+from .items import ItemInterface
+from .storage import JSONStorage, sqlite_extensions
+from .users import UserInterface
+
+magic = b'PCSNAP\0\0'
+version = 1
+
+_u32 = struct.Struct('<I')
+_trailer = struct.Struct('<32sQ')
+_chunk_size = 1 << 20
+_time_format = '%Y%m%d-%H%M%S'
+
+_compressors: dict[str, Callable[[], Any]] = {
+    'zlib': zlib.compressobj,
+    'lzma': lzma.LZMACompressor,
+}
+_decompressors: dict[str, Callable[[], Any]] = {
+    'zlib': zlib.decompressobj,
+    'lzma': lzma.LZMADecompressor,
+}
+
+class SnapshotError(Exception):
+    pass
+
+# A hash of the item catalog that doesn't depend on the formatting of
+# items.json.
+def catalog_hash(items: ItemInterface) -> str:
+    data = {item_id: item.to_dict() for item_id, item in items.items.items()}
+    raw = json.dumps(data, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+class SnapshotInfo:
+    __slots__ = ('filename', 'created', 'catalog_hash', 'users', 'codec',
+                 'compression', 'body_offset')
+
+    def __init__(self, filename: str, metadata: dict[str, Any],
+            body_offset: int) -> None:
+        self.filename = filename
+        self.created: float = metadata['created']
+        self.catalog_hash: str = metadata['catalog_hash']
+        self.users: int = metadata['users']
+        self.codec: str = metadata['codec']
+        self.compression: str = metadata['compression']
+        self.body_offset = body_offset
+
+    def __repr__(self) -> str:
+        return f'<SnapshotInfo {self.filename!r}>'
+
+def _read_info(f: BinaryIO, filename: str) -> SnapshotInfo:
+    header = f.read(len(magic) + _u32.size)
+    if len(header) < len(magic) + _u32.size or not header.startswith(magic):
+        raise SnapshotError(f'{filename!r} is not a snapshot')
+    size, = _u32.unpack_from(header, len(magic))
+    try:
+        metadata = json.loads(f.read(size))
+        if metadata['version'] != version:
+            raise SnapshotError(f'{filename!r} has an unsupported version')
+        return SnapshotInfo(filename, metadata, len(header) + size)
+    except (ValueError, KeyError, TypeError) as exc:
+        raise SnapshotError(f'{filename!r} has invalid metadata') from exc
+
+def read_info(filename: str) -> SnapshotInfo:
+    with open(filename, 'rb') as f:
+        return _read_info(f, filename)
+
+# Yields the uncompressed users file in chunks. SnapshotError is raised
+# (after the last chunk) if the snapshot is truncated or the checksum doesn't
+# match, so callers must not use the data until the iterator is exhausted.
+def _iter_body(f: BinaryIO, info: SnapshotInfo) -> Iterator[bytes]:
+    decompressor_factory = _decompressors.get(info.compression)
+    if decompressor_factory is None:
+        raise SnapshotError(f'Unknown compression: {info.compression!r}')
+    decompressor = decompressor_factory()
+
+    end = f.seek(0, os.SEEK_END) - _trailer.size
+    pos = info.body_offset
+    if end < pos:
+        raise SnapshotError(f'{info.filename!r} is truncated')
+    f.seek(pos)
+
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        while pos < end:
+            chunk = f.read(min(_chunk_size, end - pos))
+            if not chunk:
+                raise SnapshotError(f'{info.filename!r} is truncated')
+            pos += len(chunk)
+            data = decompressor.decompress(chunk)
+            if data:
+                digest.update(data)
+                size += len(data)
+                yield data
+        # zlib decompressors may have some data left.
+        flush = getattr(decompressor, 'flush', None)
+        if flush is not None:
+            data = flush()
+            if data:
+                digest.update(data)
+                size += len(data)
+                yield data
+        complete: bool = decompressor.eof
+    except (zlib.error, lzma.LZMAError) as exc:
+        raise SnapshotError(f'{info.filename!r} is corrupt: {exc}') from exc
+
+    expected_digest, expected_size = _trailer.unpack(f.read(_trailer.size))
+    if not complete or size != expected_size or \
+            digest.digest() != expected_digest:
+        raise SnapshotError(f'{info.filename!r} failed the checksum')
+
+# Checks that a snapshot can be decompressed and that its checksum matches.
+# Raises SnapshotError if it doesn't.
+def verify(filename: str) -> SnapshotInfo:
+    with open(filename, 'rb') as f:
+        info = _read_info(f, filename)
+        for _ in _iter_body(f, info):
+            pass
+    return info
+
+# Restores a snapshot to the users file of a JSON storage backend. The old
+# users file, shard directory and journal are moved into a new directory
+# (which is returned), so the restore can be undone. The snapshot is verified
+# before anything is moved.
+def restore(filename: str, storage: JSONStorage) -> str:
+    users_dir = os.path.dirname(storage.filename) or '.'
+    with open(filename, 'rb') as f:
+        info = _read_info(f, filename)
+        with tempfile.NamedTemporaryFile('wb', dir=users_dir,
+                                         delete=False) as tmp:
+            try:
+                for chunk in _iter_body(f, info):
+                    tmp.write(chunk)
+            except BaseException:
+                tmp.close()
+                os.remove(tmp.name)
+                raise
+
+    backup = (f'{storage.dirname}.before-restore-'
+              f'{time.strftime(_time_format, time.gmtime())}')
+    os.mkdir(backup)
+    old_files = [storage.filename, storage.dirname]
+    old_files.extend(glob.glob(glob.escape(storage.journal_filename) + '*'))
+    for fn in old_files:
+        if os.path.exists(fn):
+            os.replace(fn, os.path.join(backup, os.path.basename(fn)))
+    os.replace(tmp.name, storage.filename)
+    return backup
+
+# Creates the snapshot file in the writer thread (see db.save()). Snapshots
+# can also be loaded with this, in which case the metadata isn't used.
+class _SnapshotCodec(db.Codec):
+    __slots__ = ('metadata',)
+
+    def __init__(self, metadata: dict[str, Any]) -> None:
+        self.metadata = metadata
+
+    def loads(self, raw: bytes) -> MutableMapping[str, Any]:
+        f = io.BytesIO(raw)
+        info = _read_info(f, '<snapshot>')
+        body = b''.join(_iter_body(f, info))
+        return db.codecs[info.codec].loads(body)
+
+    def dumps(self, data: Mapping[str, Any]) -> bytes:
+        body = db.codecs[self.metadata['codec']].dumps(data)
+        compressor = _compressors[self.metadata['compression']]()
+        raw_metadata = json.dumps(self.metadata).encode('utf-8')
+        return b''.join((magic, _u32.pack(len(raw_metadata)), raw_metadata,
+                         compressor.compress(body), compressor.flush(),
+                         _trailer.pack(hashlib.sha256(body).digest(),
+                                       len(body))))
+
+# Takes snapshots and deletes old ones. The newest snapshot in each of the
+# last keep_hourly hours and keep_daily days (in UTC) is kept.
+class SnapshotManager:
+    __slots__ = ('directory', 'keep_hourly', 'keep_daily', 'codec',
+                 'compression')
+
+    def __init__(self, directory: str, *, keep_hourly: int = 24,
+            keep_daily: int = 14, codec: str = 'json',
+            compression: str = 'zlib') -> None:
+        if codec not in db.codecs:
+            raise ValueError(f'Unknown codec: {codec!r}')
+        if compression not in _compressors:
+            raise ValueError(f'Unknown compression: {compression!r}')
+        self.directory = directory
+        self.keep_hourly = keep_hourly
+        self.keep_daily = keep_daily
+        self.codec = codec
+        self.compression = compression
+
+    # Takes a snapshot of the users. Only a cheap copy of the users is made
+    # here, the snapshot is serialised, compressed and written in the writer
+    # thread, and old snapshots are deleted afterwards.
+    def take(self, users: UserInterface, items: ItemInterface) \
+            -> Future[None]:
+        now = time.time()
+        metadata = {
+            'version': version,
+            'created': now,
+            'catalog_hash': catalog_hash(items),
+            'users': len(users),
+            'codec': self.codec,
+            'compression': self.compression,
+        }
+        stamp = time.strftime(_time_format, time.gmtime(now))
+        filename = os.path.join(self.directory,
+                                f'users-{stamp}-{int(now * 1000) % 1000:03}'
+                                f'.snap')
+        return db.save(filename, users.frozen_copy(), self.prune,
+                       codec=_SnapshotCodec(metadata))
+
+    # Returns the filenames and creation times of every snapshot, newest
+    # first. The times come from the filenames, so this doesn't need to open
+    # the snapshots.
+    def _list(self) -> list[tuple[str, float]]:
+        res: list[tuple[str, float]] = []
+        for fn in glob.glob(os.path.join(glob.escape(self.directory),
+                                         'users-*-*-*.snap')):
+            name = os.path.basename(fn)[6:-5]
+            try:
+                created = calendar.timegm(time.strptime(name[:15],
+                                                        _time_format))
+                created += int(name[16:]) / 1000
+            except ValueError:
+                continue
+            res.append((fn, created))
+        res.sort(key=lambda i : i[1], reverse=True)
+        return res
+
+    # Returns information about every readable snapshot, newest first.
+    def snapshots(self) -> list[SnapshotInfo]:
+        res: list[SnapshotInfo] = []
+        for fn, _ in self._list():
+            try:
+                res.append(read_info(fn))
+            except (OSError, SnapshotError):
+                pass
+        return res
+
+    # Returns the newest snapshot that passes verify(), or None.
+    def latest_valid(self) -> Optional[SnapshotInfo]:
+        for fn, _ in self._list():
+            try:
+                return verify(fn)
+            except (OSError, SnapshotError):
+                print(f'WARNING: Skipping invalid snapshot {fn!r}')
+        return None
+
+    # Deletes snapshots that the rotation policy doesn't keep and returns
+    # their filenames. The newest snapshot is always kept.
+    def prune(self) -> list[str]:
+        hours: set[int] = set()
+        days: set[int] = set()
+        removed: list[str] = []
+        for i, (fn, created) in enumerate(self._list()):
+            hour = int(created // 3600)
+            day = hour // 24
+            keep = i == 0
+            if hour not in hours and len(hours) < self.keep_hourly:
+                hours.add(hour)
+                keep = True
+            if day not in days and len(days) < self.keep_daily:
+                days.add(day)
+                keep = True
+            if not keep:
+                os.remove(fn)
+                removed.append(fn)
+        return removed
+
+def _format_time(t: float) -> str:
+    return time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(t))
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    list_parser = subparsers.add_parser('list')
+    list_parser.add_argument('directory')
+    verify_parser = subparsers.add_parser('verify')
+    verify_parser.add_argument('snapshots', nargs='+')
+    restore_parser = subparsers.add_parser('restore')
+    restore_parser.add_argument('snapshot', help='The snapshot to restore. '
+                                'If this is a directory, the newest valid '
+                                'snapshot in it is restored.')
+    restore_parser.add_argument('users', help='The users file (for '
+                                'example users.json) to replace.')
+    restore_parser.add_argument('--items', help='Warn if the snapshot was '
+                                'taken with a different item catalog.')
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        for info in SnapshotManager(args.directory).snapshots():
+            print(f'{info.filename}: {_format_time(info.created)}, '
+                  f'{info.users:,} users, catalog {info.catalog_hash[:12]}')
+    elif args.command == 'verify':
+        failed = False
+        for fn in args.snapshots:
+            try:
+                verify(fn)
+            except (OSError, SnapshotError) as exc:
+                print(f'{fn}: FAILED ({exc})')
+                failed = True
+            else:
+                print(f'{fn}: OK')
+        if failed:
+            raise SystemExit(1)
+    else:
+        if os.path.isdir(args.snapshot):
+            info = SnapshotManager(args.snapshot).latest_valid()
+            if info is None:
+                raise SystemExit('No valid snapshots found')
+        else:
+            info = read_info(args.snapshot)
+
+        if args.items:
+            items = ItemInterface.from_dict(db.load(args.items))
+            if catalog_hash(items) != info.catalog_hash:
+                print('WARNING: The snapshot was taken with a different item '
+                      'catalog, users will lose any items that no longer '
+                      'exist.')
+
+        # Don't open the storage backend, as that would create the database
+        # if it's an SQLite one.
+        if os.path.splitext(args.users)[1] in sqlite_extensions:
+            raise SystemExit('Snapshots can only be restored to JSON or '
+                             'binary users files')
+        storage = JSONStorage(args.users)
+        backup = restore(info.filename, storage)
+        print(f'Restored {info.filename} ({_format_time(info.created)}, '
+              f'{info.users:,} users) to {args.users}')
+        print(f'The old users file, shards and journal were moved to '
+              f'{backup}')
+
+if __name__ == '__main__':
+    main()
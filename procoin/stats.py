@@ -0,0 +1,116 @@
+# Running totals for the whole economy. These are updated by the code that
+# modifies users (see procoin.users) so that getting them doesn't need a scan
+# of every user.
+
+from __future__ import annotations
+import heapq
+from collections.abc import Iterable
+from typing import Optional
+from .items import Item, ItemInterface
+
+class EconomyStats:
+    __slots__ = ('users', 'money_supply', 'item_counts',
+                 'items_in_circulation', 'item_boost', 'item_value',
+                 'boost_payouts', 'boost_paid')
+
+    def __init__(self) -> None:
+        self.users: int = 0
+        self.money_supply: int = 0
+
+        # The total amount of each item (by ID) that users have.
+        self.item_counts: dict[str, int] = {}
+        self.items_in_circulation: int = 0
+
+        # The total boost and cost of every item users have.
+        self.item_boost: int = 0
+        self.item_value: int = 0
+
+        # Boosts paid out since the stats were created (see User.add_boost).
+        # These can't be worked out from the users.
+        self.boost_payouts: int = 0
+        self.boost_paid: int = 0
+
+    # Every user has a base boost of 1.
+    @property
+    def total_boost(self) -> int:
+        return self.users + self.item_boost
+
+    def add_user(self, balance: int) -> None:
+        self.users += 1
+        self.money_supply += balance
+
+    def add_item(self, item: Item, qty: int) -> None:
+        self.item_counts[item.id] = self.item_counts.get(item.id, 0) + qty
+        self.items_in_circulation += qty
+        self.item_boost += item.boost * qty
+        self.item_value += item.cost * qty
+
+    def remove_item(self, item: Item, qty: int) -> None:
+        count = self.item_counts[item.id] - qty
+        if count:
+            self.item_counts[item.id] = count
+        else:
+            del self.item_counts[item.id]
+        self.items_in_circulation -= qty
+        self.item_boost -= item.boost * qty
+        self.item_value -= item.cost * qty
+
+    # Updates the totals after an item's boost or cost changes.
+    def item_changed(self, item: Item, old_boost: int, old_cost: int) -> None:
+        count = self.item_counts.get(item.id, 0)
+        self.item_boost += (item.boost - old_boost) * count
+        self.item_value += (item.cost - old_cost) * count
+
+    # Forgets about an item that was removed from the catalog (users lose
+    # removed items).
+    def item_removed(self, item: Item) -> None:
+        count = self.item_counts.pop(item.id, 0)
+        self.items_in_circulation -= count
+        self.item_boost -= item.boost * count
+        self.item_value -= item.cost * count
+
+    # Calculates the stats from scratch. records should contain a
+    # (user_id, balance, inventory) tuple for every user (see
+    # UserInterface.records). Unknown items are ignored.
+    @classmethod
+    def from_records(cls, ii: ItemInterface,
+            records: Iterable[tuple[str, int, dict[str, int]]]) \
+            -> EconomyStats:
+        self = cls()
+        known_items = ii.items
+        for _, balance, inventory in records:
+            self.add_user(balance)
+            for item_id, qty in inventory.items():
+                item = known_items.get(item_id)
+                if item is not None and qty > 0:
+                    self.add_item(item, qty)
+        return self
+
+    # Returns a list of differences between these stats and other (which
+    # should be calculated with from_records()), or an empty list if they
+    # match. Boost payouts aren't compared.
+    def compare(self, other: EconomyStats) -> list[str]:
+        res: list[str] = []
+        for attr in ('users', 'money_supply', 'items_in_circulation',
+                     'item_boost', 'item_value'):
+            value: int = getattr(self, attr)
+            expected: int = getattr(other, attr)
+            if value != expected:
+                res.append(f'{attr}: {value} != {expected}')
+        for item_id in self.item_counts.keys() | other.item_counts.keys():
+            value = self.item_counts.get(item_id, 0)
+            expected = other.item_counts.get(item_id, 0)
+            if value != expected:
+                res.append(f'item_counts[{item_id!r}]: {value} != '
+                           f'{expected}')
+        return res
+
+    # Returns the n items with the highest counts as (item_id, count) tuples.
+    # Items with the same count are sorted by ID.
+    def top_items(self, n: Optional[int] = None) -> list[tuple[str, int]]:
+        key = lambda i : (-i[1], i[0])
+        if n is None:
+            return sorted(self.item_counts.items(), key=key)
+
+        # Only the top n items have to be sorted.
+        return heapq.nsmallest(n, self.item_counts.items(), key=key)
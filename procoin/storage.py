@@ -0,0 +1,289 @@
+# ProCoin storage backends
+#
+# A storage backend loads a UserInterface, persists the changes made by
+# UserInterface.transaction() and periodically saves any other modified users.
+
+from __future__ import annotations
+import abc, os, sqlite3, threading
+from collections.abc import Iterable, MutableMapping
+from concurrent.futures import Future
+from typing import Any, Optional, Union
+from . import db
+from .store import Store as _Store
+from .users import InventorySnapshot, User, UserInterface
+
+# The state of a user before a transaction: (user, balance, inventory).
+# This Union[] is a hack to keep Python 3.7 and 3.8 support.
+UserState = Union['tuple[User, int, InventorySnapshot]']
+
+class Storage(abc.ABC):
+    __slots__ = ()
+
+    @abc.abstractmethod
+    def load_users(self, store: _Store) -> UserInterface:
+        pass
+
+    # Persists the changes made in a transaction. If this raises an exception
+    # the in-memory changes are rolled back.
+    def commit(self, states: Iterable[UserState]) -> None:
+        pass
+
+    # Saves any modified users. This may return before the save completes,
+    # the returned Future is resolved once everything has been written.
+    def save(self, users: UserInterface) -> Future[None]:
+        return db.completed_future()
+
+    def save_blocking(self, users: UserInterface) -> None:
+        self.save(users).result()
+
+    def close(self) -> None:
+        pass
+
+
+# Users are stored in a directory of shard files and transactions are written
+# to a journal. users.json is only loaded if the shard directory doesn't exist
+# yet. Shards are saved with codec (see db.codecs), however files saved with
+# any codec can be loaded.
+class JSONStorage(Storage):
+    __slots__ = ('filename', 'dirname', 'journal_filename', 'journal',
+                 'codec', '_lock', '_unsaved', '_failures')
+
+    def __init__(self, filename: str, codec: str = 'json') -> None:
+        if codec not in db.codecs:
+            raise ValueError(f'Unknown codec: {codec!r}')
+        self.filename = filename
+        self.dirname = os.path.splitext(filename)[0] + '.d'
+        self.journal_filename = filename + '.journal'
+        self.journal: Optional[db.Journal] = None
+        self.codec = codec
+
+        # The IDs of users whose save failed (which are marked as modified
+        # again on the next save) and the number of failed saves. These are
+        # updated in the writer thread, so they are protected by _lock.
+        self._lock = threading.Lock()
+        self._unsaved: set[str] = set()
+        self._failures: int = 0
+
+    # Loads the raw users. Also returns the IDs of users that aren't saved in
+    # the shard files yet. This doesn't touch the journal, so it can be used
+    # while the bot is running.
+    def load_raw(self) -> tuple[MutableMapping[str, Any], Iterable[str]]:
+        # Make sure the shard directory is up to date before checking it
+        # exists.
+        db.flush(self.dirname)
+        legacy = not os.path.isdir(self.dirname)
+        if legacy:
+            data = db.load_users(self.filename)
+        else:
+            data = db.load_shards(self.dirname)
+        replayed = db.replay_journal(self.journal_filename, data)
+
+        # Write every shard on the next save if the users were loaded from
+        # users.json, otherwise only write users changed by the journal.
+        return data, (data if legacy else replayed)
+
+    def load_users(self, store: _Store) -> UserInterface:
+        data, dirty = self.load_raw()
+        users = UserInterface.from_dict(store, data, self, lazy=True)
+        users.dirty.update(dirty)
+
+        if self.journal:
+            self.journal.close()
+        self.journal = db.Journal(self.journal_filename)
+        return users
+
+    def commit(self, states: Iterable[UserState]) -> None:
+        if self.journal:
+            for user, _, _ in states:
+                self.journal.append(user.id, user.balance,
+                                    user._get_touched_items())
+
+    # Saves any shards containing modified users in the writer thread. Once
+    # the shards are saved, the journal entries they contain are discarded.
+    # If the save fails, the journal is kept and the users are saved again
+    # the next time this is called.
+    def save(self, users: UserInterface) -> Future[None]:
+        journal = self.journal
+        assert journal is not None
+        with self._lock:
+            users.dirty.update(self._unsaved)
+            self._unsaved.clear()
+            failures = self._failures
+
+        generation = journal.rotate()
+        user_ids = set(users.dirty)
+        shards = users.dirty_shards_to_dict()
+
+        def saved() -> None:
+            # The journal can only be discarded completely if every failed
+            # save was included in this one.
+            with self._lock:
+                if self._failures == failures:
+                    journal.release()
+            journal.discard(generation)
+
+        def failed(exc: BaseException) -> None:
+            with self._lock:
+                self._unsaved.update(user_ids)
+                self._failures += 1
+                journal.retain()
+
+        return db.save_shards(self.dirname, shards, saved, codec=self.codec,
+                              errback=failed)
+
+    def close(self) -> None:
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+
+
+# Users are stored in an SQLite database in WAL mode. Every transaction is
+# written to the database immediately, and save() only writes users modified
+# outside of transactions (for example boosts).
+class SQLiteStorage(Storage):
+    __slots__ = ('filename', 'import_from', 'conn')
+
+    # If the database is empty and import_from is specified, users are
+    # imported from that JSON file.
+    def __init__(self, filename: str, import_from: Optional[str] = None) \
+            -> None:
+        self.filename = filename
+        self.import_from = import_from
+
+        # isolation_level=None stops the sqlite3 module from starting
+        # transactions implicitly.
+        self.conn = sqlite3.connect(filename, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS users (
+                id TEXT PRIMARY KEY,
+                balance INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS inventory (
+                user_id TEXT NOT NULL,
+                item_id TEXT NOT NULL,
+                qty INTEGER NOT NULL,
+                PRIMARY KEY (user_id, item_id)
+            ) WITHOUT ROWID;
+        ''')
+
+    # Runs the enclosed statements in a transaction.
+    def _transaction(self) -> _SQLiteTransaction:
+        return _SQLiteTransaction(self.conn)
+
+    def load_users(self, store: _Store) -> UserInterface:
+        data: dict[str, Any] = {}
+        for user_id, balance in self.conn.execute(
+                'SELECT id, balance FROM users'):
+            data[user_id] = {'balance': _from_sql(balance), 'inventory': {}}
+        orphans = 0
+        for user_id, item_id, qty in self.conn.execute(
+                'SELECT user_id, item_id, qty FROM inventory'):
+            user_data = data.get(user_id)
+            if user_data is None:
+                orphans += 1
+                continue
+            user_data['inventory'][item_id] = _from_sql(qty)
+        if orphans:
+            print(f'WARNING: Ignoring {orphans:,} inventory rows of unknown '
+                  f'users in {self.filename!r}')
+
+        if not data and self.import_from:
+            data, _ = JSONStorage(self.import_from).load_raw()
+            with self._transaction():
+                for user_id, user_data in data.items():
+                    self._write_user(user_id, user_data['balance'],
+                                     user_data['inventory'])
+
+        return UserInterface.from_dict(store, data, self, lazy=True)
+
+    # Writes a user's balance and replaces their entire inventory.
+    def _write_user(self, user_id: str, balance: int,
+            inventory: dict[str, int]) -> None:
+        self.conn.execute('INSERT OR REPLACE INTO users (id, balance) '
+                          'VALUES (?, ?)', (user_id, _to_sql(balance)))
+        self.conn.execute('DELETE FROM inventory WHERE user_id = ?',
+                          (user_id,))
+        self.conn.executemany('INSERT INTO inventory (user_id, item_id, qty) '
+                              'VALUES (?, ?, ?)',
+                              ((user_id, item_id, _to_sql(qty))
+                               for item_id, qty in inventory.items()))
+
+    def commit(self, states: Iterable[UserState]) -> None:
+        with self._transaction():
+            for user, _, _ in states:
+                self.conn.execute('INSERT OR REPLACE INTO users (id, balance) '
+                                  'VALUES (?, ?)',
+                                  (user.id, _to_sql(user.balance)))
+                for item_id, qty in user._get_touched_items().items():
+                    if qty > 0:
+                        self.conn.execute('INSERT OR REPLACE INTO inventory '
+                                          '(user_id, item_id, qty) '
+                                          'VALUES (?, ?, ?)',
+                                          (user.id, item_id, _to_sql(qty)))
+                    else:
+                        self.conn.execute('DELETE FROM inventory WHERE '
+                                          'user_id = ? AND item_id = ?',
+                                          (user.id, item_id))
+
+    # Only modified users are written, so this doesn't need another thread.
+    def save(self, users: UserInterface) -> Future[None]:
+        with self._transaction():
+            for user_id in users.dirty:
+                user = users.find_by_id(user_id)
+                assert user is not None
+                self._write_user(user_id, user.balance, user.inventory)
+        users.dirty.clear()
+        return db.completed_future()
+
+    def close(self) -> None:
+        self.conn.close()
+
+# SQLite integers are 64-bit, so larger balances and quantities are stored as
+# blobs containing the number in decimal (a text value would be converted to
+# a float).
+def _to_sql(n: int) -> Union[int, bytes]:
+    return n if -2 ** 63 <= n < 2 ** 63 else str(n).encode('ascii')
+
+def _from_sql(value: Union[int, bytes]) -> int:
+    return value if isinstance(value, int) else int(value)
+
+class _SQLiteTransaction:
+    __slots__ = ('conn',)
+    def __init__(self, conn: sqlite3.Connection) -> None:
+        self.conn = conn
+
+    def __enter__(self) -> None:
+        self.conn.execute('BEGIN')
+
+    def __exit__(self, exc_type: Any, exc: Any, tb: Any) -> None:
+        if exc_type is None:
+            self.conn.execute('COMMIT')
+        else:
+            self.conn.execute('ROLLBACK')
+
+
+# Users files with these extensions use the SQLite backend.
+sqlite_extensions = ('.db', '.sqlite', '.sqlite3')
+
+# Creates a storage backend based on the file extension of filename. ".bin"
+# files use binary shards (and users.bin may be a converted users.json, see
+# procoin.binary).
+def open_storage(filename: str) -> Storage:
+    base, ext = os.path.splitext(filename)
+    if ext in sqlite_extensions:
+        return SQLiteStorage(filename, import_from=base + '.json')
+    if ext == '.bin':
+        return JSONStorage(filename, codec='binary')
+    return JSONStorage(filename)
+
+# Returns the users file to use in a directory. The SQLite backend is used if
+# users.db exists (it will import users.json if it is empty), then binary
+# shards if users.bin exists.
+def find_users_file(directory: str) -> str:
+    for name in ('users.db', 'users.bin'):
+        filename = os.path.join(directory, name)
+        if os.path.exists(filename):
+            return filename
+    return os.path.join(directory, 'users.json')
@@ -1,5 +1,6 @@
 from __future__ import annotations
 import random, time
+from typing import Optional, Union
 
 
 # Local imports
@@ -9,6 +10,10 @@ small_items_stock = 6
 big_items_stock = 3
 big_item_bound = 0x7fffffff
 
+# The stock and counters of a store, see Store._snapshot().
+# This Union[] is a hack to keep Python 3.7 and 3.8 support.
+StoreSnapshot = Union['tuple[dict[Item, int], int, int, int, int]']
+
 # A base error.
 class Error(Exception):
     pass
@@ -26,32 +31,56 @@ class CannotAffordError(Error):
 
 class Store:
     __slots__ = ('items', 'current_stock', 'small_items', 'big_items',
-                 'last_update')
+                 'last_update', '_store_string', 'bought', 'sold',
+                 'bought_value', 'sold_value')
 
     def __init__(self, items: ItemInterface) -> None:
         self.items = items
+        self.current_stock: dict[Item, int] = {}
+        self._store_string: Optional[str] = None
+
+        # The amount and total cost of items bought from and sold to the
+        # store since it was created.
+        self.bought: int = 0
+        self.sold: int = 0
+        self.bought_value: int = 0
+        self.sold_value: int = 0
+
+        self.update_items()
+        # self.regenerate_store()
 
+    # Should be called when the item catalog changes. Items that no longer
+    # exist are removed from the stock.
+    def update_items(self) -> None:
         self.big_items: list[Item] = \
             list(self.items.filter_by(self._is_bigitem))
 
         self.small_items: list[Item] = \
             list(self.items.filter_by(self._not_bigitem))
 
-        self.current_stock: dict[Item, int] = {}
-        # self.regenerate_store()
+        known_items = self.items.items
+        for item in list(self.current_stock):
+            if known_items.get(item.id) is not item:
+                del self.current_stock[item]
+        self._store_string = None
 
     def __str__(self) -> str:
         return self.store_string
 
+    # The store string is cached until the stock changes.
     @property
     def store_string(self) -> str:
-        store_string = ''
+        if self._store_string is not None:
+            return self._store_string
+
+        lines: list[str] = []
         for item in sorted(self.current_stock.keys(), key=self._sort_key):
             # The diamond prefix is handled in items.py, no need to worry about
             # it here.
             in_stock: int = self.current_stock[item]
-            store_string += f'`{in_stock}x` {item.item_string}\n'
-        return store_string
+            lines.append(f'`{in_stock}x` {item.item_string}\n')
+        self._store_string = ''.join(lines)
+        return self._store_string
 
     # Returns a boolean (booleans are subclasses of ints anyway).
     def buy(self, item: Item, qty: int) -> None:
@@ -70,6 +99,9 @@ class Store:
 
         # Remove the item(s) from the stock.
         self.current_stock[item] -= qty
+        self._store_string = None
+        self.bought += qty
+        self.bought_value += item.cost * qty
 
         # Remove out-of-stock items from the store.
         if self.current_stock[item] == 0:
@@ -83,11 +115,34 @@ class Store:
             raise Error('You must sell at least one item!')
 
         # Add the item to the store
+        self._store_string = None
+        self.sold += qty
+        self.sold_value += item.cost * qty
         if item in self.current_stock:
             self.current_stock[item] += qty
         else:
             self.current_stock[item] = qty
 
+    # Returns a copy of the stock and counters that can be passed to
+    # _restore() if a transaction fails.
+    def _snapshot(self) -> StoreSnapshot:
+        return (self.current_stock.copy(), self.bought, self.sold,
+                self.bought_value, self.sold_value)
+
+    # Undoes any purchases and sales made since _snapshot() was called.
+    def _restore(self, state: StoreSnapshot) -> None:
+        stock, bought, sold, bought_value, sold_value = state
+
+        # Every purchase or sale changes the counters.
+        if bought == self.bought and sold == self.sold:
+            return
+        self.current_stock = stock
+        self.bought = bought
+        self.sold = sold
+        self.bought_value = bought_value
+        self.sold_value = sold_value
+        self._store_string = None
+
     def _sort_key(self, item: Item) -> int:
         return item.cost
 
@@ -103,6 +158,7 @@ class Store:
 
     def regenerate_store(self) -> None:
         self.current_stock.clear()
+        self._store_string = None
 
         # Ensure that random.sample() doesn't error if there are very few
         # items.
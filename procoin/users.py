@@ -1,25 +1,150 @@
 from __future__ import annotations
-import math, random, time
-from typing import Any, Optional, Union
+import contextlib, math, random, time, zlib
+from array import array
+from bisect import bisect_left
+from collections.abc import Callable, Iterable, Iterator, Mapping, Sequence
+from typing import Any, Optional, Union, TYPE_CHECKING
 from . import items
 from .items import format_currency
+from .leaderboard import Leaderboard
+from .stats import EconomyStats
 from .store import CannotAffordError, Error, Store as _Store
 
+if TYPE_CHECKING:
+    from .storage import Storage as _Storage
+
+# The quantities of the items in a user's inventory, see _make_quantities().
+_Quantities = Union['array[int]', 'list[int]']
+
+# The item indexes and quantities in a user's inventory.
+# This Union[] is a hack to keep Python 3.7 and 3.8 support.
+InventorySnapshot = Union['tuple[array[int], _Quantities]']
+
+# A user in the users.json format.
+_RawUser = Union['dict[str, Any]']
+
+# The number of files users are split between when saving. Changing this will
+# require deleting the existing shard files (or converting them).
+shard_count = 64
+
+# Quantities are stored in an array of 64-bit integers. Users files (and the
+# storage backends) allow larger quantities, so users that have a quantity
+# that doesn't fit use a list instead.
+def _make_quantities(qtys: Sequence[int]) -> _Quantities:
+    try:
+        return array('q', qtys)
+    except OverflowError:
+        return list(qtys)
+
 class User:
-    __slots__ = ('store', 'id', 'balance', 'boost', 'inventory', '_next_boost')
+    __slots__ = ('store', 'id', '_balance', 'boost', '_inv_idx', '_inv_qty',
+                 '_item_value', '_next_boost', '_ui', '_inv_version',
+                 '_inv_lines', '_inv_pages', '_touched')
     def __init__(self, store: _Store, id: str) -> None:
         self.store = store
         self.id: str = id
-        self.balance: int = 1_000_000
+        self._ui: Optional[UserInterface] = None
+        self._balance: int = 1_000_000
         self.boost: int = 1
         self._next_boost: float = 0
-        self.inventory: dict[str, int] = {}
+
+        # The inventory is stored as two parallel arrays, the item indexes
+        # (see ItemInterface.by_index) in ascending order and the quantities
+        # of those items. This uses far less memory than a dict.
+        self._inv_idx = array('I')
+        self._inv_qty: _Quantities = array('q')
+
+        # The indexes of items added or removed during the current
+        # transaction, so only those items have to be saved.
+        self._touched: Optional[set[int]] = None
+
+        # The total cost of every item in the inventory.
+        self._item_value: int = 0
+
+        # The rendered inventory is cached until the inventory changes (which
+        # increments _inv_version).
+        self._inv_version: int = 0
+        self._inv_lines: Optional[tuple[int, items.ItemInterface, int,
+                                        list[str], int]] = None
+        self._inv_pages: Optional[tuple[list[str], int, int, list[str]]] = \
+            None
+
+    @property
+    def balance(self) -> int:
+        return self._balance
+
+    @balance.setter
+    def balance(self, balance: int) -> None:
+        ui = self._ui
+        if ui is not None and ui._stats is not None:
+            ui._stats.money_supply += balance - self._balance
+        self._balance = balance
+        self._changed()
+
+    # Returns the economy stats if they're being kept track of.
+    def _get_stats(self) -> Optional[EconomyStats]:
+        return None if self._ui is None else self._ui._stats
+
+    # The user's balance plus the cost of every item they have.
+    @property
+    def net_worth(self) -> int:
+        return self._balance + self._item_value
+
+    # Marks the user as modified so that it gets saved (and updates any
+    # leaderboards).
+    def _changed(self) -> None:
+        if self._ui is not None:
+            self._ui._user_changed(self)
+
+    # Should be called whenever the inventory is modified.
+    def _inventory_changed(self) -> None:
+        self._inv_version += 1
+        self._changed()
+
+    # The inventory in the {item_id: qty} format. This creates a new dict
+    # every time it is accessed, so modifying it does nothing.
+    @property
+    def inventory(self) -> dict[str, int]:
+        by_index = self.store.items.by_index
+        return {by_index[index].id: qty
+                for index, qty in zip(self._inv_idx, self._inv_qty)}
+
+    # Iterates over (item, qty) tuples in the inventory.
+    def iter_items(self) -> Iterator[tuple[items.Item, int]]:
+        by_index = self.store.items.by_index
+        for index, qty in zip(self._inv_idx, self._inv_qty):
+            yield by_index[index], qty
+
+    # Returns the position of an item index in self._inv_idx, or -1 if the
+    # user doesn't have the item.
+    def _find_index(self, index: int) -> int:
+        pos = bisect_left(self._inv_idx, index)
+        if pos < len(self._inv_idx) and self._inv_idx[pos] == index:
+            return pos
+        return -1
+
+    # Gets the amount of an item the user has.
+    def get_qty(self, item: items.Item) -> int:
+        pos = self._find_index(item.index)
+        return self._inv_qty[pos] if pos >= 0 else 0
+
+    # Returns the items added or removed in the current transaction as an
+    # {item_id: qty} dict. Removed items have a quantity of 0.
+    def _get_touched_items(self) -> dict[str, int]:
+        if not self._touched:
+            return {}
+        by_index = self.store.items.by_index
+        res: dict[str, int] = {}
+        for index in self._touched:
+            pos = self._find_index(index)
+            res[by_index[index].id] = self._inv_qty[pos] if pos >= 0 else 0
+        return res
 
     # Convert the User object to a dict.
     def to_dict(self) -> dict[str, Union[int, dict[str, int]]]:
         return {'balance': self.balance, 'inventory': self.inventory}
 
-    # Create a User object from a dict.
+    # Create a User object from a dict. Unknown items are deleted.
     @classmethod
     def from_dict(cls, store: _Store, id: str, data: dict[Any, Any]):
         balance = data['balance']
@@ -29,34 +154,97 @@ class User:
         assert isinstance(inventory, dict)
         self = cls(store, id)
         self.balance = balance
-        self.inventory.update(inventory)
-        self.recalc_boost()
+
+        # This calculates the boost and net worth at the same time instead of
+        # calling recalc_boost() afterwards as it's faster.
+        known_items = store.items.items
+        pairs: list[tuple[int, int]] = []
+        boost: int = 1
+        item_value: int = 0
+        for item_id, qty in inventory.items():
+            item = known_items.get(item_id)
+            if item is None:
+                print(f'WARNING: Deleting unknown item {item_id!r}.')
+            elif qty > 0:
+                pairs.append((item.index, qty))
+                boost += item.boost * qty
+                item_value += item.cost * qty
+
+        if pairs:
+            pairs.sort()
+            indexes, qtys = zip(*pairs)
+            self._inv_idx = array('I', indexes)
+            self._inv_qty = _make_quantities(qtys)
+        self.boost = boost
+        self._item_value = item_value
         return self
 
     # Recalculates the user's boost, should be called when the inventory is
     # updated and the delta is not easily obtainable.
+    # This also recalculates the net worth.
     def recalc_boost(self) -> None:
-        ii: items.ItemInterface = self.store.items
         boost: int = 1
-        # Convert self.inventory.items() to a tuple so items can be safely
-        # deleted from it.
-        for item_id, qty in tuple(self.inventory.items()):
-            try:
-                boost += ii.get_item(item_id).boost * qty
-            except KeyError:
-                # Delete unknown items
-                print(f'WARNING: Deleting unknown item {item_id!r}.')
-                del self.inventory[item_id]
+        item_value: int = 0
+        for item, qty in self.iter_items():
+            boost += item.boost * qty
+            item_value += item.cost * qty
         self.boost = boost
+        self._item_value = item_value
+        self._changed()
+
+    # Returns a copy of the inventory arrays that can be passed to _restore().
+    # Copying the arrays is a lot faster than creating a dict.
+    def _snapshot_inventory(self) -> InventorySnapshot:
+        return self._inv_idx[:], self._inv_qty[:]
+
+    # Restores the balance and inventory saved at the start of a transaction.
+    def _restore(self, balance: int, inventory: InventorySnapshot) -> None:
+        idx, qty = inventory
+        if idx != self._inv_idx or qty != self._inv_qty:
+            if self._ui is not None:
+                self._ui._update_holders(self.id, self._inv_idx, idx)
+            stats = self._get_stats()
+            if stats is not None:
+                for item, amount in self.iter_items():
+                    stats.remove_item(item, amount)
+            self._inv_idx = idx[:]
+            self._inv_qty = qty[:]
+            if stats is not None:
+                for item, amount in self.iter_items():
+                    stats.add_item(item, amount)
+            self._inv_version += 1
+            self.recalc_boost()
+        if balance != self._balance:
+            self.balance = balance
 
     # Adds an item to the user's inventory and adds the boost.
     def add_item(self, item: items.Item, qty: int) -> None:
         assert qty > 0
-        if item.id in self.inventory:
-            self.inventory[item.id] += qty
+        if self._touched is not None:
+            self._touched.add(item.index)
+        pos = bisect_left(self._inv_idx, item.index)
+        if pos < len(self._inv_idx) and self._inv_idx[pos] == item.index:
+            new_qty = self._inv_qty[pos] + qty
+            try:
+                self._inv_qty[pos] = new_qty
+            except OverflowError:
+                self._inv_qty = list(self._inv_qty)
+                self._inv_qty[pos] = new_qty
         else:
-            self.inventory[item.id] = qty
+            try:
+                self._inv_qty.insert(pos, qty)
+            except OverflowError:
+                self._inv_qty = list(self._inv_qty)
+                self._inv_qty.insert(pos, qty)
+            self._inv_idx.insert(pos, item.index)
+            if self._ui is not None:
+                self._ui._add_holder(item.index, self.id)
         self.boost += item.boost * qty
+        self._item_value += item.cost * qty
+        stats = self._get_stats()
+        if stats is not None:
+            stats.add_item(item, qty)
+        self._inventory_changed()
 
     # Buy an item from the store.
     def buy_item(self, item: items.Item, qty: int) -> None:
@@ -77,7 +265,7 @@ class User:
     # Ensures a user has an item.
     def assert_has_item(self, item: items.Item, qty: int) -> None:
         assert qty > 0
-        actual_amount = self.inventory.get(item.id, 0)
+        actual_amount = self.get_qty(item)
         if qty > actual_amount:
             raise Error(f'You only have {actual_amount} `{item}`'
                         f'{"" if actual_amount == 1 else "s"}, not {qty}!')
@@ -88,19 +276,30 @@ class User:
     def take_item(self, item: items.Item, qty: int, *,
             ignore_cursed: bool = False) -> None:
         assert qty > 0
-        actual_amount = self.inventory.get(item.id, 0)
+        pos = self._find_index(item.index)
+        actual_amount = self._inv_qty[pos] if pos >= 0 else 0
         if qty > actual_amount:
             raise Error(f'You only have {actual_amount} `{item}`'
                         f'{"" if actual_amount == 1 else "s"}, not {qty}!')
         if item.cursed and not ignore_cursed:
             raise Error('You cannot remove cursed items!')
 
+        if self._touched is not None:
+            self._touched.add(item.index)
         actual_amount -= qty
         if actual_amount > 0:
-            self.inventory[item.id] = actual_amount
+            self._inv_qty[pos] = actual_amount
         else:
-            del self.inventory[item.id]
+            del self._inv_idx[pos]
+            del self._inv_qty[pos]
+            if self._ui is not None:
+                self._ui._remove_holder(item.index, self.id)
         self.boost -= item.boost * qty
+        self._item_value -= item.cost * qty
+        stats = self._get_stats()
+        if stats is not None:
+            stats.remove_item(item, qty)
+        self._inventory_changed()
 
     # Sell an item to the store. The actual sale price can be between 0.85 and
     # 1.05 times the actual price.
@@ -116,66 +315,457 @@ class User:
         self.balance += cost_int
         return cost_int
 
-    # Adds the boost if called 20 seconds after the last boost.
-    def add_boost(self) -> None:
-        t = time.time()
+    # Adds the boost if called 20 seconds after the last boost. t defaults to
+    # the current time.
+    def add_boost(self, t: Optional[float] = None) -> None:
+        if t is None:
+            t = time.time()
         if t >= self._next_boost + 20:
-            self.balance += max(self.boost, 0)
+            amount = max(self.boost, 0)
+            self.balance += amount
             self._next_boost = t + 20
+            stats = self._get_stats()
+            if stats is not None:
+                stats.boost_payouts += 1
+                stats.boost_paid += amount
 
-    # Apparently \r\n is larger than \n but smaller than \n\n.
-    def get_inventory(self) -> list[str]:
+    # Renders a line for each item in the inventory (sorted by name), and
+    # returns the lines and the total amount of items. This is cached until
+    # the inventory (or the item catalog) changes.
+    def _get_inventory_lines(self) -> tuple[list[str], int]:
         items = self.store.items
-        inv_string = inv_prefix = \
-            f'Balance: {format_currency(self.balance)}\n\n'
+        cached = self._inv_lines
+        if cached is not None and cached[0] == self._inv_version and \
+                cached[1] is items and cached[2] == items.version:
+            return cached[3], cached[4]
+
+        lines: list[str] = []
         total_items: int = 0
-        for item in sorted(self.inventory,
-                key=lambda i : items.get_name(i).lower()):
+        for item, amount in sorted(self.iter_items(),
+                key=lambda i : i[0].name.lower()):
             # The diamond prefix is handled in items.py, no need to worry about
             # it here.
-            amount = self.inventory[item]
-            inv_string += f'`{amount}x` {items.get_prefixed_name(item)}: ' \
-                          f'{format_currency(items.get_boost(item))}\n'
+            lines.append(f'`{amount}x` {item.prefixed_name}: '
+                         f'{format_currency(item.boost)}\n')
             total_items += amount
+
+        self._inv_lines = (self._inv_version, items, items.version, lines,
+                           total_items)
+        return lines, total_items
+
+    # Apparently \r\n is larger than \n but smaller than \n\n.
+    # The pages are cached until the inventory, balance or boost changes, so
+    # flipping between pages doesn't re-render the inventory.
+    def get_inventory(self) -> list[str]:
+        lines, total_items = self._get_inventory_lines()
+        cached = self._inv_pages
+        if cached is not None and cached[0] is lines and \
+                cached[1] == self.balance and cached[2] == self.boost:
+            return cached[3]
+
+        inv_prefix = f'Balance: {format_currency(self.balance)}\n\n'
         footer = f'\nTotal items: {total_items:,}' \
                  f'\nTotal boost: {format_currency(self.boost)}'
 
-        pages = []
-        footer_l = len(footer)
-        while len(inv_string) + footer_l > 2048:
-            n = inv_string[:2048 - footer_l].rsplit('\n', 1)
-            assert n
-            pages.append(n[0] + '\n' + footer)
-            inv_string = inv_prefix + (n[1] if len(n) > 1 else '') + \
-                inv_string[2048 - footer_l:]
-        pages.append(inv_string + footer)
+        # Split the lines into pages that (including the footer) fit in 2048
+        # characters.
+        pages: list[str] = []
+        limit = 2048 - len(footer)
+        page: list[str] = [inv_prefix]
+        page_l = len(inv_prefix)
+        for line in lines:
+            if page_l + len(line) > limit and len(page) > 1:
+                pages.append(''.join(page) + footer)
+                page = [inv_prefix]
+                page_l = len(inv_prefix)
+            page.append(line)
+            page_l += len(line)
+        pages.append(''.join(page) + footer)
 
+        self._inv_pages = (lines, self.balance, self.boost, pages)
         return pages
 
     @property
     def inv(self) -> str:
         return self.get_inventory()[0]
 
+# Calculates the leaderboard scores of a user that hasn't been converted to a
+# User object.
+def _record_scores(ii: items.ItemInterface, balance: int,
+        inventory: dict[str, int]) -> dict[str, int]:
+    boost: int = 1
+    item_value: int = 0
+    for item_id, qty in inventory.items():
+        item = ii.items.get(item_id)
+        if item is not None:
+            boost += item.boost * qty
+            item_value += item.cost * qty
+    return {'balance': balance, 'boost': boost,
+            'net_worth': balance + item_value}
+
+# The scores that leaderboards can be created for.
+leaderboard_scores: dict[str, Callable[[User], int]] = {
+    'balance': lambda user : user.balance,
+    'boost': lambda user : user.boost,
+    'net_worth': lambda user : user.net_worth,
+}
+
+# An immutable copy of the users (in the users.json format) that can be read
+# from another thread, such as the db writer thread. This is much faster to
+# make than UserInterface.to_dict(): users that haven't been converted to
+# User objects are shared with the UserInterface (which never modifies them),
+# and only the balance and inventory arrays of User objects are copied. Users
+# are converted to dicts when they are accessed.
+class UsersCopy(Mapping):
+    __slots__ = ('_raw', '_users', '_item_ids', '_user_ids')
+
+    # If user_ids is specified, only those users are included.
+    def __init__(self, ui: UserInterface,
+            user_ids: Optional[Iterable[str]] = None) -> None:
+        self._raw = ui._raw
+        self._user_ids: Optional[frozenset[str]] = None
+        users = ui.users
+        if user_ids is None:
+            copied = users
+        else:
+            self._user_ids = frozenset(user_ids)
+            copied = {user_id: users[user_id] for user_id in self._user_ids
+                      if user_id in users}
+        self._users: dict[str, tuple[int, array[int], _Quantities]] = {
+            user_id: (user.balance, user._inv_idx[:], user._inv_qty[:])
+            for user_id, user in copied.items()
+        }
+        self._item_ids = [item.id for item in ui.store.items.by_index]
+
+    def __getitem__(self, user_id: str) -> _RawUser:
+        user = self._users.get(user_id)
+        if user is None:
+            if self._user_ids is not None and user_id not in self._user_ids:
+                raise KeyError(user_id)
+            return self._raw[user_id]
+        balance, indexes, qtys = user
+        item_ids = self._item_ids
+        return {'balance': balance,
+                'inventory': {item_ids[index]: qty
+                              for index, qty in zip(indexes, qtys)}}
+
+    def __iter__(self) -> Iterator[str]:
+        if self._user_ids is not None:
+            yield from self._user_ids
+            return
+        users = self._users
+        for user_id in self._raw:
+            if user_id not in users:
+                yield user_id
+        yield from users
+
+    def __len__(self) -> int:
+        if self._user_ids is not None:
+            return len(self._user_ids)
+        return len(self._raw) + sum(1 for user_id in self._users
+                                    if user_id not in self._raw)
+
 class UserInterface:
-    __slots__ = ('store', 'users')
-    def __init__(self, store: _Store, users: dict[str, User]) -> None:
+    __slots__ = ('store', 'users', 'storage', 'dirty', 'holders', '_raw',
+                 '_shards', '_leaderboards', '_stats')
+
+    # raw contains users (in the users.json format) that will only be
+    # converted to User objects when they are first accessed. It is never
+    # modified.
+    def __init__(self, store: _Store, users: dict[str, User],
+            storage: Optional[_Storage] = None,
+            raw: Optional[Mapping[str, _RawUser]] = None) -> None:
         self.store = store
         self.users = users
+        self.storage = storage
+        self._raw: Mapping[str, _RawUser] = {} if raw is None else raw
+
+        # The IDs of the User objects that have each item (by index). Users
+        # that haven't been converted to User objects yet aren't included.
+        self.holders: dict[int, set[str]] = {}
+        for user in users.values():
+            user._ui = self
+            for index in user._inv_idx:
+                self._add_holder(index, user.id)
+
+        # The IDs of users that have been modified since the last save.
+        self.dirty: set[str] = set()
+
+        # Leaderboards and stats are only created when they are first used.
+        self._leaderboards: dict[str, Leaderboard] = {}
+        self._stats: Optional[EconomyStats] = None
+
+        # The user IDs in each shard, these are only worked out when the users
+        # are first saved.
+        self._shards: Optional[list[set[str]]] = None
+
+    def __len__(self) -> int:
+        return len(self._raw) + sum(1 for user_id in self.users
+                                    if user_id not in self._raw)
+
+    # Iterates over every user ID without creating User objects.
+    def user_ids(self) -> Iterator[str]:
+        yield from self._raw
+        for user_id in self.users:
+            if user_id not in self._raw:
+                yield user_id
+
+    # Iterates over (user_id, balance, inventory) for every user without
+    # creating User objects. The inventories must not be modified.
+    def records(self) -> Iterator[tuple[str, int, dict[str, int]]]:
+        users = self.users
+        for user_id, data in self._raw.items():
+            if user_id not in users:
+                yield user_id, data['balance'], data['inventory']
+        for user_id, user in users.items():
+            yield user_id, user.balance, user.inventory
+
+    # Like records(), but yields (user_id, balance, item indexes, quantities)
+    # where the item indexes are sorted. Unknown items are skipped. This is
+    # used by procoin.columnar.
+    def index_records(self) \
+            -> Iterator[tuple[str, int, Sequence[int], Sequence[int]]]:
+        users = self.users
+        known_items = self.store.items.items
+        for user_id, data in self._raw.items():
+            if user_id not in users:
+                pairs = sorted((known_items[item_id].index, qty)
+                               for item_id, qty in data['inventory'].items()
+                               if qty > 0 and item_id in known_items)
+                yield (user_id, data['balance'],
+                       [index for index, _ in pairs],
+                       [qty for _, qty in pairs])
+        for user_id, user in users.items():
+            yield user_id, user.balance, user._inv_idx, user._inv_qty
 
     def to_dict(self) -> dict[str, dict[str, Union[int, dict[str, int]]]]:
-        return {k: v.to_dict() for k, v in self.users.items()}
+        users = self.users
+        res = {k: v if k not in users else users[k].to_dict()
+               for k, v in self._raw.items()}
+        for k, user in users.items():
+            if k not in res:
+                res[k] = user.to_dict()
+        return res
+
+    # Returns a copy of the users that can be read from another thread, see
+    # UsersCopy.
+    def frozen_copy(self) -> UsersCopy:
+        return UsersCopy(self)
+
+    def _add_holder(self, index: int, user_id: str) -> None:
+        holders = self.holders.get(index)
+        if holders is None:
+            holders = self.holders[index] = set()
+        holders.add(user_id)
+
+    def _remove_holder(self, index: int, user_id: str) -> None:
+        holders = self.holders.get(index)
+        if holders is not None:
+            holders.discard(user_id)
+            if not holders:
+                del self.holders[index]
+
+    # Updates the holders when a user's inventory is replaced.
+    def _update_holders(self, user_id: str, old: Iterable[int],
+            new: Iterable[int]) -> None:
+        old_set = set(old)
+        new_set = set(new)
+        for index in old_set - new_set:
+            self._remove_holder(index, user_id)
+        for index in new_set - old_set:
+            self._add_holder(index, user_id)
 
+    # Updates users after ItemInterface.update_from() has modified the item
+    # catalog. Only users that have a changed or removed item are modified.
+    # Users that haven't been converted to User objects yet will use the new
+    # catalog when they are.
+    def apply_catalog_changes(self, changes: items.CatalogChanges) -> None:
+        users = self.users
+
+        # Delete removed items (while the inventories still use the old
+        # indexes).
+        stats = self._stats
+        self._stats = None
+        for item in changes.removed:
+            for user_id in self.holders.pop(item.index, ()):
+                user = users[user_id]
+                pos = user._find_index(item.index)
+                qty = user._inv_qty[pos]
+                del user._inv_idx[pos]
+                del user._inv_qty[pos]
+                user.boost -= item.boost * qty
+                user._item_value -= item.cost * qty
+                user._inventory_changed()
+
+        # Every inventory has to be converted to the new indexes if items were
+        # removed. The mapping preserves the order, so the indexes stay
+        # sorted.
+        index_map = changes.index_map
+        if index_map is not None:
+            for user in users.values():
+                if user._inv_idx:
+                    user._inv_idx = array('I', [index_map[index]
+                                                for index in user._inv_idx])
+            self.holders = {index_map[index]: holders
+                            for index, holders in self.holders.items()}
+
+        # Adjust the boost and net worth of anyone with a changed item.
+        for item, old_boost, old_cost in changes.changed:
+            for user_id in self.holders.get(item.index, ()):
+                user = users[user_id]
+                qty = user.get_qty(item)
+                user.boost += (item.boost - old_boost) * qty
+                user._item_value += (item.cost - old_cost) * qty
+                user._changed()
+
+        # Users that haven't been loaded are included in the stats, so they
+        # have to be updated separately.
+        if stats is not None:
+            for item in changes.removed:
+                stats.item_removed(item)
+            for item, old_boost, old_cost in changes.changed:
+                stats.item_changed(item, old_boost, old_cost)
+            self._stats = stats
+
+        # Leaderboard scores of users that haven't been loaded may have
+        # changed, so rebuild the leaderboards the next time they are used.
+        if changes.removed or changes.changed:
+            self._leaderboards.pop('boost', None)
+            self._leaderboards.pop('net_worth', None)
+
+    # Called by User objects when they are modified.
+    def _user_changed(self, user: User) -> None:
+        self.dirty.add(user.id)
+        for kind, leaderboard in self._leaderboards.items():
+            leaderboard.update(user.id, leaderboard_scores[kind](user))
+
+    # Gets a leaderboard (kind should be a key in leaderboard_scores). The
+    # leaderboard is built the first time it is requested, and after that it
+    # is updated whenever a user changes.
+    def get_leaderboard(self, kind: str) -> Leaderboard:
+        leaderboard = self._leaderboards.get(kind)
+        if leaderboard is None:
+            assert kind in leaderboard_scores
+            ii: items.ItemInterface = self.store.items
+            leaderboard = Leaderboard({
+                user_id: _record_scores(ii, balance, inventory)[kind]
+                for user_id, balance, inventory in self.records()
+            })
+            self._leaderboards[kind] = leaderboard
+        return leaderboard
+
+    # Gets the economy stats. These are calculated the first time they are
+    # requested, and after that they are updated whenever a user changes.
+    def get_stats(self) -> EconomyStats:
+        if self._stats is None:
+            self._stats = EconomyStats.from_records(self.store.items,
+                                                    self.records())
+        return self._stats
+
+    # Recalculates the stats from scratch and returns a list of any
+    # differences from the running totals (see EconomyStats.compare).
+    def verify_stats(self) -> list[str]:
+        expected = EconomyStats.from_records(self.store.items, self.records())
+        return self.get_stats().compare(expected)
+
+    # Gets the shard number of a user ID. This uses CRC32 as hash() is
+    # randomised between runs.
+    @staticmethod
+    def shard_of(user_id: str) -> int:
+        return zlib.crc32(user_id.encode('utf-8')) % shard_count
+
+    def _get_shards(self) -> list[set[str]]:
+        if self._shards is None:
+            self._shards = [set() for _ in range(shard_count)]
+            for user_id in self.user_ids():
+                self._shards[self.shard_of(user_id)].add(user_id)
+        return self._shards
+
+    # Returns a copy of each of the specified shards (see UsersCopy). Users
+    # that haven't been accessed are only decoded when the copy is read, which
+    # is usually done by the db writer thread.
+    def shards_to_dict(self, shards: Iterable[int]) \
+            -> dict[int, UsersCopy]:
+        all_shards = self._get_shards()
+        return {shard: UsersCopy(self, all_shards[shard]) for shard in shards}
+
+    # Copies every shard containing a modified user and marks all users as
+    # saved (storage backends mark them as modified again if the save fails).
+    def dirty_shards_to_dict(self) -> dict[int, UsersCopy]:
+        shards = {self.shard_of(user_id) for user_id in self.dirty}
+        self.dirty.clear()
+        return self.shards_to_dict(shards)
+
+    # If lazy is True, User objects are only created when the users are first
+    # accessed (so users must not be modified afterwards).
     @classmethod
     def from_dict(cls, store: _Store,
-            users: dict[str, dict[str, Union[int, dict[str, int]]]]):
+            users: Mapping[str, dict[str, Union[int, dict[str, int]]]],
+            storage: Optional[_Storage] = None, *, lazy: bool = False):
+        if lazy:
+            return cls(store, {}, storage, users)
         new_users = {k: User.from_dict(store, k, v) for k, v in users.items()}
-        return cls(store, new_users)
+        return cls(store, new_users, storage)
+
+    # Changes made to users inside a transaction are either all saved by the
+    # storage backend or, if an exception is raised, all rolled back (along
+    # with any changes to the store's stock).
+    @contextlib.contextmanager
+    def transaction(self, *users: User) -> Iterator[None]:
+        states = [(user, user.balance, user._snapshot_inventory())
+                  for user in dict.fromkeys(users)]
+        store_state = self.store._snapshot()
+
+        # Keep track of changed items (unless this is a nested transaction).
+        outer = [user for user, _, _ in states if user._touched is None]
+        for user in outer:
+            user._touched = set()
+
+        try:
+            yield
+            if self.storage is not None:
+                self.storage.commit(states)
+        except BaseException:
+            for user, balance, inventory in states:
+                user._restore(balance, inventory)
+            self.store._restore(store_state)
+            raise
+        finally:
+            for user in outer:
+                user._touched = None
+
+    # Creates a User object from a raw user.
+    def _hydrate(self, user_id: str) -> Optional[User]:
+        data = self._raw.get(user_id)
+        if data is None:
+            return None
+
+        user = self.users[user_id] = User.from_dict(self.store, user_id, data)
+        user._ui = self
+        for index in user._inv_idx:
+            self._add_holder(index, user_id)
+
+        # User.from_dict() deletes unknown items.
+        if len(user._inv_idx) != len(data['inventory']):
+            self.dirty.add(user_id)
+        return user
 
     def find_by_id(self, user_id: Union[str, int]) -> Optional[User]:
-        return self.users.get(str(user_id))
+        user_id = str(user_id)
+        user = self.users.get(user_id)
+        if user is None:
+            user = self._hydrate(user_id)
+        return user
 
     def get_or_create(self, user_id: Union[str, int]) -> User:
         user_id = str(user_id)
-        if user_id not in self.users:
-            self.users[user_id] = User(self.store, user_id)
-        return self.users[user_id]
+        user = self.find_by_id(user_id)
+        if user is None:
+            user = self.users[user_id] = User(self.store, user_id)
+            user._ui = self
+            if self._stats is not None:
+                self._stats.add_user(user.balance)
+            if self._shards is not None:
+                self._shards[self.shard_of(user_id)].add(user_id)
+            self._user_changed(user)
+        return user
@@ -0,0 +1,131 @@
+# Event loop lag monitoring
+#
+# A heartbeat coroutine wakes up every interval seconds and records how late
+# it was (the event loop lag). A helper thread checks that the heartbeat keeps
+# running, and if the loop has been blocked for longer than threshold seconds
+# it prints the loop thread's stack and the command or listener that was
+# running (see metrics.enter_handler()), while the loop is still blocked.
+
+from __future__ import annotations
+import asyncio, sys, threading, time, traceback
+from collections import deque
+from typing import Optional
+from . import metrics
+
+# Lag histogram buckets, in seconds.
+_lag_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                5.0, 10.0)
+
+class Watchdog:
+    __slots__ = ('interval', 'threshold', 'recent', 'blocked', '_loop',
+                 '_loop_thread', '_last_tick', '_tick', '_reported',
+                 '_task', '_thread', '_stop')
+
+    # The lag of the last window heartbeats is kept for percentiles().
+    def __init__(self, interval: float = 0.1, threshold: float = 0.25,
+            window: int = 3000) -> None:
+        self.interval = interval
+        self.threshold = threshold
+        self.recent: deque[float] = deque(maxlen=window)
+
+        # The number of times the loop was blocked for longer than threshold.
+        self.blocked: int = 0
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: int = 0
+        self._last_tick: float = 0.0
+        self._tick: int = 0
+        self._reported: int = -1
+        self._task: Optional[asyncio.Future[None]] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    # Starts the watchdog on a loop (which doesn't have to be running yet)
+    # and exports the lag as metrics.
+    def start(self, loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+        loop = loop or asyncio.get_event_loop()
+        self._task = asyncio.ensure_future(self._heartbeat(), loop=loop)
+
+        registry = metrics.registry
+        registry.add_histogram('procoin_loop_lag_seconds',
+                               'How late the event loop ran the watchdog.',
+                               _lag_buckets)
+        for q in (50, 90, 99):
+            registry.add_gauge(f'procoin_loop_lag_p{q}_seconds',
+                               f'The p{q} event loop lag over the last '
+                               f'{self.recent.maxlen} heartbeats.',
+                               lambda q=q : self.percentile(q))
+        registry.add_gauge('procoin_loop_blocked_total',
+                           'Times the event loop was blocked for longer '
+                           'than the watchdog threshold.',
+                           lambda : self.blocked, metric_type='counter')
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._stop_thread()
+
+    # The helper thread is a daemon thread that exits once it notices the
+    # event is set. It isn't joined, as that would block the event loop.
+    def _stop_thread(self) -> None:
+        self._stop.set()
+        self._thread = None
+
+    async def _heartbeat(self) -> None:
+        self._loop = asyncio.get_event_loop()
+        self._loop_thread = threading.get_ident()
+        self._last_tick = time.perf_counter()
+
+        # Each thread gets its own event, so a thread that hasn't noticed
+        # that it was stopped yet can't be restarted by the next start().
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._watch,
+                                        args=(self._stop,),
+                                        name='procoin.watchdog', daemon=True)
+        self._thread.start()
+
+        try:
+            while True:
+                expected = time.perf_counter() + self.interval
+                await asyncio.sleep(self.interval)
+                now = time.perf_counter()
+                lag = max(now - expected, 0.0)
+                self.recent.append(lag)
+                metrics.registry.observe_value('procoin_loop_lag_seconds',
+                                               lag)
+                if lag > self.threshold:
+                    self.blocked += 1
+                    if self._reported == self._tick:
+                        print(f'WARNING: The event loop was blocked for '
+                              f'{lag * 1000:,.0f} ms', file=sys.stderr)
+                self._last_tick = now
+                self._tick += 1
+        finally:
+            self._stop_thread()
+
+    # Runs in the helper thread.
+    def _watch(self, stop: threading.Event) -> None:
+        while not stop.wait(self.threshold / 4):
+            tick = self._tick
+            blocked = time.perf_counter() - self._last_tick - self.interval
+            if blocked > self.threshold and tick != self._reported:
+                self._reported = tick
+                self._report(blocked)
+
+    def _report(self, blocked: float) -> None:
+        loop = self._loop
+        handler = 'unknown' if loop is None else \
+            metrics.current_handler(loop)
+        frame = sys._current_frames().get(self._loop_thread)
+        stack = ''.join(traceback.format_stack(frame)) if frame else ''
+        print(f'WARNING: The event loop has been blocked for '
+              f'{blocked * 1000:,.0f} ms while running {handler}:\n{stack}',
+              file=sys.stderr, end='')
+
+    # Returns the qth percentile of the recent lag, in seconds.
+    def percentile(self, q: float) -> float:
+        if not self.recent:
+            return 0.0
+        values = sorted(self.recent)
+        return values[min(int(len(values) * q / 100), len(values) - 1)]
@@ -1,23 +1,53 @@
 #!/usr/bin/env python3
 
 from __future__ import annotations
-import discord # type: ignore
+import argparse, discord # type: ignore
 from discord.ext import commands # type: ignore
 import os
 
-bot = commands.Bot(command_prefix='&')
-bot.load_extension('procoin_cog')
-bot.load_extension('sweepstakes_cog')
+# Store the token in token.txt, git should ignore it.
+token_file = os.path.join(os.path.dirname(__file__), 'token.txt')
 
-@bot.event
-async def on_ready():
-    print('Logged in')
+# To split the bot into several processes, start procoin_ledger.py and then
+# start each process with --ledger and the shards it should handle, for
+# example "--ledger procoin.sock --shard-count 4 --shards 0,1".
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ledger', help='The socket of a ledger process to '
+                        'send economy operations to.')
+    parser.add_argument('--shard-count', type=int,
+                        help='The total number of shards.')
+    parser.add_argument('--shards', help='A comma-separated list of shard IDs '
+                        'that this process should handle.')
+    parser.add_argument('--metrics-port', type=int,
+                        help='Serve Prometheus metrics on this port (on '
+                        'localhost only).')
+    args = parser.parse_args()
+    if args.shards and not args.shard_count:
+        parser.error('--shards requires --shard-count')
 
-# TODO implement discord error handling
+    if args.shards:
+        bot = commands.AutoShardedBot(command_prefix='&',
+            shard_count=args.shard_count,
+            shard_ids=[int(shard) for shard in args.shards.split(',')])
+    else:
+        bot = commands.Bot(command_prefix='&')
+
+    # These are read by procoin_cog.
+    bot.procoin_ledger = args.ledger
+    bot.procoin_metrics_port = args.metrics_port
+    bot.load_extension('procoin_cog')
+    bot.load_extension('sweepstakes_cog')
+
+    @bot.event
+    async def on_ready():
+        print('Logged in')
+
+    # TODO implement discord error handling
 
-# Store the token in token.txt, git should ignore it.
-token_file = os.path.join(os.path.dirname(__file__), 'token.txt')
-if __name__ == '__main__':
     with open(token_file, 'r') as f:
         token = f.read().strip()
     bot.run(token)
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 from __future__ import annotations
 import asyncio, discord # type: ignore
 from discord.ext import commands, tasks # type: ignore
+from collections.abc import Iterable
 from typing import Any, Optional, Union, TYPE_CHECKING
 import os, time, traceback
 
@@ -19,27 +20,125 @@ else:
     from discord.ext.commands import Cog
 
 # Local imports
+from procoin import db, metrics, profiler
 from procoin.core import ProCoin
-from procoin.items import Item, format_currency
+from procoin.events import MessageDispatcher, MessageEvent
+from procoin.items import Item, ItemInterface, format_currency
+from procoin.ledger import Ledger
+from procoin.merges import MergeInterface
+from procoin.rpc import Economy, LocalEconomy, RemoteEconomy
+from procoin.snapshots import SnapshotManager
+from procoin.storage import find_users_file
 from procoin.store import Error
-from procoin.users import User
+from procoin.watchdog import Watchdog
 
 def _plural(n: Union[int, float]) -> str:
     return '' if n == 1 else 's'
 
+# Formats a recipe in the same way as MergeInterface.get_merges().
+def _recipe_string(recipe: Iterable[Item]) -> str:
+    return '`' + '` + `'.join(sorted(item.name for item in recipe)) + '`'
+
+# Joins lines for an embed description, dropping any lines that don't fit.
+def _join_lines(lines: list[str], limit: int = 2048) -> str:
+    res = ''
+    for i, line in enumerate(lines):
+        more = f'\n*...and {len(lines) - i:,} more.*'
+        if len(res) + len(line) + len(more) + 1 > limit:
+            return res + more
+        res += line + '\n'
+    return res.rstrip('\n')
+
+# Leaderboard names (and aliases) accepted by the leaderboard commands.
+_leaderboard_kinds = {
+    'balance': 'balance', 'bal': 'balance', 'money': 'balance',
+    'boost': 'boost',
+    'networth': 'net_worth', 'net_worth': 'net_worth', 'worth': 'net_worth',
+}
+_leaderboard_titles = {
+    'balance': 'Balance', 'boost': 'Boost', 'net_worth': 'Net worth',
+}
+
+# The longest time the profiling commands can run for.
+_max_profile_time = 300.0
+
+def _format_seconds(seconds: float) -> str:
+    if seconds == float('inf'):
+        return 'slow'
+    if seconds < 1:
+        return f'{seconds * 1000:.1f}ms'
+    return f'{seconds:.2f}s'
+
+def _get_leaderboard_kind(kind: str) -> str:
+    try:
+        return _leaderboard_kinds[kind.lower()]
+    except KeyError:
+        raise Error('Unknown leaderboard! Try `balance`, `boost` or '
+                    '`networth`.') from None
+
 # This can't inherit from both commands.Cog and ProCoin, as attributes such as
 # "store" conflict.
 class BotInterface(Cog, name='General commands'):
-    def __init__(self, bot: commands.Bot, directory: str) -> None:
+    # If ledger_socket is specified, the economy is owned by a separate ledger
+    # process (see procoin_ledger.py) and only the item catalog is loaded.
+    def __init__(self, bot: commands.Bot, directory: str,
+            ledger_socket: Optional[str] = None) -> None:
         self.bot = bot
-        self.pc = ProCoin(os.path.join(directory, 'items.json'),
-                          os.path.join(directory, 'users.json'))
-        self.__update_store.start()
 
-    # Get a username from a User object.
-    def get_username(self, user: User) -> str:
+        # Every command that reads or modifies users goes through
+        # self.economy, see procoin.rpc. The merges are stored in self.recipes
+        # as discord.py sets self.merges to the merges command.
+        self.economy: Economy
+        self.pc: Optional[ProCoin] = None
+        self.item_filename = item_filename = os.path.join(directory,
+                                                          'items.json')
+        self.profile_dir = os.path.join(directory, 'profiles')
+        if ledger_socket:
+            self.items = ItemInterface.from_dict(db.load(item_filename))
+            self.recipes = MergeInterface(self.items)
+            self.economy = RemoteEconomy(ledger_socket, self.items)
+        else:
+            user_filename = find_users_file(directory)
+            snapshots = SnapshotManager(os.path.join(directory, 'snapshots'))
+            self.pc = ProCoin(item_filename, user_filename,
+                              snapshots=snapshots)
+            self.items = self.pc.items
+            self.recipes = self.pc.merges
+            ledger = Ledger()
+            metrics.add_ledger_gauges(ledger)
+            self.economy = LocalEconomy(self.pc, ledger)
+
+        # Other cogs should add message handlers here instead of listening
+        # for on_message.
+        self.messages = MessageDispatcher()
+        self.messages.add_handler(self.__handle_message)
+        sweepstakes = bot.get_cog('Sweepstakes')
+        if sweepstakes:
+            self.messages.add_handler(sweepstakes.handle_message)
+
+        # The ledger process regenerates the store itself.
+        if not ledger_socket:
+            self.__update_store.start()
+
+        # Log anything that blocks the event loop.
+        self.watchdog = Watchdog()
+        self.watchdog.start(bot.loop)
+
+        # Serve the metrics over HTTP if procoin_bot.py was given a port.
+        self.__metrics_server: Optional[asyncio.AbstractServer] = None
+        self.__metrics_task: Optional[asyncio.Task] = None
+        metrics_port = getattr(bot, 'procoin_metrics_port', None)
+        if metrics_port:
+            self.__metrics_task = bot.loop.create_task(
+                self.__start_metrics_server(metrics_port))
+
+    async def __start_metrics_server(self, port: int) -> None:
+        self.__metrics_server = await metrics.start_http_server(port)
+
+    # Get a username from a user ID.
+    def get_username(self, user_id: str) -> str:
         try:
-            id = int(user.id)
+            id = int(user_id)
         except ValueError:
             pass
         else:
@@ -48,11 +147,15 @@ class BotInterface(Cog, name='General commands'):
                 return discord_user.name
 
         # Default username
-        return '#' + user.id
+        return '#' + user_id
 
     @commands.is_owner()
     @commands.command(help='Reloads the bot.', hidden=True)
     async def reload(self, ctx) -> None:
+        # Wait for the users to be saved without blocking the event loop, the
+        # save in cog_unload() will then only have to write users modified
+        # since.
+        await self.economy.save()
         try:
             self.bot.reload_extension(__name__)
             self.bot.reload_extension('sweepstakes_cog')
@@ -63,66 +166,152 @@ class BotInterface(Cog, name='General commands'):
             await ctx.message.add_reaction('✅')
 
     @commands.is_owner()
-    @commands.command(help='Starts a debugging shell.', hidden=True)
-    async def drop_to_shell(self, ctx):
+    @commands.command(help='Reloads items.json without reloading the users.',
+                      hidden=True)
+    async def reload_items(self, ctx) -> None:
+        added, removed, changed = await self.economy.reload_items()
+
+        # The ledger process has its own copy of the catalog. Other bot
+        # processes will have to reload their catalogs separately.
+        if self.pc is None:
+            self.items.update_from(ItemInterface.from_dict(
+                db.load(self.item_filename)))
+            self.recipes.update_merges()
+
+        await ctx.send(f'Reloaded items: {added} added, {removed} removed '
+                       f'and {changed} changed.')
+
+    @commands.is_owner()
+    @commands.command(help='Shows how long commands and listeners take.',
+                      hidden=True)
+    async def stats(self, ctx) -> None:
+        lines = [f'{"Name":<32} {"Calls":>7} {"Errors":>6} {"Mean":>8} '
+                 f'{"p99":>8} {"Total":>8}']
+        for summary in metrics.registry.summary()[:15]:
+            name = f'{summary.kind}: {summary.name}'
+            if len(name) > 32:
+                name = name[:31] + '…'
+            lines.append(f'{name:<32} {summary.calls:>7,} '
+                         f'{summary.errors:>6,} '
+                         f'{_format_seconds(summary.mean):>8} '
+                         f'{_format_seconds(summary.p99):>8} '
+                         f'{_format_seconds(summary.total):>8}')
+
+        saves = metrics.registry.saves
+        msg = '```\n' + '\n'.join(lines) + '\n```'
+        msg += (f'Event loop lag: p50 '
+                f'{_format_seconds(self.watchdog.percentile(50))}, p99 '
+                f'{_format_seconds(self.watchdog.percentile(99))}, blocked '
+                f'{self.watchdog.blocked:,} times\n')
+        if saves.count:
+            msg += (f'Saves: {saves.count:,} (mean '
+                    f'{_format_seconds(saves.sum / saves.count)}, last '
+                    f'{metrics.registry.last_save_bytes:,} bytes, '
+                    f'{metrics.registry.save_errors:,} failed)')
+        await ctx.send(msg)
+
+    # The profiling commands don't block the event loop, so the bot keeps
+    # running normally while they are profiling it (see procoin.profiler).
+    @commands.is_owner()
+    @commands.command(help='Profiles the bot for a number of seconds and '
+                      'shows the functions that took the most time.',
+                      usage='[seconds]', hidden=True)
+    async def profile(self, ctx, seconds: float = 10.0) -> None:
+        seconds = min(max(seconds, 1.0), _max_profile_time)
         await ctx.message.add_reaction('⌛')
         try:
-            import code
-            code.interact(local={'self': self, 'bot': self.bot})
+            sampler = await profiler.sample(seconds)
+            filename = profiler.profile_filename(self.profile_dir, 'cpu',
+                                                 'txt')
+            await asyncio.get_event_loop().run_in_executor(None,
+                sampler.save, filename)
         finally:
-            if self.bot.user:
-                await ctx.message.add_reaction('✅')
-                await ctx.message.remove_reaction('⌛', self.bot.user)
+            await self.__remove_hourglass(ctx)
+
+        samples = max(sampler.samples, 1)
+        lines = [f'{"Total":>6} {"Self":>6}  Function']
+        for func, cumulative, own in sampler.top_functions(15):
+            lines.append(f'{cumulative * 100 / samples:>5.1f}% '
+                         f'{own * 100 / samples:>5.1f}%  '
+                         f'{profiler.format_function(func)[:60]}')
+        await ctx.send(f'{sampler.samples:,} samples in {seconds:g} seconds, '
+                       f'saved to `{filename}`.\n'
+                       f'```\n' + '\n'.join(lines) + '\n```')
+
+    @commands.is_owner()
+    @commands.command(aliases=['memprofile'],
+                      help='Traces memory allocations for a number of '
+                      'seconds and shows where the most memory was '
+                      'allocated.', usage='[seconds]', hidden=True)
+    async def trace_memory(self, ctx, seconds: float = 10.0) -> None:
+        seconds = min(max(seconds, 1.0), _max_profile_time)
+        await ctx.message.add_reaction('⌛')
+        try:
+            filename = profiler.profile_filename(self.profile_dir, 'memory',
+                                                 'tracemalloc')
+
+            # Saving the snapshot and grouping the allocations can be slow,
+            # so this is done in the executor with the snapshot.
+            def save(snapshot: Any) -> list[Any]:
+                snapshot.dump(filename)
+                return profiler.top_allocations(snapshot, 15)
+            _, top = await profiler.trace_memory(seconds, process=save)
+        finally:
+            await self.__remove_hourglass(ctx)
+
+        lines = [f'{"Size":>11} {"Blocks":>8}  Line']
+        for stat in top:
+            frame = stat.traceback[0]
+            location = f'{os.path.basename(frame.filename)}:{frame.lineno}'
+            lines.append(f'{stat.size / 1024:>7,.1f} KiB {stat.count:>8,}  '
+                         f'{location[:60]}')
+        await ctx.send(f'Allocations made in {seconds:g} seconds that are '
+                       f'still in use, saved to `{filename}`.\n'
+                       f'```\n' + '\n'.join(lines) + '\n```')
+
+    async def __remove_hourglass(self, ctx) -> None:
+        if self.bot.user:
+            await ctx.message.add_reaction('✅')
+            await ctx.message.remove_reaction('⌛', self.bot.user)
 
     @commands.command(aliases=['money'], help="Gets a user's balance.",
                       usage='[@mention]')
     async def bal(self, ctx, target_uid: str = '') -> None:
         target_uid = target_uid.strip(' <@!>')
+        balance = await self.economy.balance(target_uid or ctx.author.id,
+                                             create=not target_uid)
 
-        user: Optional[User]
-        if target_uid:
-            user = self.pc.users.find_by_id(target_uid)
-        else:
-            user = self.pc.users.get_or_create(ctx.author.id)
-
-        if not user:
+        if balance is None:
             await ctx.send("That user doesn't have a balance!")
             return
-        await ctx.send(f'<@{user.id}> has {format_currency(user.balance)}')
+        await ctx.send(f'<@{target_uid or ctx.author.id}> has '
+                       f'{format_currency(balance)}')
 
     @commands.command(help="Gets a user's boost.", usage='[@mention]')
     async def boost(self, ctx, target_uid: str = '') -> None:
         target_uid = target_uid.strip(' <@!>')
+        boost = await self.economy.boost(target_uid or ctx.author.id,
+                                         create=not target_uid)
 
-        user: Optional[User]
-        if target_uid:
-            user = self.pc.users.find_by_id(target_uid)
-        else:
-            user = self.pc.users.get_or_create(ctx.author.id)
-
-        if not user:
+        if boost is None:
             await ctx.send("That user doesn't have a boost!")
             return
-        await ctx.send(f'<@{user.id}> has a boost of '
-                       f'{format_currency(user.boost)}')
+        await ctx.send(f'<@{target_uid or ctx.author.id}> has a boost of '
+                       f'{format_currency(boost)}')
 
     @commands.command(aliases=['inventory'], help="Gets a user's inventory.",
                       usage='[@mention] [page]')
     async def inv(self, ctx, target_uid: str = '', page: int = 1) -> None:
         target_uid = target_uid.strip(' <@!>')
+        create = not target_uid
+        target_uid = target_uid or str(ctx.author.id)
+        pages = await self.economy.inventory(target_uid, create=create)
 
-        user: Optional[User]
-        if target_uid:
-            user = self.pc.users.find_by_id(target_uid)
-        else:
-            user = self.pc.users.get_or_create(ctx.author.id)
-
-        if not user:
+        if pages is None:
             await ctx.send("That user doesn't have an inventory!")
             return
 
-        username: str = self.get_username(user)
-        pages = user.get_inventory()
+        username: str = self.get_username(target_uid)
         page = min(max(page, 1), len(pages))
         embed = discord.Embed(title=f"{username}'s inventory.",
             description=pages[page - 1], colour=0xfdd835)
@@ -131,15 +320,73 @@ class BotInterface(Cog, name='General commands'):
             return
         await msg.add_reaction('◀️')
         await msg.add_reaction('▶️')
-        embed.set_image(url=f'{self.__img}#INV:{page}:{user.id}')
+        embed.set_image(url=f'{self.__img}#INV:{page}:{target_uid}')
         embed.set_footer(text=f'Page {page} of {len(pages)}')
         await msg.edit(embed=embed)
 
+    @commands.command(aliases=['lb', 'top'],
+                      help='Shows the users with the highest balance, boost '
+                           'or net worth.',
+                      usage='[balance|boost|networth] [count]')
+    async def leaderboard(self, ctx, kind: str = 'balance',
+            count: int = 10) -> None:
+        kind = _get_leaderboard_kind(kind)
+        count = min(max(count, 1), 25)
+        lines = [f'{i}. <@{user_id}>: {format_currency(score)}'
+                 for i, (user_id, score)
+                 in enumerate(await self.economy.leaderboard(kind, count),
+                              1)]
+        embed = discord.Embed(title=f'{_leaderboard_titles[kind]} '
+                                    f'leaderboard',
+            description='\n'.join(lines) or 'Nobody is on the leaderboard!',
+            colour=0xfdd835)
+        await ctx.send(embed=embed)
+
+    @commands.command(help="Shows a user's position on a leaderboard.",
+                      usage='[balance|boost|networth] [@mention]')
+    async def rank(self, ctx, kind: str = 'balance',
+            target_uid: str = '') -> None:
+        kind = _get_leaderboard_kind(kind)
+        target_uid = target_uid.strip(' <@!>') or str(ctx.author.id)
+        res = await self.economy.rank(kind, target_uid)
+        if not res:
+            await ctx.send("That user isn't on the leaderboard!")
+            return
+
+        rank, score, total = res
+        await ctx.send(f'<@{target_uid}> is #{rank:,} of {total:,} on the '
+                       f'{_leaderboard_titles[kind].lower()} leaderboard '
+                       f'with {format_currency(score)}.')
+
+    @commands.command(name='economy',
+                      help='Shows statistics about the whole economy.')
+    async def economy_stats(self, ctx) -> None:
+        stats, top_items = await self.economy.economy_stats(5)
+        msg = f'Users: {stats["users"]:,}\n' \
+              f'Money supply: {format_currency(stats["money_supply"])}\n' \
+              f'Total boost: {format_currency(stats["total_boost"])}\n' \
+              f'Items in circulation: {stats["items_in_circulation"]:,} ' \
+              f'({stats["distinct_items"]:,} different items worth ' \
+              f'{format_currency(stats["item_value"])})\n' \
+              f'Boosts paid: {stats["boost_payouts"]:,} ' \
+              f'({format_currency(stats["boost_paid"])})\n' \
+              f'Bought from the store: {stats["store_bought"]:,} items ' \
+              f'({format_currency(stats["store_bought_value"])})\n' \
+              f'Sold to the store: {stats["store_sold"]:,} items ' \
+              f'({format_currency(stats["store_sold_value"])})'
+        if top_items:
+            msg += '\n\n**Most common items:**\n' + '\n'.join(
+                f'`{count:,}x` {item.prefixed_name}'
+                for item, count in top_items)
+        embed = discord.Embed(title='The Economy', description=msg,
+                              colour=0xfdd835)
+        await ctx.send(embed=embed)
+
     @commands.command(help='Gives information on an item.',
                       usage='<item name>')
     async def info(self, ctx, *parameters: str) -> None:
         item_string = ' '.join(parameters)
-        item = self.pc.items.lookup(item_string)
+        item = self.items.lookup(item_string)
         if not item:
             await ctx.send("Couldn't find that item!")
             return
@@ -162,7 +409,7 @@ class BotInterface(Cog, name='General commands'):
             qty = int(parameters[-1])
             # Try finding the item string as-is for items ending in numbers
             # such as "Area 51".
-            if self.pc.items.lookup(item_string):
+            if self.items.lookup(item_string):
                 raise ValueError
             item_string = ' '.join(parameters[:-1])
         except ValueError:
@@ -178,11 +425,9 @@ class BotInterface(Cog, name='General commands'):
             return
         item_string, qty = self.__parse_item_and_quantity(parameters)
 
-        total_cost = self.pc.buy(ctx.author.id, item_string, qty)
-        if not self.pc.store.current_stock:
-            self.__update_store.restart()
+        total_cost = await self.economy.buy(ctx.author.id, item_string, qty)
         await ctx.send(f'{ctx.author.mention} bought {qty}'\
-                       f' {self.pc.items.lookup(item_string)}{_plural(qty)}'
+                       f' {self.items.lookup(item_string)}{_plural(qty)}'
                        f' for {format_currency(total_cost)}.')
 
     @commands.command(brief='Sells item(s) to the store.',
@@ -196,17 +441,16 @@ class BotInterface(Cog, name='General commands'):
         item_string, qty = self.__parse_item_and_quantity(parameters)
 
         # Error objects are now caught in a global handler.
-        sale_price = self.pc.sell(ctx.author.id, item_string, qty)
+        sale_price = await self.economy.sell(ctx.author.id, item_string, qty)
 
         await ctx.send(f'{ctx.author.mention} sold {qty}'\
-                       f' {self.pc.items.lookup(item_string)}{_plural(qty)}'
+                       f' {self.items.lookup(item_string)}{_plural(qty)}'
                        f' for {format_currency(sale_price)}.')
 
     @commands.command(help='Displays the store.')
     async def store(self, ctx) -> None:
-        next_update = self.pc.store.last_update + 3600
-        delay = round(max(next_update - time.time(), 0) / 60)
-        msg: str = self.pc.store.store_string
+        msg, last_update = await self.economy.store()
+        delay = round(max(last_update + 3600 - time.time(), 0) / 60)
         msg += f'\r\n*The store resets in {delay} minute{_plural(delay)}.*'
         embed = discord.Embed(title='The Store', description=msg,
                               colour=0xfdd835)
@@ -217,7 +461,7 @@ class BotInterface(Cog, name='General commands'):
     async def pay(self, ctx, target_uid: str, amount: int) -> None:
         # Remove the @mention wrapper from the UID
         target_uid = target_uid.strip(' <@!>')
-        self.pc.pay(ctx.author.id, target_uid, amount)
+        await self.economy.pay(ctx.author.id, target_uid, amount)
         await ctx.send(f'{ctx.author.mention} paid <@{target_uid}> '
                        f'{format_currency(amount)}.')
 
@@ -237,17 +481,62 @@ class BotInterface(Cog, name='General commands'):
         # Remove the @mention wrapper from the UID
         target_uid = target_uid.strip(' <@!>')
 
-        self.pc.give_item(ctx.author.id, target_uid, item_string, qty)
+        await self.economy.give_item(ctx.author.id, target_uid, item_string,
+                                     qty)
         await ctx.send(f'{ctx.author.mention} gave <@{target_uid}> {qty} '
-                       f'{self.pc.items.lookup(item_string)}'
+                       f'{self.items.lookup(item_string)}'
                        f'{_plural(qty)}!')
 
-    @commands.command(help='Displays a list of possible merges.')
-    async def merges(self, ctx) -> None:
-        msg: str = self.pc.merges.get_merges()
-        embed = discord.Embed(title='Possible Merges:', description=msg,
-                      colour=0xfdd835)
-        await ctx.send(embed=embed)
+    # Gets the merge pages for the merges command. using_id and makes_id are
+    # item IDs or empty strings.
+    def __get_merge_pages(self, using_id: str, makes_id: str) -> list[str]:
+        return self.recipes.get_merge_pages(
+            self.items.items.get(using_id) if using_id else None,
+            self.items.items.get(makes_id) if makes_id else None,
+        )
+
+    @commands.command(brief='Displays a list of possible merges.',
+                      help='Displays a list of possible merges. Use '
+                           '"using <item>" or "makes <item>" to only show '
+                           'merges that use or make an item.',
+                      usage='[using|makes <item name>] [page]')
+    async def merges(self, ctx, *parameters: str) -> None:
+        using_id = makes_id = ''
+        page = 1
+        if parameters and parameters[0].lower() in ('using', 'makes'):
+            item_string, page = self.__parse_item_and_quantity(parameters[1:])
+            item = self.items.lookup(item_string)
+            if not item:
+                await ctx.send("Couldn't find that item!")
+                return
+            if parameters[0].lower() == 'using':
+                using_id = item.id
+                title = f'Merges using {item}:'
+            else:
+                makes_id = item.id
+                title = f'Merges that make {item}:'
+        else:
+            if parameters:
+                try:
+                    page = int(parameters[0])
+                except ValueError:
+                    raise commands.UserInputError
+            title = 'Possible Merges:'
+
+        pages = self.__get_merge_pages(using_id, makes_id)
+        page = min(max(page, 1), len(pages))
+        embed = discord.Embed(title=title,
+            description=pages[page - 1] or 'There are no merges!',
+            colour=0xfdd835)
+        msg = await ctx.send(embed=embed)
+        if len(pages) < 2:
+            return
+        await msg.add_reaction('◀️')
+        await msg.add_reaction('▶️')
+        embed.set_image(url=f'{self.__img}#MERGES:{page}:{using_id}:'
+                            f'{makes_id}')
+        embed.set_footer(text=f'Page {page} of {len(pages)}')
+        await msg.edit(embed=embed)
 
     @commands.command(help='Displays a list of possible merges.',
                       usage='<upgrade 1>, <upgrade 2>, ... [amount]')
@@ -262,7 +551,7 @@ class BotInterface(Cog, name='General commands'):
 
         names: str
         result: Item
-        names, result = self.pc.merge(ctx.author.id, items, qty)
+        names, result = await self.economy.merge(ctx.author.id, items, qty)
 
         if qty > 1:
             times = f' {qty} times'
@@ -271,6 +560,43 @@ class BotInterface(Cog, name='General commands'):
         await ctx.send(f'{ctx.author.mention} merged {names}{times} to make '
                        f'{qty} {result.prefixed_name}{_plural(qty)}!')
 
+    @commands.command(aliases=['canmerge'],
+                      help='Lists the merges you can do with your current '
+                           'inventory.')
+    async def mergeable(self, ctx) -> None:
+        lines = sorted(f'{_recipe_string(recipe)} → {result} '
+                       f'(up to {amount:,}x)'
+                       for recipe, result, amount
+                       in await self.economy.possible_merges(ctx.author.id))
+        embed = discord.Embed(title='Merges you can do:',
+            description=_join_lines(lines) or "You can't merge anything!",
+            colour=0xfdd835)
+        await ctx.send(embed=embed)
+
+    @commands.command(aliases=['howto', 'craft'],
+                      help='Shows how to make an item from your inventory, '
+                           'including any merges needed to make the items '
+                           'in the recipe.',
+                      usage='<item name> [amount]')
+    async def plan(self, ctx, *parameters: str) -> None:
+        item_string, qty = self.__parse_item_and_quantity(parameters)
+        target, steps = await self.economy.plan_merges(ctx.author.id,
+                                                       item_string, qty)
+        if steps is None:
+            await ctx.send(f"{ctx.author.mention} You can't make {qty} "
+                           f"{target.prefixed_name}{_plural(qty)} with your "
+                           f"current inventory!")
+            return
+
+        lines = [f'{n}. Merge {_recipe_string(recipe)}'
+                 f'{f" {amount:,} times" if amount > 1 else ""} to make '
+                 f'{result.prefixed_name}'
+                 for n, (recipe, result, amount) in enumerate(steps, 1)]
+        embed = discord.Embed(title=f'How to make {qty} {target}'
+                                    f'{_plural(qty)}:',
+            description=_join_lines(lines), colour=0xfdd835)
+        await ctx.send(embed=embed)
+
     @commands.command(brief='Uses a scroll of remove curse.',
                       help='Uses a scroll of remove curse. You cannot control '
                            'which item the scroll will cleanse, and there is '
@@ -279,7 +605,7 @@ class BotInterface(Cog, name='General commands'):
     async def remove_curse(self, ctx, *parameters: str) -> None:
         if any(parameters):
             raise Error('This command takes no parameters!')
-        item, removed_item = self.pc.remove_curse(ctx.author.id)
+        item, removed_item = await self.economy.remove_curse(ctx.author.id)
         if removed_item:
             await ctx.send(f'The cursed item resists your scroll, and is '
                            f'eventually removed, but not before it can '
@@ -291,22 +617,43 @@ class BotInterface(Cog, name='General commands'):
     # future commands.Cog internal function, the name will be mangled by
     # Python transparently.
     @tasks.loop(minutes=60.0)
+    @metrics.timed('task', 'update_store')
     async def __update_store(self) -> None:
-        # Save the user database (in another thread)
-        self.pc.save_user_file()
+        # Save the user database (in another thread) and regenerate the store
+        await self.economy.restock()
 
-        # Regenerate the store
-        self.pc.store.regenerate_store()
-
-    # Call User.add_boost() if required.
+    # This is the only on_message listener, see procoin.events.
     @Cog.listener()
+    @metrics.timed('listener')
     async def on_message(self, message) -> None:
-        user = self.pc.users.find_by_id(message.author.id)
-        if user:
-            user.add_boost()
+        await self.messages.dispatch(message)
+
+    # Call User.add_boost() if required. This is queued on the ledger without
+    # waiting for it to be applied.
+    def __handle_message(self, event: MessageEvent) -> None:
+        self.economy.add_boost(event.author_id, event.time)
+
+    # Record the latency of every command (see procoin.metrics). Errors are
+    # counted in on_command_error() as after hooks can't see them.
+    async def cog_before_invoke(self, ctx) -> None:
+        ctx.procoin_handler = metrics.enter_handler('command',
+            ctx.command.qualified_name)
+        ctx.procoin_start = time.perf_counter()
+
+    async def cog_after_invoke(self, ctx) -> None:
+        start = getattr(ctx, 'procoin_start', None)
+        if start is not None:
+            metrics.registry.observe('command', ctx.command.qualified_name,
+                                     time.perf_counter() - start)
+            metrics.exit_handler(ctx.procoin_handler)
 
     @Cog.listener()
+    @metrics.timed('listener')
     async def on_command_error(self, ctx, error: BaseException) -> None:
+        name = ctx.command.qualified_name if ctx.command else '(unknown)'
+        metrics.registry.count_error('command', name,
+                                     metrics.error_name(error))
+
         if isinstance(error, commands.CommandNotFound):
             await ctx.send(f'Invalid command! Use {ctx.prefix}'
                            f'help for a list of commands.')
@@ -337,6 +684,7 @@ class BotInterface(Cog, name='General commands'):
 
     __img = 'https://upload.wikimedia.org/wikipedia/commons/c/ca/1x1.png'
     @Cog.listener()
+    @metrics.timed('listener')
     async def on_reaction_add(self, reaction, user) -> None:
         message = reaction.message
         if message.author.id != self.bot.user.id or not reaction.me:
@@ -350,23 +698,32 @@ class BotInterface(Cog, name='General commands'):
         # Get the URL
         embed = message.embeds[0]
         if not embed.image or not embed.image.url.startswith(self.__img +
-                '#INV:'):
+                '#'):
             return
 
-        # Parse the URL
+        # Parse the URL, which is in the format "#<kind>:<page>:<args>".
+        kind, _, url_args = embed.image.url[len(self.__img) + 1:].partition(
+            ':')
         try:
-            page_s, user_id = embed.image.url.rsplit('#INV:', 1)[-1].split(':', 1)
+            page_s, args = url_args.split(':', 1)
             page = int(page_s)
         except ValueError:
             return
         page = max(page + (emoji == '▶️') * 2 - 1, 1)
 
+        # Get the pages
+        if kind == 'INV':
+            pages = await self.economy.inventory(args, create=True)
+        elif kind == 'MERGES':
+            using_id, _, makes_id = args.partition(':')
+            pages = self.__get_merge_pages(using_id, makes_id)
+        else:
+            return
+
         # Set the page
-        user = self.pc.users.get_or_create(user_id)
-        pages = user.get_inventory()
         page = min(len(pages), page)
         embed.description = pages[page - 1]
-        embed.set_image(url=f'{self.__img}#INV:{page}:{user_id}')
+        embed.set_image(url=f'{self.__img}#{kind}:{page}:{args}')
         embed.set_footer(text=f'Page {page} of {len(pages)}')
         asyncio.ensure_future(message.edit(embed=embed))
 
@@ -379,12 +736,22 @@ class BotInterface(Cog, name='General commands'):
             except discord.Forbidden:
                 break
 
-    # Save the user file (and block) when the cog is unloaded. This has to
-    # block as otherwise reloads might lose data.
+    # Save the user file when the cog is unloaded. This doesn't have to block
+    # as loading the users waits for any pending saves. Any operations still
+    # queued on the ledger are applied first.
     def cog_unload(self) -> None:
-        print('[DEBUG] Saving user file in main thread...')
-        self.pc.save_user_file_blocking()
-        print('[DEBUG] Done.')
-
+        self.__update_store.cancel()
+        self.watchdog.stop()
+        if self.__metrics_task:
+            self.__metrics_task.cancel()
+        if self.__metrics_server:
+            self.__metrics_server.close()
+        self.economy.close()
+        if self.pc:
+            self.pc.save_user_file()
+            self.pc.close()
+
+# procoin_bot.py sets bot.procoin_ledger if a ledger process should be used.
 def setup(bot):
-    bot.add_cog(BotInterface(bot, os.getcwd()))
+    bot.add_cog(BotInterface(bot, os.getcwd(),
+                             getattr(bot, 'procoin_ledger', None)))
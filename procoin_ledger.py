@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+#
+# Runs the ledger process that owns the economy when the bot is split into
+# several processes. Start this first, then start each bot process with
+# --ledger pointing at the same socket (see procoin_bot.py).
+#
+
+from __future__ import annotations
+import argparse, asyncio, os
+from procoin import metrics
+from procoin.core import ProCoin
+from procoin.ledger import Ledger
+from procoin.rpc import LedgerServer
+from procoin.snapshots import SnapshotManager
+from procoin.storage import find_users_file
+from procoin.watchdog import Watchdog
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', default='procoin.sock',
+                        help='The Unix domain socket to listen on.')
+    parser.add_argument('--directory', default=os.getcwd(),
+                        help='The directory containing items.json and the '
+                        'users file.')
+    parser.add_argument('--metrics-port', type=int,
+                        help='Serve Prometheus metrics on this port (on '
+                        'localhost only).')
+    args = parser.parse_args()
+
+    user_filename = find_users_file(args.directory)
+    snapshots = SnapshotManager(os.path.join(args.directory, 'snapshots'))
+    pc = ProCoin(os.path.join(args.directory, 'items.json'), user_filename,
+                 snapshots=snapshots)
+    ledger = Ledger()
+    server = LedgerServer(pc, ledger)
+    metrics.add_ledger_gauges(ledger)
+    metrics.registry.add_gauge('procoin_ledger_requests_total',
+                               'Requests received from bot processes.',
+                               lambda : server.requests,
+                               metric_type='counter')
+
+    loop = asyncio.get_event_loop()
+    watchdog = Watchdog()
+    watchdog.start(loop)
+    unix_server = loop.run_until_complete(server.start(args.socket))
+    if args.metrics_port:
+        loop.run_until_complete(
+            metrics.start_http_server(args.metrics_port))
+    print(f'Listening on {args.socket}')
+    try:
+        loop.run_until_complete(server.run_store_loop())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watchdog.stop()
+        unix_server.close()
+        ledger.close()
+        pc.save_user_file_blocking()
+        pc.close()
+        os.remove(args.socket)
+
+if __name__ == '__main__':
+    main()
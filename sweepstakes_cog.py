@@ -1,24 +1,25 @@
 from __future__ import annotations
 import discord # type: ignore
-import time
 from discord.ext import commands # type: ignore
 from random import choice, randint
+from collections.abc import Awaitable
 from typing import Optional
 
 # When type checking, procoin_cog.Cog is a dummy object so annotations work.
 from procoin_cog import Cog
-from procoin.core import ProCoin
+from procoin.events import MessageEvent
 from procoin.items import Item
+from procoin.rpc import Economy
 
 class _SpamCounter:
     __slots__ = ('author_id', 'messages', 'expiry')
-    def __init__(self, author_id: int):
+    def __init__(self, author_id: int, t: float):
         self.author_id = author_id
         self.messages = 0
-        self.expiry = time.time() + 10
+        self.expiry = t + 10
 
-    def is_valid_for(self, author_id: int):
-        return author_id == self.author_id and self.expiry > time.time()
+    def is_valid_for(self, author_id: int, t: float):
+        return author_id == self.author_id and self.expiry > t
 
 class Sweepstakes(Cog):
     __slots__ = ('bot', 'next_event', 'next_item', 'in_race', 'spam_count')
@@ -30,32 +31,44 @@ class Sweepstakes(Cog):
         self.spam_count: dict[int, _SpamCounter] = {}
         self.in_race = False
 
+        # Messages are dispatched by the general commands cog (see
+        # procoin.events).
+        cog = self.bot.get_cog('General commands')
+        if cog:
+            cog.messages.add_handler(self.handle_message)
+
+    def cog_unload(self) -> None:
+        cog = self.bot.get_cog('General commands')
+        if cog:
+            cog.messages.remove_handler(self.handle_message)
+
     @property
-    def pc(self) -> ProCoin:
+    def economy(self) -> Economy:
         cog = self.bot.get_cog('General commands')
         assert cog
-        return cog.pc
+        return cog.economy
 
-    # Reward people who spam with cursed items
-    async def __check_for_spam(self, message) -> None:
-        spam_count = self.spam_count.get(message.guild.id)
+    # Reward people who spam with cursed items. Returns True if the author
+    # should get a cursed item.
+    def __check_for_spam(self, event: MessageEvent) -> bool:
+        spam_count = self.spam_count.get(event.guild_id)
 
-        if not spam_count or not spam_count.is_valid_for(message.author.id):
-            spam_count = _SpamCounter(message.author.id)
-            self.spam_count[message.guild.id] = spam_count
+        if not spam_count or \
+                not spam_count.is_valid_for(event.author_id, event.time):
+            spam_count = _SpamCounter(event.author_id, event.time)
+            self.spam_count[event.guild_id] = spam_count
 
         spam_count.messages += 1
-        if spam_count.messages < 7 or randint(0, 2):
-            return
+        return spam_count.messages >= 7 and not randint(0, 2)
 
-        await self.give_prize(message, self.__get_cursed_item())
-
-    @commands.Cog.listener()
-    async def on_message(self, message) -> None:
-        if message.author.bot or message.guild is None:
-            return
-
-        await self.__check_for_spam(message)
+    # Called for every guild message by procoin.events.MessageDispatcher.
+    # Returns an awaitable if any messages have to be sent.
+    def handle_message(self, event: MessageEvent) \
+            -> Optional[Awaitable[None]]:
+        message = event.message
+        actions: list[Awaitable[None]] = []
+        if self.__check_for_spam(event):
+            actions.append(self.give_prize(message, self.__get_cursed_item()))
 
         if self.in_race:
             if self.bot.user.mentioned_in(message):
@@ -63,22 +76,30 @@ class Sweepstakes(Cog):
                 item = self.next_item
                 self.next_item = None
                 assert item is not None
-                await self.give_prize(message, item)
-            return
+                actions.append(self.give_prize(message, item))
         else:
             self.next_event -= 1
-
-        if self.next_event <= 0:
-            self.__set_timer()
-            if randint(0, 1) == 1:
-                # Do sweepstakes
-                await self.do_sweepstake(message)
-            else:
-                # Start a race
-                self.next_item = self.__get_random_prize()
-                self.in_race = True
-                await message.channel.send(f'The next person to @mention me ' \
-                    f'will receive 1 {self.next_item.prefixed_name}!')
+            if self.next_event <= 0:
+                self.__set_timer()
+                if randint(0, 1) == 1:
+                    # Do sweepstakes
+                    actions.append(self.do_sweepstake(message))
+                else:
+                    # Start a race
+                    self.next_item = self.__get_random_prize()
+                    self.in_race = True
+                    actions.append(message.channel.send(f'The next person '
+                        f'to @mention me will receive 1 '
+                        f'{self.next_item.prefixed_name}!'))
+
+        if actions:
+            return self.__run_actions(actions)
+        return None
+
+    @staticmethod
+    async def __run_actions(actions: list[Awaitable[None]]) -> None:
+        for action in actions:
+            await action
 
     async def do_sweepstake(self, message) -> None:
         prize = self.__get_random_prize()
@@ -86,8 +107,7 @@ class Sweepstakes(Cog):
 
     async def give_prize(self, message, prize: Item,
                          congratulations: str = 'Congratulations') -> None:
-        user = self.pc.users.get_or_create(message.author.id)
-        user.add_item(prize, 1)
+        await self.economy.add_item(message.author.id, prize, 1)
         await message.channel.send(f'{congratulations}! '
             f'{message.author.mention} won a {prize.prefixed_name}!')
 
@@ -98,11 +118,11 @@ class Sweepstakes(Cog):
         return item.cost < 1_000_000_000 and not item.cursed
 
     def __get_random_prize(self) -> Item:
-        items = tuple(self.pc.items.filter_by(self.__item_filter))
+        items = tuple(self.economy.items.filter_by(self.__item_filter))
         return choice(items)
 
     def __get_cursed_item(self) -> Item:
-        items = tuple(self.pc.items.filter_by(
+        items = tuple(self.economy.items.filter_by(
             lambda item : item.cursed and item.boost <= 0
         ))
         return choice(items)
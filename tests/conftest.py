@@ -0,0 +1,45 @@
+from __future__ import annotations
+import json, os, pathlib
+from collections.abc import Callable, Iterator
+from typing import Optional
+import pytest
+from procoin import db
+from procoin.core import ProCoin
+from procoin.storage import Storage
+
+items = {
+    'apple': {'name': 'Apple', 'cost': 100, 'boost': 1, 'default_qty': 10},
+    'pear': {'name': 'Pear', 'cost': 250, 'boost': 2, 'default_qty': 5},
+    'gold': {'name': 'Gold', 'cost': 10 ** 12, 'boost': 3000,
+             'default_qty': 1},
+    'pie': {'name': 'Pie', 'cost': 500, 'boost': 5, 'default_qty': 0,
+            'merges': [['apple', 'pear']]},
+    'tart': {'name': 'Tart', 'cost': 2000, 'boost': 20, 'default_qty': 0,
+             'merges': [['pie', 'pie', 'apple']]},
+    'rock': {'name': 'Cursed Rock', 'cost': 1, 'boost': -5,
+             'default_qty': 3, 'cursed': True},
+    'remove_curse': {'name': 'Scroll of Remove Curse', 'cost': 300_000,
+                     'boost': 2020, 'default_qty': 0,
+                     'merges': [['gold', 'pear']]},
+}
+
+# Creates ProCoin objects that use a temporary items.json and users file
+# (users.json unless another name is specified).
+@pytest.fixture
+def make_procoin(tmp_path: pathlib.Path) \
+        -> Iterator[Callable[..., ProCoin]]:
+    item_file = os.path.join(tmp_path, 'items.json')
+    with open(item_file, 'w') as f:
+        json.dump(items, f)
+
+    instances: list[ProCoin] = []
+    def make(user_file: str = 'users.json',
+            storage: Optional[Storage] = None) -> ProCoin:
+        pc = ProCoin(item_file, os.path.join(tmp_path, user_file), storage)
+        instances.append(pc)
+        return pc
+
+    yield make
+    db.flush()
+    for pc in instances:
+        pc.close()
@@ -0,0 +1,91 @@
+from __future__ import annotations
+import os, pathlib
+from collections.abc import Callable
+from typing import Any
+import pytest
+from procoin import binary, db
+from procoin.core import ProCoin
+
+users: dict[str, Any] = {
+    '1': {'balance': 0, 'inventory': {}},
+    '2': {'balance': -5, 'inventory': {'apple': 3, 'pear': -1}},
+    '3': {'balance': 2 ** 70, 'inventory': {'gold': 2 ** 64 + 1}},
+    '4': {'balance': -2 ** 70, 'inventory': {'apple': 255, 'pear': 256}},
+    'ユーザー': {'balance': 1, 'inventory': {'🍎': 1, 'apple': -128}},
+}
+
+@pytest.mark.parametrize('data', [users, {}])
+def test_round_trip(data: dict[str, Any]) -> None:
+    raw = binary.dumps(data)
+    assert binary.is_binary(raw)
+    lazy = binary.LazyUsers.from_buffer(raw)
+    assert len(lazy) == len(data)
+    assert dict(lazy.items()) == data
+
+def test_file_round_trip(tmp_path: pathlib.Path) -> None:
+    filename = os.path.join(tmp_path, 'users.bin')
+    db.save_blocking(filename, users, codec='binary')
+    assert db.detect_codec(filename) is db.codecs['binary']
+    for use_mmap in (True, False):
+        assert dict(binary.load(filename, use_mmap).items()) == users
+    assert dict(db.load_users(filename).items()) == users
+
+def test_invalid() -> None:
+    with pytest.raises(ValueError):
+        binary.dumps({'a\0b': {'balance': 0, 'inventory': {}}})
+    with pytest.raises(binary.FormatError):
+        binary.LazyUsers.from_buffer(b'PCUSERS')
+    with pytest.raises(binary.FormatError):
+        binary.LazyUsers.from_buffer(b'{}' * 20)
+
+def test_lazy_users() -> None:
+    lazy = binary.LazyUsers.from_buffer(binary.dumps(users))
+    lazy['5'] = {'balance': 5, 'inventory': {}}
+    lazy['1'] = {'balance': 1, 'inventory': {}}
+    del lazy['2']
+    assert '2' not in lazy and '1' in lazy and '5' in lazy
+    assert lazy['1']['balance'] == 1
+    assert sorted(lazy) == sorted(['1', '3', '4', '5', 'ユーザー'])
+
+    # Users in the merged mapping replace existing ones, whether they come
+    # from a file or were set.
+    other = binary.LazyUsers.from_buffer(
+        binary.dumps({'3': {'balance': 3, 'inventory': {}}}))
+    other['ユーザー'] = {'balance': 7, 'inventory': {}}
+    lazy.merge(other)
+    assert lazy['3']['balance'] == 3
+    assert lazy['ユーザー']['balance'] == 7
+    assert len(lazy) == 5
+
+# Shards saved with different codecs can be loaded together.
+def test_mixed_shards(tmp_path: pathlib.Path) -> None:
+    dirname = os.path.join(tmp_path, 'users.d')
+    db.save_shards_blocking(dirname, {0: {'1': users['1'], '2': users['2']}})
+    db.save_shards_blocking(dirname, {1: {'3': users['3'], '4': users['4']}},
+                            codec='binary')
+    loaded = db.load_shards(dirname)
+    assert isinstance(loaded, binary.LazyUsers)
+    assert dict(loaded.items()) == \
+        {k: v for k, v in users.items() if k in ('1', '2', '3', '4')}
+
+    # Saving a shard with another codec replaces the old file.
+    db.save_shards_blocking(dirname, {1: {'3': users['3']}})
+    assert sorted(os.listdir(dirname)) == ['0.json', '1.json']
+
+def test_binary_storage(make_procoin: Callable[..., ProCoin]) -> None:
+    pc = make_procoin('users.bin')
+    pc.add_item('1', pc.items.get_item('gold'), 3)
+    pc.add_item('2', pc.items.get_item('apple'), 1)
+    pc.pay('1', '2', 10)
+    pc.save_user_file_blocking()
+    pc.pay('2', '1', 5)
+    expected = pc.users.to_dict()
+    pc.close()
+
+    pc2 = make_procoin('users.bin')
+    assert pc2.users.to_dict() == expected
+    dirname = pc2.storage.dirname
+    assert os.listdir(dirname)
+    for fn in os.listdir(dirname):
+        assert db.detect_codec(os.path.join(dirname, fn)) is \
+            db.codecs['binary']
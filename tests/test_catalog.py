@@ -0,0 +1,90 @@
+from __future__ import annotations
+import json
+from collections.abc import Callable
+from procoin.core import ProCoin
+from procoin.users import leaderboard_scores
+
+def _expected_leaderboard(pc: ProCoin, kind: str) -> list[tuple[str, int]]:
+    scores = []
+    for user_id in list(pc.users.users) + list(pc.users._raw):
+        user = pc.users.find_by_id(user_id)
+        assert user is not None
+        scores.append((user_id, leaderboard_scores[kind](user)))
+    return sorted(set(scores), key=lambda i : (-i[1], i[0]))
+
+# Reloading the catalog updates users that have changed or removed items,
+# whether or not they have been converted to User objects, along with the
+# stats, leaderboards and store.
+def test_reload_items(make_procoin: Callable[..., ProCoin]) -> None:
+    pc = make_procoin()
+    for i in range(40):
+        user = pc.users.get_or_create(str(i))
+        user.add_item(pc.items.get_item('apple'), i % 3 + 1)
+        if i % 2:
+            user.add_item(pc.items.get_item('rock'), i)
+        if i % 5 == 0:
+            user.add_item(pc.items.get_item('gold'), 1)
+    pc.save_user_file_blocking()
+    pc.close()
+
+    # Only some of the users are converted to User objects before the
+    # reload.
+    pc = make_procoin()
+    for i in range(0, 40, 3):
+        assert pc.users.find_by_id(str(i)) is not None
+    stats = pc.users.get_stats()
+    for kind in leaderboard_scores:
+        pc.leaderboard(kind, 1)
+    rock = pc.items.get_item('rock')
+    pc.store.sell(rock, 2)
+    pc.store.sell(pc.items.get_item('apple'), 2)
+
+    with open(pc.item_filename) as f:
+        new_items = json.load(f)
+    del new_items['rock']
+    new_items['apple']['boost'] = 7
+    new_items['apple']['cost'] = 123
+    new_items['plum'] = {'name': 'Plum', 'cost': 10, 'boost': 3}
+    with open(pc.item_filename, 'w') as f:
+        json.dump(new_items, f)
+
+    changes = pc.reload_items()
+    apple = pc.items.get_item('apple')
+    assert changes.removed == [rock]
+    assert changes.changed == [(apple, 1, 100)]
+    assert [item.id for item in changes.added] == ['plum']
+    assert list(pc.store.current_stock) == [apple]
+    assert pc.users.get_stats() is stats
+    assert pc.users.verify_stats() == []
+    assert stats.item_counts['apple'] == sum(i % 3 + 1 for i in range(40))
+
+    # The leaderboards are checked before the remaining users are converted
+    # to User objects.
+    leaderboards = {kind: pc.leaderboard(kind, 100)
+                    for kind in leaderboard_scores}
+    for kind, top in leaderboards.items():
+        assert top == _expected_leaderboard(pc, kind)
+
+    gold = pc.items.get_item('gold')
+    for i in range(40):
+        user = pc.users.find_by_id(str(i))
+        assert user is not None
+        expected = {'apple': i % 3 + 1}
+        if i % 5 == 0:
+            expected['gold'] = 1
+        assert {item.id: qty for item, qty in user.iter_items()} == expected
+        assert user.boost == 1 + 7 * (i % 3 + 1) + gold.boost * (i % 5 == 0)
+        assert user.net_worth == user.balance + 123 * (i % 3 + 1) + \
+            gold.cost * (i % 5 == 0)
+
+    # New items can be used, and the leaderboards are kept up to date.
+    pc.add_item('3', pc.items.get_item('plum'), 4)
+    pc.sell('4', 'apple', 1)
+    assert pc.users.verify_stats() == []
+    for kind in leaderboard_scores:
+        assert pc.leaderboard(kind, 100) == _expected_leaderboard(pc, kind)
+
+    expected_users = pc.users.to_dict()
+    pc.save_user_file_blocking()
+    pc.close()
+    assert make_procoin().users.to_dict() == expected_users
@@ -0,0 +1,49 @@
+from __future__ import annotations
+import os, pathlib
+from collections.abc import Callable
+import pytest
+from procoin.core import ProCoin
+from procoin.users import leaderboard_scores
+
+np = pytest.importorskip('numpy')
+from procoin import columnar
+
+# Balances and quantities that don't fit in 64 bits are kept exactly.
+@pytest.mark.parametrize('huge', [False, True])
+def test_snapshot(make_procoin: Callable[..., ProCoin],
+        tmp_path: pathlib.Path, huge: bool) -> None:
+    pc = make_procoin()
+    for i in range(20):
+        pc.add_item(str(i), pc.items.get_item('apple'), i + 1)
+        if i % 3 == 0:
+            pc.add_item(str(i), pc.items.get_item('gold'), i + 1)
+    if huge:
+        pc.add_cash('1', 2 ** 70)
+        pc.add_item('2', pc.items.get_item('gold'), 2 ** 64)
+        pc.add_item('3', pc.items.get_item('pear'), 2 ** 62)
+        pc.add_item('4', pc.items.get_item('pear'), 2 ** 62)
+
+    dirname = os.path.join(tmp_path, 'columnar')
+    columnar.Snapshot.from_users(pc.users).save(dirname)
+    for mmap in (True, False):
+        snapshot = columnar.Snapshot.load(dirname, mmap)
+        assert len(snapshot) == 20
+        assert (snapshot.balances.dtype == object) == huge
+        assert (snapshot.quantities.dtype == object) == huge
+
+        for kind, values in (('boost', snapshot.boosts()),
+                             ('net_worth', snapshot.net_worths()),
+                             ('balance', snapshot.balances)):
+            expected = {}
+            for user_id in snapshot.user_ids:
+                user = pc.users.find_by_id(str(user_id))
+                assert user is not None
+                expected[str(user_id)] = leaderboard_scores[kind](user)
+            assert [int(v) for v in values] == \
+                [expected[str(u)] for u in snapshot.user_ids]
+
+        counts = pc.users.get_stats().item_counts
+        assert {str(snapshot.item_ids[i]): int(count) for i, count
+                in enumerate(snapshot.item_counts()) if count} == counts
+        assert 0 <= columnar.gini(snapshot.net_worths()) <= 1
+        assert len(columnar.percentiles(snapshot.balances)) == 6
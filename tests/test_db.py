@@ -0,0 +1,43 @@
+from __future__ import annotations
+import os, pathlib, threading
+from collections.abc import Mapping
+from typing import Any
+from procoin import db
+
+# Waits for resume to be set before saving.
+class _SlowCodec(db.JSONCodec):
+    __slots__ = ('started', 'resume')
+
+    def __init__(self, started: threading.Event,
+            resume: threading.Event) -> None:
+        self.started = started
+        self.resume = resume
+
+    def dumps(self, data: Mapping[str, Any]) -> bytes:
+        self.started.set()
+        self.resume.wait()
+        return super().dumps(data)
+
+# Loading a file only waits for saves to that file, so reloading the items
+# doesn't wait for the users to be saved.
+def test_load_waits_for_file(tmp_path: pathlib.Path) -> None:
+    items_file = os.path.join(tmp_path, 'items.json')
+    db.save_blocking(items_file, {'a': 1})
+
+    started = threading.Event()
+    resume = threading.Event()
+    slow = db.save(os.path.join(tmp_path, 'users.json'), {},
+                   codec=_SlowCodec(started, resume))
+    started.wait()
+    loaded: list[Any] = []
+    thread = threading.Thread(target=lambda : loaded.append(
+        db.load(items_file)))
+    thread.start()
+    thread.join(5)
+    try:
+        assert loaded == [{'a': 1}]
+        assert not slow.done()
+    finally:
+        resume.set()
+    db.flush()
+    assert slow.done()
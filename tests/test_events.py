@@ -0,0 +1,27 @@
+from __future__ import annotations
+import asyncio
+from types import SimpleNamespace
+from procoin import metrics
+from procoin.events import MessageDispatcher, MessageEvent
+
+def _message(bot: bool = False) -> SimpleNamespace:
+    return SimpleNamespace(author=SimpleNamespace(id=1, bot=bot),
+                           guild=SimpleNamespace(id=2))
+
+def test_failing_handler() -> None:
+    seen: list[int] = []
+    def failing(event: MessageEvent) -> None:
+        raise ValueError('Oops')
+    async def handler(event: MessageEvent) -> None:
+        seen.append(event.author_id)
+
+    dispatcher = MessageDispatcher()
+    dispatcher.add_handler(failing)
+    dispatcher.add_handler(handler)
+    asyncio.run(dispatcher.dispatch(_message()))
+    asyncio.run(dispatcher.dispatch(_message(bot=True)))
+
+    # The second handler still runs, and the error is counted.
+    assert seen == [1]
+    key = ('message handler', failing.__qualname__, 'ValueError')
+    assert metrics.registry.errors[key] == 1
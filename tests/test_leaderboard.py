@@ -0,0 +1,78 @@
+from __future__ import annotations
+import random
+import pytest
+from procoin.leaderboard import Leaderboard, _max_levels, _nil
+
+# Compares a leaderboard with a sorted list of the scores, and checks that
+# every level of the skip list skips the right number of users.
+def _check(leaderboard: Leaderboard, scores: dict[str, int]) -> None:
+    expected = sorted(scores.items(), key=lambda i : (-i[1], i[0]))
+    assert len(leaderboard) == len(scores)
+    assert leaderboard.top(len(scores) + 5) == expected
+    for n in (0, 1, 3):
+        assert leaderboard.top(n) == expected[:n]
+    for rank, (user_id, score) in enumerate(expected, 1):
+        assert leaderboard.rank(user_id) == rank
+        assert leaderboard.get_score(user_id) == score
+
+    ranks = {key: pos for pos, key in enumerate(
+        ((-score, user_id) for user_id, score in expected), 1)}
+    for level in range(_max_levels):
+        node = leaderboard._head
+        pos = 0
+        while node is not _nil:
+            pos += node.width[level]
+            node = node.next[level]
+            if node is not _nil:
+                assert ranks[node.key] == pos
+        assert pos == len(scores) + 1
+
+def test_empty() -> None:
+    leaderboard = Leaderboard()
+    assert leaderboard.top(10) == []
+    assert leaderboard.rank('1') is None
+    assert '1' not in leaderboard
+    _check(leaderboard, {})
+
+# Users with the same score are ordered by ID.
+def test_ties() -> None:
+    scores = {'b': 5, 'a': 5, 'c': 7, 'd': 5}
+    leaderboard = Leaderboard(scores)
+    assert leaderboard.top(4) == [('c', 7), ('a', 5), ('b', 5), ('d', 5)]
+    assert [leaderboard.rank(u) for u in 'abcd'] == [2, 3, 1, 4]
+
+    leaderboard.update('c', 5)
+    leaderboard.update('a', 5)
+    scores['c'] = 5
+    _check(leaderboard, scores)
+
+    leaderboard.remove('b')
+    del scores['b']
+    _check(leaderboard, scores)
+    assert 'b' not in leaderboard
+    with pytest.raises(KeyError):
+        leaderboard.remove('b')
+
+@pytest.mark.parametrize('built', [True, False])
+def test_random_operations(built: bool) -> None:
+    rng = random.Random(0)
+    scores = {str(i): rng.randint(-5, 20) for i in range(200)}
+    if built:
+        leaderboard = Leaderboard(scores)
+    else:
+        leaderboard = Leaderboard()
+        for user_id, score in scores.items():
+            leaderboard.update(user_id, score)
+    _check(leaderboard, scores)
+
+    for i in range(500):
+        user_id = str(rng.randrange(250))
+        if user_id in scores and rng.random() < 0.2:
+            leaderboard.remove(user_id)
+            del scores[user_id]
+        else:
+            scores[user_id] = rng.randint(-5, 20)
+            leaderboard.update(user_id, scores[user_id])
+        if i % 50 == 0:
+            _check(leaderboard, scores)
+    _check(leaderboard, scores)
@@ -0,0 +1,161 @@
+from __future__ import annotations
+from typing import Any, Optional
+import pytest
+from procoin.items import ItemInterface
+from procoin.merges import MergeInterface, MergeStep
+from procoin.store import Store
+from procoin.users import User
+
+catalog: dict[str, Any] = {
+    'a': {'name': 'A', 'cost': 1, 'boost': 1},
+    'b': {'name': 'B', 'cost': 2, 'boost': 1},
+    'c': {'name': 'C', 'cost': 5, 'boost': 2, 'merges': [['a', 'b']]},
+    'd': {'name': 'D', 'cost': 20, 'boost': 5, 'merges': [['c', 'c', 'a']]},
+
+    # x and y can be made from each other, x can also be made from a.
+    'x': {'name': 'X', 'cost': 3, 'boost': 1,
+          'merges': [['y'], ['a', 'a', 'a']]},
+    'y': {'name': 'Y', 'cost': 3, 'boost': 1, 'merges': [['x']]},
+
+    # Cursed items can't be merged.
+    'cursed': {'name': 'Cursed', 'cost': 1, 'boost': -1, 'cursed': True},
+    'z': {'name': 'Z', 'cost': 1, 'boost': 1, 'merges': [['cursed', 'a']]},
+}
+
+def _setup(inventory: dict[str, int]) -> tuple[MergeInterface, User]:
+    ii = ItemInterface.from_dict(catalog)
+    user = User(Store(ii), '1')
+    for item_id, qty in inventory.items():
+        user.add_item(ii.get_item(item_id), qty)
+    return MergeInterface(ii), user
+
+def _plan(mi: MergeInterface, user: User, target: str, amount: int) \
+        -> Optional[list[tuple[list[str], str, int]]]:
+    steps = mi.plan_merges(user, mi.items.get_item(target), amount)
+    if steps is None:
+        return None
+    return [(sorted(item.id for item in recipe), result.id, qty)
+            for recipe, result, qty in steps]
+
+# Does every step of a plan and returns the user's inventory.
+def _run(mi: MergeInterface, user: User, steps: list[MergeStep]) \
+        -> dict[str, int]:
+    for recipe, result, qty in steps:
+        assert mi.merge_item(user, recipe, qty)[1] is result
+    return {item.id: qty for item, qty in user.iter_items()}
+
+def test_multi_step() -> None:
+    mi, user = _setup({'a': 5, 'b': 3})
+    assert _plan(mi, user, 'd', 1) == \
+        [(['a', 'b'], 'c', 2), (['a', 'c', 'c'], 'd', 1)]
+    steps = mi.plan_merges(user, mi.items.get_item('d'), 1)
+    assert steps is not None
+    assert _run(mi, user, steps) == {'a': 2, 'b': 1, 'd': 1}
+
+# Items the user already has are used before anything is made, and plans
+# that need more items than the user has fail.
+@pytest.mark.parametrize('inventory,amount,expected', [
+    ({'c': 1, 'a': 2, 'b': 1}, 1,
+     [(['a', 'b'], 'c', 1), (['a', 'c', 'c'], 'd', 1)]),
+    ({'c': 2, 'a': 1}, 1, [(['a', 'c', 'c'], 'd', 1)]),
+    ({'a': 6, 'b': 4}, 2,
+     [(['a', 'b'], 'c', 4), (['a', 'c', 'c'], 'd', 2)]),
+    ({'a': 5, 'b': 4}, 2, None),
+    ({'a': 6, 'b': 3}, 2, None),
+    ({'c': 1, 'a': 1}, 1, None),
+    ({}, 1, None),
+])
+def test_quantity_limits(inventory: dict[str, int], amount: int,
+        expected: Optional[list[tuple[list[str], str, int]]]) -> None:
+    mi, user = _setup(inventory)
+    assert _plan(mi, user, 'd', amount) == expected
+    steps = mi.plan_merges(user, mi.items.get_item('d'), amount)
+    if steps is not None:
+        assert _run(mi, user, steps)['d'] == amount
+
+    # Planning doesn't modify the inventory.
+    if expected is None:
+        assert {item.id: qty for item, qty in user.iter_items()} == \
+            inventory
+
+# Recipe loops don't recurse forever, and other recipes are still tried.
+def test_cycles() -> None:
+    mi, user = _setup({'a': 3})
+    assert _plan(mi, user, 'y', 1) == \
+        [(['a', 'a', 'a'], 'x', 1), (['x'], 'y', 1)]
+    assert _plan(mi, user, 'y', 2) is None
+    assert _plan(mi, user, 'x', 1) == [(['a', 'a', 'a'], 'x', 1)]
+
+    # The target item can't be used to make itself.
+    mi, user = _setup({'x': 1})
+    assert _plan(mi, user, 'x', 1) is None
+    assert _plan(mi, user, 'y', 1) == [(['x'], 'y', 1)]
+
+def test_cursed() -> None:
+    mi, user = _setup({'cursed': 1, 'a': 1})
+    assert _plan(mi, user, 'z', 1) is None
+    assert mi.get_possible_merges(user) == []
+
+# Creates a catalog with n extra recipes, every fifth of which uses x.
+def _many_recipes(n: int) -> MergeInterface:
+    items = dict(catalog)
+    for i in range(n):
+        recipe = [f'item{i - 1}' if i else 'a', 'b']
+        if i % 5 == 0:
+            recipe.append('x')
+        items[f'item{i}'] = {'name': f'Item number {i:03}' + '!' * 40,
+                             'cost': 1, 'boost': 1, 'merges': [recipe]}
+    return MergeInterface(ItemInterface.from_dict(items))
+
+def test_merge_pages() -> None:
+    mi = _many_recipes(100)
+    pages = mi.get_merge_pages()
+    assert len(pages) > 1
+    assert all(len(page) <= 2048 for page in pages)
+    lines = '\n'.join(pages).split('\n')
+    assert lines == sorted(mi.get_merges().split('\n'))
+    assert len(lines) == len(mi.merges)
+
+    # The pages are cached.
+    assert mi.get_merge_pages() is pages
+
+    ii = mi.items
+    a, c, x, d = (ii.get_item(i) for i in ('a', 'c', 'x', 'd'))
+    using_x = '\n'.join(mi.get_merge_pages(using=x)).split('\n')
+    assert len(using_x) == 21
+    assert using_x == [line for line in lines if '`X`' in line]
+    assert mi.get_merge_pages(makes=d) == [mi._get_merge_lines()[(0, 2, 2)]]
+    assert mi.get_merge_pages(using=a, makes=d) == \
+        mi.get_merge_pages(makes=d)
+    assert mi.get_merge_pages(using=x, makes=d) == ['']
+    assert mi.get_merge_pages(using=ii.get_item('d')) == ['']
+    assert mi.get_merge_pages(makes=c) == [mi._get_merge_lines()[(0, 1)]]
+
+def test_merge_pages_cache_limit() -> None:
+    mi = _many_recipes(300)
+    items = list(mi.items.items.values())
+    for item in items:
+        mi.get_merge_pages(makes=item)
+        assert len(mi._merge_pages) <= 256
+    assert len(mi._merge_pages) == len(items) % 256
+
+# The pages are rebuilt after the catalog changes.
+def test_merge_pages_catalog_change() -> None:
+    ii = ItemInterface.from_dict(catalog)
+    mi = MergeInterface(ii)
+    c = ii.get_item('c')
+    assert 'C' in mi.get_merge_pages(makes=c)[0]
+    old_pages = mi.get_merge_pages()
+
+    new_catalog = dict(catalog)
+    new_catalog['c'] = {'name': 'Renamed', 'cost': 5, 'boost': 2,
+                        'merges': [['a', 'b'], ['a', 'a']]}
+    del new_catalog['z']
+    ii.update_from(ItemInterface.from_dict(new_catalog))
+    mi.update_merges()
+
+    pages = mi.get_merge_pages(makes=c)
+    assert len(pages[0].split('\n')) == 2
+    assert all('Renamed' in line for line in pages[0].split('\n'))
+    assert mi.get_merge_pages() != old_pages
+    assert 'Z' not in '\n'.join(mi.get_merge_pages())
@@ -0,0 +1,60 @@
+from __future__ import annotations
+import asyncio, os, pathlib, threading, time, tracemalloc
+import pytest
+from procoin import profiler
+
+def _busy(seconds: float) -> None:
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+def test_sample() -> None:
+    async def main() -> profiler.StackSampler:
+        task = asyncio.ensure_future(profiler.sample(0.3, interval=0.001))
+        await asyncio.sleep(0.05)
+        _busy(0.1)
+        sampler = await task
+
+        # The sampler thread has finished, so the samples can't change.
+        assert not any(thread.name == 'procoin.profiler sampler'
+                       for thread in threading.enumerate())
+        return sampler
+
+    sampler = asyncio.run(main())
+    assert sampler.samples == sum(sampler.stacks.values()) > 0
+    names = [func[2] for func, _, _ in sampler.top_functions()]
+    assert '_busy' in names
+
+def test_trace_memory(tmp_path: pathlib.Path) -> None:
+    filename = os.path.join(tmp_path, 'memory.tracemalloc')
+    kept: list[bytes] = []
+    def save(snapshot: tracemalloc.Snapshot) -> int:
+        assert threading.current_thread() is not threading.main_thread()
+        snapshot.dump(filename)
+        return len(profiler.top_allocations(snapshot))
+
+    async def main() -> tuple[tracemalloc.Snapshot, int]:
+        task = asyncio.ensure_future(profiler.trace_memory(0.1,
+                                                           process=save))
+        await asyncio.sleep(0.02)
+        kept.extend(bytes(1000) for _ in range(100))
+        snapshot, count = await task
+        assert count is not None
+        return snapshot, count
+
+    snapshot, count = asyncio.run(main())
+    assert not tracemalloc.is_tracing()
+    assert count == 10
+    assert os.path.exists(filename)
+    assert any(frame.filename == __file__
+               for stat in snapshot.statistics('lineno')
+               for frame in stat.traceback)
+
+    # Only one trace can run at once.
+    async def twice() -> None:
+        first = asyncio.ensure_future(profiler.trace_memory(0.05))
+        await asyncio.sleep(0)
+        with pytest.raises(profiler.ProfilerBusyError):
+            await profiler.trace_memory(0.05)
+        await first
+    asyncio.run(twice())
@@ -0,0 +1,30 @@
+from __future__ import annotations
+import asyncio, os, pathlib
+import pytest
+from procoin import rpc
+
+# Requests fail (instead of waiting forever) if the ledger sends an invalid
+# response, and the next request reconnects.
+def test_invalid_response(tmp_path: pathlib.Path) -> None:
+    path = os.path.join(tmp_path, 'ledger.sock')
+    responses = [b'\0\0\0\2{]', rpc._encode([2, None, 'ok'])]
+
+    async def handle_client(reader: asyncio.StreamReader,
+            writer: asyncio.StreamWriter) -> None:
+        await reader.readexactly(4)
+        writer.write(responses.pop(0))
+        await writer.drain()
+        await reader.read()
+
+    async def main() -> None:
+        server = await asyncio.start_unix_server(handle_client, path)
+        client = rpc.LedgerClient(path)
+        with pytest.raises(ConnectionError):
+            await asyncio.wait_for(client.call('balance', '1', False), 5)
+        assert await asyncio.wait_for(client.call('balance', '1', False),
+                                      5) == 'ok'
+        client.close()
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(main())
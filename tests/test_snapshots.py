@@ -0,0 +1,114 @@
+from __future__ import annotations
+import os, pathlib, time
+from collections.abc import Callable
+import pytest
+from procoin import snapshots
+from procoin.core import ProCoin
+from procoin.snapshots import SnapshotError, SnapshotManager
+
+def _populate(pc: ProCoin) -> None:
+    for i in range(20):
+        pc.users.get_or_create(str(i))
+    pc.add_item('1', pc.items.get_item('gold'), 2)
+    pc.add_item('2', pc.items.get_item('apple'), 3)
+    pc.add_cash('3', 2 ** 70)
+    pc.pay('3', '4', 2 ** 65)
+
+# The copy isn't affected by later changes, and includes users that haven't
+# been converted to User objects.
+def test_frozen_copy(make_procoin: Callable[..., ProCoin]) -> None:
+    pc = make_procoin()
+    _populate(pc)
+    pc.save_user_file_blocking()
+    pc.close()
+
+    pc = make_procoin()
+    pc.add_item('5', pc.items.get_item('pear'), 1)
+    copy = pc.users.frozen_copy()
+    expected = pc.users.to_dict()
+    pc.add_item('5', pc.items.get_item('pear'), 1)
+    pc.pay('1', '2', 1)
+    assert len(copy) == len(expected)
+    assert dict(copy) == expected
+
+@pytest.mark.parametrize('codec', ['json', 'binary'])
+@pytest.mark.parametrize('compression', ['zlib', 'lzma'])
+def test_take_and_restore(make_procoin: Callable[..., ProCoin],
+        tmp_path: pathlib.Path, codec: str, compression: str) -> None:
+    pc = make_procoin()
+    _populate(pc)
+    manager = SnapshotManager(os.path.join(tmp_path, 'snapshots'),
+                              codec=codec, compression=compression)
+    manager.take(pc.users, pc.items).result()
+    expected = pc.users.to_dict()
+
+    # Changes made after the snapshot are undone by restoring it.
+    pc.pay('4', '5', 100)
+    pc.save_user_file_blocking()
+    pc.close()
+
+    info = manager.latest_valid()
+    assert info is not None
+    assert info.users == len(expected)
+    assert info.catalog_hash == snapshots.catalog_hash(pc.items)
+    backup = snapshots.restore(info.filename, pc.storage)
+    assert os.path.isdir(os.path.join(backup, 'users.d'))
+    assert make_procoin().users.to_dict() == expected
+
+def test_corrupt_snapshot(make_procoin: Callable[..., ProCoin],
+        tmp_path: pathlib.Path) -> None:
+    pc = make_procoin()
+    _populate(pc)
+    manager = SnapshotManager(os.path.join(tmp_path, 'snapshots'))
+    manager.take(pc.users, pc.items).result()
+    filename = manager.snapshots()[0].filename
+    snapshots.verify(filename)
+    with open(filename, 'rb') as f:
+        raw = f.read()
+
+    body_offset = snapshots.read_info(filename).body_offset
+    damaged = bytearray(raw)
+    damaged[body_offset + 10] ^= 0xff
+    for data in (bytes(damaged), raw[:-8], raw[:body_offset + 5], b'junk'):
+        with open(filename, 'wb') as f:
+            f.write(data)
+        with pytest.raises(SnapshotError):
+            snapshots.verify(filename)
+        with pytest.raises(SnapshotError):
+            snapshots.restore(filename, pc.storage)
+    assert manager.latest_valid() is None
+
+    # Nothing is moved if the snapshot is invalid.
+    assert sorted(os.listdir(tmp_path)) == \
+        ['items.json', 'snapshots', 'users.json.journal']
+
+def test_prune(tmp_path: pathlib.Path) -> None:
+    manager = SnapshotManager(str(tmp_path), keep_hourly=2, keep_daily=2)
+    hour = 3600
+    times = [0, hour, 2 * hour, 24 * hour, 24 * hour + 60, 48 * hour]
+    for t in times:
+        name = time.strftime(snapshots._time_format, time.gmtime(t))
+        with open(os.path.join(tmp_path, f'users-{name}-000.snap'), 'w'):
+            pass
+
+    # The two newest hours and days are kept.
+    removed = manager.prune()
+    kept = sorted(created for _, created in manager._list())
+    assert kept == [24 * hour + 60, 48 * hour]
+    assert len(removed) == len(times) - 2
+
+# Restoring to an SQLite database isn't supported, and fails without
+# creating the database.
+def test_restore_to_sqlite(make_procoin: Callable[..., ProCoin],
+        tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    pc = make_procoin()
+    _populate(pc)
+    directory = os.path.join(tmp_path, 'snapshots')
+    SnapshotManager(directory).take(pc.users, pc.items).result()
+
+    users_db = os.path.join(tmp_path, 'users.db')
+    monkeypatch.setattr('sys.argv', ['snapshots', 'restore', directory,
+                                     users_db])
+    with pytest.raises(SystemExit, match='can only be restored'):
+        snapshots.main()
+    assert not os.path.exists(users_db)
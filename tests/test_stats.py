@@ -0,0 +1,71 @@
+from __future__ import annotations
+import random
+from collections.abc import Callable
+import pytest
+from procoin.core import ProCoin
+from procoin.store import Error
+
+# The running totals have to match the totals calculated from scratch after
+# any mix of operations, including ones on users that were loaded after the
+# stats were created.
+def test_running_totals(make_procoin: Callable[..., ProCoin]) -> None:
+    pc = make_procoin()
+    for i in range(10):
+        pc.users.get_or_create(str(i))
+    pc.add_item('0', pc.items.get_item('apple'), 5)
+    pc.add_item('1', pc.items.get_item('gold'), 1)
+    pc.save_user_file_blocking()
+    pc.close()
+
+    pc = make_procoin()
+    stats = pc.users.get_stats()
+    assert stats.users == 10
+    assert pc.users.verify_stats() == []
+
+    random.seed(0)
+    apple = pc.items.get_item('apple')
+    pear = pc.items.get_item('pear')
+    pc.pay('2', '3', 1_000)
+    pc.add_item('4', apple, 3)
+    pc.add_item('4', pear, 3)
+    pc.add_item('5', pc.items.get_item('rock'), 1)
+    pc.add_item('5', pc.items.get_item('remove_curse'), 2)
+    pc.add_item('5', pear, 1)
+    pc.sell('0', 'apple', 2)
+    pc.buy('6', 'apple', 1)
+    pc.give_item('4', '7', 'pear', 1)
+    pc.merge('4', ['apple', 'pear'], 2)
+    pc.remove_curse('5')
+    pc.add_cash('8', 2 ** 70)
+    pc.remove_cash('8', 2 ** 69)
+    pc.users.get_or_create('new')
+    for user_id in ('1', '4', '9'):
+        user = pc.users.find_by_id(user_id)
+        assert user is not None
+        user.add_boost()
+
+    # Failed transactions are rolled back.
+    with pytest.raises(Error):
+        pc.give_item('7', '6', 'gold', 1)
+    with pytest.raises(Error):
+        pc.buy('6', 'gold', 1)
+
+    assert pc.users.verify_stats() == []
+    assert stats.users == 11
+    assert stats.boost_payouts == 3
+    assert pc.users.get_stats() is stats
+
+def test_top_items(make_procoin: Callable[..., ProCoin]) -> None:
+    pc = make_procoin()
+    stats = pc.users.get_stats()
+    counts = {'apple': 5, 'pear': 5, 'gold': 7, 'pie': 1, 'tart': 5}
+    for item_id, qty in counts.items():
+        pc.add_item('1', pc.items.get_item(item_id), qty)
+
+    expected = [('gold', 7), ('apple', 5), ('pear', 5), ('tart', 5),
+                ('pie', 1)]
+    assert stats.top_items() == expected
+    for n in range(7):
+        assert stats.top_items(n) == expected[:n]
+    assert pc.top_items(2) == [(pc.items.get_item('gold'), 7),
+                               (pc.items.get_item('apple'), 5)]
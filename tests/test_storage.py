@@ -0,0 +1,172 @@
+from __future__ import annotations
+import glob, os, pathlib, threading
+from collections.abc import Callable
+from typing import Any
+import pytest
+from procoin import db
+from procoin.core import ProCoin
+
+def _balances(pc: ProCoin, *user_ids: str) -> list[int]:
+    res = []
+    for user_id in user_ids:
+        user = pc.users.find_by_id(user_id)
+        assert user is not None
+        res.append(user.balance)
+    return res
+
+def _setup(make_procoin: Callable[..., ProCoin]) -> ProCoin:
+    pc = make_procoin()
+    for user_id in ('user0', 'user1', 'user2', 'user3'):
+        pc.users.get_or_create(user_id)
+    pc.save_user_file_blocking()
+    return pc
+
+def _journal_files(pc: ProCoin) -> list[str]:
+    return glob.glob(pc.user_filename + '.journal.*')
+
+def test_journal_replay(make_procoin: Callable[..., ProCoin]) -> None:
+    pc = _setup(make_procoin)
+    pc.pay('user0', 'user1', 100)
+    pc.add_item('user2', pc.items.get_item('apple'), 3)
+    expected = pc.users.to_dict()
+    pc.close()
+
+    # Nothing has been saved since the transactions, so they have to come
+    # from the journal.
+    pc2 = make_procoin()
+    assert pc2.users.to_dict() == expected
+    assert pc2.users.dirty == {'user0', 'user1', 'user2'}
+
+def test_journal_rotation(make_procoin: Callable[..., ProCoin]) -> None:
+    pc = _setup(make_procoin)
+    pc.pay('user0', 'user1', 100)
+    future = pc.save_user_file()
+    pc.pay('user2', 'user3', 50)
+    future.result()
+
+    # The first transaction is in the saved shards, so only the current
+    # journal should be left.
+    assert _journal_files(pc) == []
+    expected = pc.users.to_dict()
+    pc.close()
+    assert make_procoin().users.to_dict() == expected
+
+def test_failed_save(make_procoin: Callable[..., ProCoin],
+        monkeypatch: pytest.MonkeyPatch) -> None:
+    pc = _setup(make_procoin)
+    pc.pay('user0', 'user1', 100)
+
+    dumps = db.JSONCodec.dumps
+    def fail_once(self: db.JSONCodec, data: dict[str, Any]) -> bytes:
+        monkeypatch.setattr(db.JSONCodec, 'dumps', dumps)
+        raise OSError('Disk full')
+    monkeypatch.setattr(db.JSONCodec, 'dumps', fail_once)
+
+    with pytest.raises(OSError):
+        pc.save_user_file_blocking()
+    assert _journal_files(pc)
+
+    # Saving an unrelated user must also save the users from the failed save.
+    pc.pay('user2', 'user3', 50)
+    pc.save_user_file_blocking()
+    assert _journal_files(pc) == []
+    expected = _balances(pc, 'user0', 'user1', 'user2', 'user3')
+    pc.close()
+
+    pc2 = make_procoin()
+    os.remove(pc2.storage.journal_filename)
+    pc2.close()
+    pc3 = make_procoin()
+    assert _balances(pc3, 'user0', 'user1', 'user2', 'user3') == expected
+
+# A save that was started before an earlier save failed doesn't include the
+# users from the failed save, so it can't discard their journal.
+def test_failed_save_during_save(make_procoin: Callable[..., ProCoin],
+        monkeypatch: pytest.MonkeyPatch) -> None:
+    pc = _setup(make_procoin)
+    pc.pay('user0', 'user1', 100)
+
+    started = threading.Event()
+    resume = threading.Event()
+    dumps = db.JSONCodec.dumps
+    def fail_once(self: db.JSONCodec, data: dict[str, Any]) -> bytes:
+        monkeypatch.setattr(db.JSONCodec, 'dumps', dumps)
+        started.set()
+        resume.wait()
+        raise OSError('Disk full')
+    monkeypatch.setattr(db.JSONCodec, 'dumps', fail_once)
+
+    first = pc.save_user_file()
+    started.wait()
+    pc.pay('user2', 'user3', 50)
+    second = pc.save_user_file()
+    resume.set()
+    with pytest.raises(OSError):
+        first.result()
+    second.result()
+
+    assert _journal_files(pc)
+    expected = _balances(pc, 'user0', 'user1', 'user2', 'user3')
+    pc.close()
+    pc2 = make_procoin()
+    assert _balances(pc2, 'user0', 'user1', 'user2', 'user3') == expected
+
+    # The next save includes the users from the failed save.
+    pc2.save_user_file_blocking()
+    assert _journal_files(pc2) == []
+
+def test_sqlite_round_trip(make_procoin: Callable[..., ProCoin]) -> None:
+    # The database imports users.json if it is empty.
+    pc = _setup(make_procoin)
+    pc.pay('user0', 'user1', 100)
+    pc.close()
+    pc = make_procoin('users.db')
+    assert _balances(pc, 'user0', 'user1') == [999_900, 1_000_100]
+
+    pc.add_cash('user1', 2 ** 70)
+    pc.pay('user1', 'user2', 2 ** 40)
+    pc.add_item('user2', pc.items.get_item('gold'), 2)
+    pc.add_item('user3', pc.items.get_item('pear'), 1)
+    pc.users.get_or_create('user4').add_item(pc.items.get_item('apple'), 5)
+    pc.save_user_file_blocking()
+    assert not pc.users.dirty
+
+    # Transactions are committed immediately, so removed items have to be
+    # deleted from the database.
+    pc.sell('user3', 'pear', 1)
+    pc.pay('user3', 'user0', 1)
+    expected = pc.users.to_dict()
+    pc.close()
+    assert make_procoin('users.db').users.to_dict() == expected
+
+def test_sqlite_orphan_inventory(make_procoin: Callable[..., ProCoin],
+        capsys: pytest.CaptureFixture[str]) -> None:
+    pc = make_procoin('users.db')
+    pc.add_item('user0', pc.items.get_item('apple'), 1)
+    pc.storage.conn.execute("INSERT INTO inventory (user_id, item_id, qty) "
+                            "VALUES ('missing', 'apple', 1)")
+    expected = pc.users.to_dict()
+    pc.close()
+
+    assert make_procoin('users.db').users.to_dict() == expected
+    assert 'Ignoring 1 inventory rows' in capsys.readouterr().out
+
+# Records appended while the journal is being rotated (for example by
+# another thread) aren't lost.
+def test_journal_append_during_rotate(tmp_path: pathlib.Path) -> None:
+    filename = os.path.join(tmp_path, 'users.json.journal')
+    journal = db.Journal(filename)
+
+    def append() -> None:
+        for i in range(2000):
+            journal.append(str(i), i, {})
+    thread = threading.Thread(target=append)
+    thread.start()
+    while thread.is_alive():
+        journal.rotate()
+    thread.join()
+    journal.close()
+
+    users: dict[str, Any] = {}
+    assert len(db.replay_journal(filename, users)) == 2000
+    assert all(users[str(i)]['balance'] == i for i in range(2000))
@@ -0,0 +1,195 @@
+from __future__ import annotations
+import os, pathlib
+from collections.abc import Callable
+from typing import Any
+import pytest
+from procoin import binary, db
+from procoin.core import ProCoin
+from procoin.storage import Storage
+from procoin.store import Error
+from procoin.users import UserInterface
+
+def _raw_users(n: int) -> dict[str, Any]:
+    return {str(i): {'balance': 1000 + i,
+                     'inventory': {'apple': i % 4 + 1, 'gold': i % 3 + 1}}
+            for i in range(n)}
+
+# Writes users.json, or users.bin if binary is True.
+def _write_users(directory: pathlib.Path, users: dict[str, Any],
+        binary: bool = False) -> None:
+    if binary:
+        db.save_blocking(os.path.join(directory, 'users.bin'), users,
+                         codec='binary')
+    else:
+        db.save_blocking(os.path.join(directory, 'users.json'), users)
+
+@pytest.mark.parametrize('user_file', ['users.json', 'users.bin'])
+def test_unhydrated_users(make_procoin: Callable[..., ProCoin],
+        tmp_path: pathlib.Path, user_file: str) -> None:
+    raw = _raw_users(300)
+    _write_users(tmp_path, raw, user_file == 'users.bin')
+
+    # Every user is written to the shards the first time.
+    pc = make_procoin(user_file)
+    pc.save_user_file_blocking()
+    pc.close()
+
+    # Only one user is changed, so the others in their shard are rewritten
+    # from the raw data without being converted to User objects.
+    pc = make_procoin(user_file)
+    shard = UserInterface.shard_of('7')
+    neighbours = [u for u in raw if UserInterface.shard_of(u) == shard]
+    assert len(neighbours) > 1
+    pc.pay('7', '8', 5)
+    assert set(pc.users.users) == {'7', '8'}
+    apple = pc.items.get_item('apple')
+    assert pc.users.holders[apple.index] == {'7', '8'}
+    pc.save_user_file_blocking()
+
+    # A transaction after the save is only in the journal.
+    pc.add_item('9', pc.items.get_item('pear'), 2)
+    assert set(pc.users.users) == {'7', '8', '9'}
+    pc.close()
+
+    raw['7']['balance'] -= 5
+    raw['8']['balance'] += 5
+    raw['9']['inventory']['pear'] = 2
+    pc = make_procoin(user_file)
+    assert pc.users.to_dict() == raw
+    assert len(pc.users) == len(raw)
+    assert set(pc.users.users) == set()
+
+# Unknown items are deleted when a user is first converted to a User, which
+# marks them as modified so the deletion is saved.
+def test_unknown_items(make_procoin: Callable[..., ProCoin],
+        tmp_path: pathlib.Path, capsys: pytest.CaptureFixture[str]) -> None:
+    _write_users(tmp_path, {
+        '1': {'balance': 1, 'inventory': {'apple': 1, 'removed': 2}},
+        '2': {'balance': 2, 'inventory': {'apple': 1}},
+    })
+    pc = make_procoin()
+    pc.users.dirty.clear()
+    assert pc.users.find_by_id('1').inventory == {'apple': 1}
+    assert pc.users.find_by_id('2') is not None
+    assert pc.users.dirty == {'1'}
+    assert 'removed' in capsys.readouterr().out
+
+    # Holders are only tracked for converted users.
+    apple = pc.items.get_item('apple')
+    assert pc.users.holders[apple.index] == {'1', '2'}
+
+# Quantities that don't fit in 64 bits are supported by every storage
+# backend.
+@pytest.mark.parametrize('user_file',
+                         ['users.json', 'users.bin', 'users.db'])
+def test_huge_quantities(make_procoin: Callable[..., ProCoin],
+        tmp_path: pathlib.Path, user_file: str) -> None:
+    _write_users(tmp_path, {
+        '1': {'balance': 0, 'inventory': {'apple': 2 ** 70, 'pear': 1}},
+        '2': {'balance': 0, 'inventory': {'apple': 2 ** 63 - 1}},
+    }, user_file == 'users.bin')
+    pc = make_procoin(user_file)
+    apple = pc.items.get_item('apple')
+    pear = pc.items.get_item('pear')
+    user1 = pc.users.find_by_id('1')
+    assert user1.get_qty(apple) == 2 ** 70
+    assert user1.boost == 1 + 2 ** 70 * apple.boost + pear.boost
+
+    # Adding to an existing quantity or adding a new item.
+    pc.add_item('2', apple, 1)
+    pc.add_item('2', pear, 2 ** 64)
+    pc.add_item('3', pear, 2 ** 65)
+    pc.give_item('1', '2', 'apple', 2 ** 69)
+    pc.give_item('2', '1', 'pear', 1)
+    expected = {
+        '1': {'balance': 0, 'inventory': {'apple': 2 ** 69, 'pear': 2}},
+        '2': {'balance': 0, 'inventory': {'apple': 2 ** 63 + 2 ** 69,
+                                          'pear': 2 ** 64 - 1}},
+        '3': {'balance': 1_000_000, 'inventory': {'pear': 2 ** 65}},
+    }
+    assert pc.users.to_dict() == expected
+    assert not pc.users.verify_stats()
+    pc.save_user_file_blocking()
+    pc.close()
+    assert make_procoin(user_file).users.to_dict() == expected
+
+# If the storage backend can't commit a transaction, the users and the store
+# are rolled back. Failed commands don't modify anything.
+def test_transaction_rollback(make_procoin: Callable[..., ProCoin],
+        monkeypatch: pytest.MonkeyPatch) -> None:
+    pc = make_procoin()
+    apple = pc.items.get_item('apple')
+    pc.store.sell(apple, 5)
+    user = pc.users.get_or_create('1')
+    pc.users.get_or_create('2')
+    pc.add_item('1', pc.items.get_item('pear'), 2)
+    pc.save_user_file_blocking()
+    expected_user = user.to_dict()
+    expected_store = pc.store._snapshot()
+    journal_size = os.path.getsize(pc.storage.journal_filename)
+
+    with pytest.raises(Error):
+        pc.buy('1', 'apple', 6)
+    with pytest.raises(Error):
+        pc.sell('1', 'pear', 3)
+    with pytest.raises(Error):
+        pc.pay('1', '2', 10 ** 9)
+    assert not pc.users.dirty
+
+    def commit(self: Storage, *args: Any) -> None:
+        raise OSError('Disk full')
+    monkeypatch.setattr(type(pc.storage), 'commit', commit)
+    for f in (lambda : pc.buy('1', 'apple', 2),
+              lambda : pc.sell('1', 'pear', 1)):
+        with pytest.raises(OSError):
+            f()
+        assert user.to_dict() == expected_user
+        assert pc.store._snapshot() == expected_store
+
+    monkeypatch.undo()
+    assert os.path.getsize(pc.storage.journal_filename) == journal_size
+    assert pc.buy('1', 'apple', 5) == 500
+    assert apple not in pc.store.current_stock or \
+        pc.store.current_stock[apple] == apple.default_qty
+
+# Saving copies the dirty shards without decoding the users that haven't
+# been converted to User objects, and later changes don't affect the copies.
+def test_shard_copies(make_procoin: Callable[..., ProCoin],
+        tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    raw = _raw_users(300)
+    _write_users(tmp_path, raw, binary=True)
+    pc = make_procoin('users.bin')
+    pc.save_user_file_blocking()
+    pc.close()
+    pc = make_procoin('users.bin')
+
+    decoded: list[int] = []
+    decode = binary._UsersFile.decode
+    def count_decode(self: binary._UsersFile, pos: int) -> Any:
+        decoded.append(pos)
+        return decode(self, pos)
+    monkeypatch.setattr(binary._UsersFile, 'decode', count_decode)
+
+    pc.pay('7', '8', 5)
+    decoded.clear()
+    shard = UserInterface.shard_of('7')
+    neighbours = {u for u in raw if UserInterface.shard_of(u) == shard}
+    shards = pc.users.dirty_shards_to_dict()
+    assert shard in shards
+    assert decoded == []
+
+    expected = {u: raw[u] for u in neighbours}
+    user = pc.users.find_by_id('7')
+    assert user is not None
+    expected['7'] = user.to_dict()
+    new_id = next(str(i) for i in range(300, 10_000)
+                  if UserInterface.shard_of(str(i)) == shard)
+    pc.pay('7', '8', 5)
+    pc.users.get_or_create(new_id)
+    assert set(shards[shard]) == neighbours
+    assert len(shards[shard]) == len(neighbours)
+    assert dict(shards[shard]) == expected
+    assert new_id not in shards[shard]
+    with pytest.raises(KeyError):
+        shards[shard][new_id]
+    assert decoded
@@ -0,0 +1,27 @@
+from __future__ import annotations
+import asyncio, threading, time
+import pytest
+from procoin.watchdog import Watchdog
+
+def test_blocked_loop(capsys: pytest.CaptureFixture[str]) -> None:
+    async def main() -> None:
+        watchdog = Watchdog(interval=0.02, threshold=0.1)
+        watchdog.start()
+        await asyncio.sleep(0.05)
+        time.sleep(0.3)
+        await asyncio.sleep(0.05)
+
+        # Stopping the watchdog doesn't wait for the helper thread.
+        start = time.perf_counter()
+        watchdog.stop()
+        assert time.perf_counter() - start < 0.05
+        assert watchdog.blocked == 1
+        assert watchdog.percentile(100) >= 0.2
+
+    asyncio.run(main())
+    assert 'test_watchdog.py' in capsys.readouterr().err
+
+    # The helper thread exits shortly afterwards.
+    time.sleep(0.1)
+    assert not any(thread.name == 'procoin.watchdog'
+                   for thread in threading.enumerate())